@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+'''
+Engine that keeps the leases cached in Vault from expiring, by regularly running
+mdl_vault.renew_cached_leases, so pillar renders don't have to regenerate them.
+
+:configuration: Enable it in the master or minion config::
+
+    engines:
+      - mdl_vault_renewal:
+          interval: 1800
+
+`renew_ahead` defaults to twice the interval, so that every lease gets at least
+one attempt at renewing it before it gets within `vault.lease_renewal_threshold`
+of expiring.
+'''
+from __future__ import absolute_import
+
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+def start(interval=1800, renew_ahead=None, max_workers=10):
+    if renew_ahead is None:
+        renew_ahead = 2*interval
+
+    while True:
+        started = time.time()
+        try:
+            __salt__['mdl_vault.renew_cached_leases'](renew_ahead=renew_ahead,
+                                                      max_workers=max_workers)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Failed to renew cached Vault leases')
+        time.sleep(max(0, interval - (time.time() - started)))
@@ -49,23 +49,28 @@ from __future__ import absolute_import, unicode_literals, print_function
 import sys
 import os.path
 import base64
+import copy
 import errno
+import hashlib
 import logging
+import re
 import tempfile
-import signal
-from time import sleep
-from contextlib import contextmanager
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from salt.exceptions import CommandExecutionError
 from salt.ext.six import iteritems
 from salt.ext import six
 import salt.utils.files
-import salt.utils.platform
 import salt.utils.templates
 import salt.utils.versions
 import salt.utils.yaml
-from salt.exceptions import TimeoutError
-from salt.ext.six.moves import range  # pylint: disable=import-error
+
+try:
+    from salt.utils.ctx import RequestContext
+except ImportError:
+    RequestContext = None
 
 try:
     import kubernetes  # pylint: disable=import-self
@@ -90,6 +95,15 @@ log = logging.getLogger(__name__)
 
 __virtualname__ = 'mdl_kubernetes'
 
+DEFAULT_MAX_WORKERS = 10
+
+# Connections are cached for the lifetime of the process, keyed by a hash of
+# the config, so that the kubeconfig is only parsed and the connection pool only
+# set up once per distinct config. Each value is the mtime of the kubeconfig when
+# it was loaded and the dict returned by _setup_conn.
+_client_cache = {}
+_client_cache_lock = threading.Lock()
+
 
 def __virtual__():
     '''
@@ -101,19 +115,44 @@ def __virtual__():
     return False, 'python kubernetes library not found'
 
 
-if not salt.utils.platform.is_windows():
-    @contextmanager
-    def _time_limit(seconds):
-        def signal_handler(signum, frame):
-            raise TimeoutError
-        signal.signal(signal.SIGALRM, signal_handler)
-        signal.alarm(seconds)
+DELETION_TIME_LIMIT = 30
+
+
+def _wait_for_deletion(list_func, name, timeout, **list_kwargs):
+    '''
+    Wait for the object identified by name to be deleted, by watching it from
+    the resourceVersion of a listing of just that object. Returns True as soon as
+    it's gone, or False if it still exists after timeout seconds.
+    '''
+    deadline = time.time() + timeout
+    field_selector = 'metadata.name={0}'.format(name)
+    while True:
+        objects = list_func(field_selector=field_selector, **list_kwargs)
+        if not objects.items:
+            return True
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+
+        watch = kubernetes.watch.Watch()
         try:
-            yield
+            for event in watch.stream(list_func,
+                                      field_selector=field_selector,
+                                      resource_version=objects.metadata.resource_version,
+                                      timeout_seconds=max(1, int(remaining)),
+                                      _request_timeout=remaining + 5,
+                                      **list_kwargs):
+                if event['type'] == 'DELETED':
+                    return True
+                if event['type'] == 'ERROR':
+                    # Most likely the resourceVersion expired, list it again
+                    break
+        except ApiException as exc:
+            if exc.status != 410:
+                raise
         finally:
-            signal.alarm(0)
-
-    POLLING_TIME_LIMIT = 30
+            watch.stop()
 
 
 def _setup_conn_old(**kwargs):
@@ -190,21 +229,39 @@ def _setup_conn_old(**kwargs):
     return {}
 
 
+def _client_cache_key(kubeconfig, context, kubeconfig_data):
+    key = repr((kubeconfig, context, kubeconfig_data))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _kubeconfig_mtime(kubeconfig):
+    try:
+        return os.path.getmtime(kubeconfig) if kubeconfig else None
+    except (IOError, OSError):
+        return None
+
+
+def _write_kubeconfig_data(kubeconfig_data):
+    with tempfile.NamedTemporaryFile(prefix='salt-kubeconfig-', delete=False) as kcfg:
+        kcfg.write(base64.b64decode(kubeconfig_data))
+    return kcfg.name
+
+
 # pylint: disable=no-member
 def _setup_conn(**kwargs):
     '''
-    Setup kubernetes API connection singleton
+    Setup kubernetes API connection, reusing the cached ApiClient if one has
+    already been created for the same config.
     '''
     kubeconfig = kwargs.get('kubeconfig') or __salt__['config.option']('kubernetes.kubeconfig')
     kubeconfig_data = kwargs.get('kubeconfig_data') or __salt__['config.option']('kubernetes.kubeconfig-data')
     context = kwargs.get('context') or __salt__['config.option']('kubernetes.context')
 
-    if (kubeconfig_data and not kubeconfig) or (kubeconfig_data and kwargs.get('kubeconfig_data')):
-        with tempfile.NamedTemporaryFile(prefix='salt-kubeconfig-', delete=False) as kcfg:
-            kcfg.write(base64.b64decode(kubeconfig_data))
-            kubeconfig = kcfg.name
+    use_data = (kubeconfig_data and not kubeconfig) or (kubeconfig_data and kwargs.get('kubeconfig_data'))
+    if use_data:
+        kubeconfig = None
 
-    if not (kubeconfig and context):
+    if not ((kubeconfig or use_data) and context):
         if kwargs.get('api_url') or __salt__['config.option']('kubernetes.api_url'):
             salt.utils.versions.warn_until('Sodium',
                     'Kubernetes configuration via url, certificate, username and password will be removed in Sodiom. '
@@ -215,10 +272,42 @@ def _setup_conn(**kwargs):
                 raise CommandExecutionError('Old style kubernetes configuration is only supported up to python-kubernetes 2.0.0')
         else:
             raise CommandExecutionError('Invalid kubernetes configuration. Parameter \'kubeconfig\' and \'context\' are required.')
-    kubernetes.config.load_kube_config(config_file=kubeconfig, context=context)
 
-    # The return makes unit testing easier
-    return {'kubeconfig': kubeconfig, 'context': context}
+    key = _client_cache_key(kubeconfig, context, kubeconfig_data if use_data else None)
+    # The client is recreated when the kubeconfig changed, so that rotated
+    # credentials get picked up without having to restart the process
+    mtime = _kubeconfig_mtime(kubeconfig)
+    cached = _client_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with _client_cache_lock:
+        cached = _client_cache.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        if use_data:
+            # The kubeconfig is read into memory right away, don't leave the
+            # credentials lying around in a temp file
+            config_file = _write_kubeconfig_data(kubeconfig_data)
+            try:
+                api_client = kubernetes.config.new_client_from_config(
+                    config_file=config_file, context=context, persist_config=False)
+            finally:
+                _remove_kubeconfig(config_file)
+        else:
+            api_client = kubernetes.config.new_client_from_config(
+                config_file=kubeconfig, context=context)
+
+        # The return makes unit testing easier
+        cfg = {
+            'kubeconfig': kubeconfig,
+            'context': context,
+            'api_client': api_client,
+        }
+        # Replaces the entry for an older version of the kubeconfig
+        _client_cache[key] = (mtime, cfg)
+        return cfg
 
 
 def _cleanup_old(**kwargs):
@@ -236,18 +325,25 @@ def _cleanup_old(**kwargs):
         pass
 
 
+def _remove_kubeconfig(kubeconfig):
+    if kubeconfig and os.path.basename(kubeconfig).startswith('salt-kubeconfig-'):
+        try:
+            os.unlink(kubeconfig)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                log.exception(err)
+
+
 def _cleanup(**kwargs):
     if not kwargs:
         return _cleanup_old(**kwargs)
 
+    # Cached connections don't have a temporary kubeconfig to remove
+    if 'api_client' in kwargs:
+        return None
+
     if 'kubeconfig' in kwargs:
-        kubeconfig = kwargs.get('kubeconfig')
-        if kubeconfig and os.path.basename(kubeconfig).startswith('salt-kubeconfig-'):
-            try:
-                os.unlink(kubeconfig)
-            except (IOError, OSError) as err:
-                if err.errno != errno.ENOENT:
-                    log.exception(err)
+        _remove_kubeconfig(kwargs.get('kubeconfig'))
 
 
 def ping(**kwargs):
@@ -278,7 +374,7 @@ def nodes(**kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_node()
 
         return [k8s_node['metadata']['name'] for k8s_node in api_response.to_dict().get('items')]
@@ -292,6 +388,54 @@ def nodes(**kwargs):
         _cleanup(**cfg)
 
 
+def _current_jid(kwargs):
+    '''
+    Return the jid of the job we're running in, the same way salt's logging finds
+    it for functions called by states, which don't get __pub_jid.
+    '''
+    jid = kwargs.get('__pub_jid')
+    if jid is None and RequestContext is not None:
+        jid = RequestContext.current.get('data', {}).get('jid')
+    return jid
+
+
+def _node_cache(kwargs, create=True):
+    '''
+    Return the run-scoped cache of node metadata for the cluster selected by the
+    connection arguments in kwargs. __context__ outlives the job when the minion
+    runs with multiprocessing disabled, so the cache is dropped when the jid
+    changes.
+    '''
+    jid = _current_jid(kwargs)
+    cache = __context__.get('mdl_kubernetes.node_metadata')
+    if cache is None or cache['jid'] != jid:
+        if not create:
+            return None
+        cache = __context__['mdl_kubernetes.node_metadata'] = {'jid': jid, 'clusters': {}}
+    cluster = tuple(kwargs.get(key) for key in ('kubeconfig', 'kubeconfig_data', 'context'))
+    return cache['clusters'].setdefault(cluster, {})
+
+
+def _update_node_cache(node_name, api_response, kwargs):
+    if api_response is None:
+        return
+    cache = _node_cache(kwargs, create=False)
+    if cache is not None:
+        cache[node_name] = api_response.to_dict()['metadata']
+
+
+def _node_metadata(name, use_cache, kwargs):
+    if not use_cache:
+        match = node(name, **kwargs)
+        return match['metadata'] if match is not None else None
+
+    cache = _node_cache(kwargs)
+    if name not in cache:
+        match = node(name, **kwargs)
+        cache[name] = match['metadata'] if match is not None else None
+    return cache[name]
+
+
 def node(name, **kwargs):
     '''
     Return the details of the node identified by the specified name
@@ -302,36 +446,37 @@ def node(name, **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
-        api_response = api_instance.list_node()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
+        api_response = api_instance.read_node(name)
     except (ApiException, HTTPError) as exc:
         if isinstance(exc, ApiException) and exc.status == 404:
             return None
         else:
-            log.exception('Exception when calling CoreV1Api->list_node')
+            log.exception('Exception when calling CoreV1Api->read_node')
             raise CommandExecutionError(exc)
     finally:
         _cleanup(**cfg)
 
-    for k8s_node in api_response.items:
-        if k8s_node.metadata.name == name:
-            return k8s_node.to_dict()
-
-    return None
+    return api_response.to_dict()
 
 
-def node_labels(name, **kwargs):
+def node_labels(name, use_cache=False, **kwargs):
     '''
     Return the labels of the node identified by the specified name
 
+    use_cache
+        Reuse the node metadata already fetched during this run, and keep it up
+        to date with the label changes made through this module. Used by the
+        node label states, to make several states on the same node cost a single
+        request.
+
     CLI Examples::
 
         salt '*' kubernetes.node_labels name="minikube"
     '''
-    match = node(name, **kwargs)
-
-    if match is not None:
-        return match['metadata']['labels']
+    metadata = _node_metadata(name, use_cache, kwargs)
+    if metadata is not None:
+        return dict(metadata['labels'] or {})
 
     return {}
 
@@ -349,7 +494,7 @@ def node_add_label(node_name, label_name, label_value, **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         body = {
             'metadata': {
                 'labels': {
@@ -357,6 +502,7 @@ def node_add_label(node_name, label_name, label_value, **kwargs):
                 }
         }
         api_response = api_instance.patch_node(node_name, body)
+        _update_node_cache(node_name, api_response, kwargs)
         return api_response
     except (ApiException, HTTPError) as exc:
         if isinstance(exc, ApiException) and exc.status == 404:
@@ -382,7 +528,7 @@ def node_remove_label(node_name, label_name, **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         body = {
             'metadata': {
                 'labels': {
@@ -390,6 +536,7 @@ def node_remove_label(node_name, label_name, **kwargs):
                 }
         }
         api_response = api_instance.patch_node(node_name, body)
+        _update_node_cache(node_name, api_response, kwargs)
         return api_response
     except (ApiException, HTTPError) as exc:
         if isinstance(exc, ApiException) and exc.status == 404:
@@ -403,6 +550,113 @@ def node_remove_label(node_name, label_name, **kwargs):
     return None
 
 
+def _node_labels_diff(current, labels, absent, folders_absent):
+    '''
+    Return the merge patch of labels that brings the current labels to the
+    desired state, with None as the value of labels to remove.
+    '''
+    folders = tuple(folder.strip('/') + '/' for folder in folders_absent)
+    diff = {}
+    for label in current:
+        if label in labels:
+            continue
+        if label in absent or (folders and label.startswith(folders)):
+            diff[label] = None
+    for label, value in iteritems(labels):
+        if current.get(label) != value:
+            diff[label] = value
+    return diff
+
+
+def node_labels_managed(nodes,
+                        labels=None,
+                        absent=None,
+                        folders_absent=None,
+                        test=False,
+                        use_cache=False,
+                        max_workers=DEFAULT_MAX_WORKERS,
+                        **kwargs):
+    '''
+    Bring the labels of one or more nodes to the desired state with a single
+    read and at most one patch per node, processing the nodes concurrently.
+
+    Returns the label changes per node as a dict of label name to `old` and
+    `new` values, where a missing label is None. Nodes that don't exist are
+    returned as None.
+
+    nodes
+        The name of the node, or a list of names
+
+    labels
+        Dict of labels that should be set to the given values
+
+    absent
+        List of labels that should be removed
+
+    folders_absent
+        List of label folders (like `example.com/`) whose labels should be
+        removed, except for those in `labels`
+
+    test
+        Only compute the changes, don't apply them
+
+    CLI Examples::
+
+        salt '*' kubernetes.node_labels_managed minikube \
+            labels='{"example.com/role": "web"}' folders_absent='["old.example.com"]'
+    '''
+    if isinstance(nodes, six.string_types):
+        nodes = [nodes]
+    labels = __enforce_only_strings_dict(labels or {})
+    absent = set(absent or ())
+    folders_absent = folders_absent or ()
+    cfg = _setup_conn(**kwargs)
+
+    def manage(node_name):
+        metadata = _node_metadata(node_name, use_cache, kwargs)
+        if metadata is None:
+            return None
+
+        current = metadata['labels'] or {}
+        diff = _node_labels_diff(current, labels, absent, folders_absent)
+        if diff and not test:
+            api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
+            try:
+                api_response = api_instance.patch_node(node_name, {'metadata': {'labels': diff}})
+            except (ApiException, HTTPError) as exc:
+                if isinstance(exc, ApiException) and exc.status == 404:
+                    return None
+                log.exception('Exception when calling CoreV1Api->patch_node')
+                raise CommandExecutionError(exc)
+            _update_node_cache(node_name, api_response, kwargs)
+
+        return {
+            label: {'old': current.get(label), 'new': value}
+            for label, value in iteritems(diff)
+        }
+
+    ret = {}
+    errors = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(nodes))))
+    try:
+        futures = [(node_name, executor.submit(manage, node_name)) for node_name in nodes]
+        for node_name, future in futures:
+            try:
+                ret[node_name] = future.result()
+            except Exception as exc:  # pylint: disable=broad-except
+                errors[node_name] = exc
+    finally:
+        executor.shutdown(wait=False)
+        _cleanup(**cfg)
+
+    if errors:
+        raise CommandExecutionError(
+            'Failed to manage the labels of {0}'.format(', '.join(
+                '{0} ({1})'.format(node_name, exc) for node_name, exc in iteritems(errors))),
+            info={'changes': ret})
+    return ret
+
+
 def namespaces(**kwargs):
     '''
     Return the names of the available namespaces
@@ -414,7 +668,7 @@ def namespaces(**kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_namespace()
 
         return [nms['metadata']['name'] for nms in api_response.to_dict().get('items')]
@@ -439,7 +693,7 @@ def deployments(namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.ExtensionsV1beta1Api()
+        api_instance = kubernetes.client.ExtensionsV1beta1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_namespaced_deployment(namespace)
 
         return [dep['metadata']['name'] for dep in api_response.to_dict().get('items')]
@@ -467,7 +721,7 @@ def services(namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_namespaced_service(namespace)
 
         return [srv['metadata']['name'] for srv in api_response.to_dict().get('items')]
@@ -495,7 +749,7 @@ def pods(namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_namespaced_pod(namespace)
 
         return [pod['metadata']['name'] for pod in api_response.to_dict().get('items')]
@@ -523,7 +777,7 @@ def secrets(namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_namespaced_secret(namespace)
 
         return [secret['metadata']['name'] for secret in api_response.to_dict().get('items')]
@@ -551,7 +805,7 @@ def configmaps(namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.list_namespaced_config_map(namespace)
 
         return [secret['metadata']['name'] for secret in api_response.to_dict().get('items')]
@@ -579,7 +833,7 @@ def show_deployment(name, namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.ExtensionsV1beta1Api()
+        api_instance = kubernetes.client.ExtensionsV1beta1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.read_namespaced_deployment(name, namespace)
 
         return api_response.to_dict()
@@ -607,7 +861,7 @@ def show_service(name, namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.read_namespaced_service(name, namespace)
 
         return api_response.to_dict()
@@ -635,7 +889,7 @@ def show_pod(name, namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.read_namespaced_pod(name, namespace)
 
         return api_response.to_dict()
@@ -662,7 +916,7 @@ def show_namespace(name, **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.read_namespace(name)
 
         return api_response.to_dict()
@@ -693,7 +947,7 @@ def show_secret(name, namespace='default', decode=False, **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.read_namespaced_secret(name, namespace)
 
         ret = api_response.to_dict()
@@ -727,7 +981,7 @@ def show_configmap(name, namespace='default', **kwargs):
     '''
     cfg = _setup_conn(**kwargs)
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.read_namespaced_config_map(
             name,
             namespace)
@@ -746,9 +1000,10 @@ def show_configmap(name, namespace='default', **kwargs):
         _cleanup(**cfg)
 
 
-def delete_deployment(name, namespace='default', **kwargs):
+def delete_deployment(name, namespace='default', wait_timeout=DELETION_TIME_LIMIT, **kwargs):
     '''
-    Deletes the kubernetes deployment defined by name and namespace
+    Deletes the kubernetes deployment defined by name and namespace, waiting up
+    to wait_timeout seconds for it to be gone.
 
     CLI Examples::
 
@@ -759,31 +1014,16 @@ def delete_deployment(name, namespace='default', **kwargs):
     body = kubernetes.client.V1DeleteOptions(orphan_dependents=True)
 
     try:
-        api_instance = kubernetes.client.ExtensionsV1beta1Api()
+        api_instance = kubernetes.client.ExtensionsV1beta1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.delete_namespaced_deployment(
             name=name,
             namespace=namespace,
             body=body)
         mutable_api_response = api_response.to_dict()
-        if not salt.utils.platform.is_windows():
-            try:
-                with _time_limit(POLLING_TIME_LIMIT):
-                    while show_deployment(name, namespace) is not None:
-                        sleep(1)
-                    else:  # pylint: disable=useless-else-on-loop
-                        mutable_api_response['code'] = 200
-            except TimeoutError:
-                pass
+        if _wait_for_deletion(api_instance.list_namespaced_deployment, name,
+                              wait_timeout, namespace=namespace):
+            mutable_api_response['code'] = 200
         else:
-            # Windows has not signal.alarm implementation, so we are just falling
-            # back to loop-counting.
-            for i in range(60):
-                if show_deployment(name, namespace) is None:
-                    mutable_api_response['code'] = 200
-                    break
-                else:
-                    sleep(1)
-        if mutable_api_response['code'] != 200:
             log.warning('Reached polling time limit. Deployment is not yet '
                         'deleted, but we are backing off. Sorry, but you\'ll '
                         'have to check manually.')
@@ -813,7 +1053,7 @@ def delete_service(name, namespace='default', **kwargs):
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.delete_namespaced_service(
             name=name,
             namespace=namespace)
@@ -831,9 +1071,11 @@ def delete_service(name, namespace='default', **kwargs):
         _cleanup(**cfg)
 
 
-def delete_pod(name, namespace='default', **kwargs):
+def delete_pod(name, namespace='default', wait_timeout=None, **kwargs):
     '''
-    Deletes the kubernetes pod defined by name and namespace
+    Deletes the kubernetes pod defined by name and namespace. If wait_timeout is
+    given, waits up to that many seconds for the pod to be gone, and sets `code`
+    to 200 in the response if it is.
 
     CLI Examples::
 
@@ -844,13 +1086,17 @@ def delete_pod(name, namespace='default', **kwargs):
     body = kubernetes.client.V1DeleteOptions(orphan_dependents=True)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.delete_namespaced_pod(
             name=name,
             namespace=namespace,
             body=body)
 
-        return api_response.to_dict()
+        mutable_api_response = api_response.to_dict()
+        if wait_timeout is not None and _wait_for_deletion(
+                api_instance.list_namespaced_pod, name, wait_timeout, namespace=namespace):
+            mutable_api_response['code'] = 200
+        return mutable_api_response
     except (ApiException, HTTPError) as exc:
         if isinstance(exc, ApiException) and exc.status == 404:
             return None
@@ -864,9 +1110,11 @@ def delete_pod(name, namespace='default', **kwargs):
         _cleanup(**cfg)
 
 
-def delete_namespace(name, **kwargs):
+def delete_namespace(name, wait_timeout=None, **kwargs):
     '''
-    Deletes the kubernetes namespace defined by name
+    Deletes the kubernetes namespace defined by name. If wait_timeout is given,
+    waits up to that many seconds for the namespace to be gone, and sets `code`
+    to 200 in the response if it is.
 
     CLI Examples::
 
@@ -877,9 +1125,13 @@ def delete_namespace(name, **kwargs):
     body = kubernetes.client.V1DeleteOptions(orphan_dependents=True)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.delete_namespace(name=name, body=body)
-        return api_response.to_dict()
+        mutable_api_response = api_response.to_dict()
+        if wait_timeout is not None and _wait_for_deletion(
+                api_instance.list_namespace, name, wait_timeout):
+            mutable_api_response['code'] = 200
+        return mutable_api_response
     except (ApiException, HTTPError) as exc:
         if isinstance(exc, ApiException) and exc.status == 404:
             return None
@@ -906,7 +1158,7 @@ def delete_secret(name, namespace='default', **kwargs):
     body = kubernetes.client.V1DeleteOptions(orphan_dependents=True)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.delete_namespaced_secret(
             name=name,
             namespace=namespace,
@@ -938,7 +1190,7 @@ def delete_configmap(name, namespace='default', **kwargs):
     body = kubernetes.client.V1DeleteOptions(orphan_dependents=True)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.delete_namespaced_config_map(
             name=name,
             namespace=namespace,
@@ -985,7 +1237,7 @@ def create_deployment(
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.ExtensionsV1beta1Api()
+        api_instance = kubernetes.client.ExtensionsV1beta1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.create_namespaced_deployment(
             namespace, body)
 
@@ -1030,7 +1282,7 @@ def create_pod(
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.create_namespaced_pod(
             namespace, body)
 
@@ -1075,7 +1327,7 @@ def create_service(
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.create_namespaced_service(
             namespace, body)
 
@@ -1130,7 +1382,7 @@ def create_secret(
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.create_namespaced_secret(
             namespace, body)
 
@@ -1181,7 +1433,7 @@ def create_configmap(
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.create_namespaced_config_map(
             namespace, body)
 
@@ -1217,7 +1469,7 @@ def create_namespace(
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.create_namespace(body)
 
         return api_response.to_dict()
@@ -1261,7 +1513,7 @@ def replace_deployment(name,
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.ExtensionsV1beta1Api()
+        api_instance = kubernetes.client.ExtensionsV1beta1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.replace_namespaced_deployment(
             name, namespace, body)
 
@@ -1312,7 +1564,7 @@ def replace_service(name,
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.replace_namespaced_service(
             name, namespace, body)
 
@@ -1367,7 +1619,7 @@ def replace_secret(name,
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.replace_namespaced_secret(
             name, namespace, body)
 
@@ -1418,7 +1670,7 @@ def replace_configmap(name,
     cfg = _setup_conn(**kwargs)
 
     try:
-        api_instance = kubernetes.client.CoreV1Api()
+        api_instance = kubernetes.client.CoreV1Api(api_client=cfg.get('api_client'))
         api_response = api_instance.replace_namespaced_config_map(
             name, namespace, body)
 
@@ -1436,6 +1688,240 @@ def replace_configmap(name,
         _cleanup(**cfg)
 
 
+# Lists that strategic merge patches merge by a key of their items instead of
+# replacing them, by field name, or by parent and field name where the merge key
+# depends on the parent
+_MERGE_KEYS = {
+    'containers': 'name',
+    'initContainers': 'name',
+    'env': 'name',
+    'volumes': 'name',
+    'volumeMounts': 'mountPath',
+    'imagePullSecrets': 'name',
+    'containers.ports': 'containerPort',
+    'initContainers.ports': 'containerPort',
+    'spec.ports': 'port',
+}
+
+
+def _merge_key(path):
+    # List items show up in the path as field[key], only the fields count
+    fields = re.sub(r'\[[^\]]*\]', '', path).split('.')
+    return _MERGE_KEYS.get('.'.join(fields[-2:])) or _MERGE_KEYS.get(fields[-1])
+
+
+def _is_subset(desired, live):
+    '''
+    Whether live matches everything set in desired, ignoring the fields only set
+    in live, which are either defaulted or managed by the API server.
+    '''
+    if isinstance(desired, dict) and isinstance(live, dict):
+        return all(key in live and _is_subset(value, live[key])
+                   for key, value in iteritems(desired))
+    if isinstance(desired, list) and isinstance(live, list):
+        return len(desired) == len(live) and all(
+            _is_subset(desired_item, live_item) for desired_item, live_item in zip(desired, live))
+    return desired == live
+
+
+def _merged_list_patch(merge_key, desired, live, changes, path):
+    '''
+    Return the strategic merge patch for a list merged by merge_key: the changed
+    fields of the items in both lists, the new items, and delete directives for
+    the items that are no longer wanted, or None if nothing changed.
+    '''
+    live_items = dict((item[merge_key], item) for item in live)
+    desired_keys = set(item[merge_key] for item in desired)
+    patch = []
+    for item in desired:
+        key = item[merge_key]
+        item_path = '{0}[{1}]'.format(path, key)
+        if key not in live_items:
+            changes[item_path] = {'old': None, 'new': item}
+            patch.append(item)
+            continue
+        item_patch = _object_patch(item, live_items[key], changes, item_path)
+        if item_patch is not None:
+            item_patch[merge_key] = key
+            patch.append(item_patch)
+    for item in live:
+        key = item[merge_key]
+        if key not in desired_keys:
+            changes['{0}[{1}]'.format(path, key)] = {'old': item, 'new': None}
+            patch.append({merge_key: key, '$patch': 'delete'})
+    return patch or None
+
+
+def _object_patch(desired, live, changes, path=''):
+    '''
+    Return the strategic merge patch that brings live in line with desired, or
+    None if they already match, recording the changed fields in changes by their
+    dotted path.
+    '''
+    if _is_subset(desired, live):
+        return None
+
+    if isinstance(desired, dict) and isinstance(live, dict):
+        patch = {}
+        for key, value in iteritems(desired):
+            key_patch = _object_patch(value, live.get(key), changes,
+                                      '{0}.{1}'.format(path, key) if path else key)
+            if key_patch is not None:
+                patch[key] = key_patch
+        return patch or None
+
+    merge_key = _merge_key(path)
+    if (merge_key is not None and isinstance(desired, list) and isinstance(live, list) and
+            all(isinstance(item, dict) and merge_key in item for item in desired + live)):
+        # Items that are no longer wanted have to be deleted explicitly, the
+        # rest of the list is left alone
+        return _merged_list_patch(merge_key, desired, live, changes, path)
+
+    changes[path] = {'old': live, 'new': desired}
+    return desired
+
+
+def __patch_object(kind,
+                   api_class,
+                   obj_class,
+                   spec_creator,
+                   name,
+                   namespace,
+                   metadata,
+                   spec,
+                   source,
+                   template,
+                   saltenv,
+                   test,
+                   **kwargs):
+    '''
+    Read the live object, compare it with the desired one and patch the fields
+    that differ. Returns the changes, or None if the object doesn't exist.
+    '''
+    body = __create_object_body(
+        kind=kind,
+        obj_class=obj_class,
+        spec_creator=spec_creator,
+        name=name,
+        namespace=namespace,
+        metadata=copy.deepcopy(metadata or {}),
+        spec=spec or {},
+        source=source,
+        template=template,
+        saltenv=saltenv)
+    change_cause = body.metadata.annotations.get('kubernetes.io/change-cause')
+    record_change_cause = change_cause == ' '.join(sys.argv)
+    if record_change_cause:
+        # The change cause is the command that made the change, it only has to
+        # be updated when something else changes
+        del body.metadata.annotations['kubernetes.io/change-cause']
+
+    cfg = _setup_conn(**kwargs)
+    method = 'namespaced_' + kind.lower()
+
+    try:
+        api_instance = api_class(api_client=cfg.get('api_client'))
+        serialize = api_instance.api_client.sanitize_for_serialization
+        try:
+            live = getattr(api_instance, 'read_' + method)(name, namespace)
+        except ApiException as exc:
+            if exc.status == 404:
+                return None
+            raise
+
+        changes = {}
+        patch = _object_patch(serialize(body), serialize(live), changes)
+        if patch is not None and not test:
+            if record_change_cause:
+                patch.setdefault('metadata', {}).setdefault(
+                    'annotations', {})['kubernetes.io/change-cause'] = change_cause
+            getattr(api_instance, 'patch_' + method)(name, namespace, patch)
+
+        return changes
+    except (ApiException, HTTPError) as exc:
+        log.exception(
+            'Exception when calling %s->patch_%s', api_class.__name__, method)
+        raise CommandExecutionError(exc)
+    finally:
+        _cleanup(**cfg)
+
+
+def patch_deployment(name,
+                     namespace='default',
+                     metadata=None,
+                     spec=None,
+                     source=None,
+                     template=None,
+                     saltenv='base',
+                     test=False,
+                     **kwargs):
+    '''
+    Updates an existing deployment to the given metadata and spec, by sending
+    only the fields that differ from the live deployment as a strategic merge
+    patch. Fields that aren't specified, like the ones defaulted by the API
+    server, are left alone.
+
+    Returns the changed fields by their dotted path, which is empty if the
+    deployment is already up to date, or None if it doesn't exist. With
+    test=True the changes are only computed.
+
+    CLI Examples::
+
+        salt '*' kubernetes.patch_deployment my-nginx spec='{"replicas": 3}'
+    '''
+    return __patch_object('Deployment', kubernetes.client.ExtensionsV1beta1Api,
+                          AppsV1beta1Deployment, __dict_to_deployment_spec,
+                          name, namespace, metadata, spec, source, template,
+                          saltenv, test, **kwargs)
+
+
+def patch_service(name,
+                  namespace='default',
+                  metadata=None,
+                  spec=None,
+                  source=None,
+                  template=None,
+                  saltenv='base',
+                  test=False,
+                  **kwargs):
+    '''
+    Updates an existing service to the given metadata and spec, the same way
+    patch_deployment does.
+
+    CLI Examples::
+
+        salt '*' kubernetes.patch_service my-nginx spec='{"ports": [80, 443]}'
+    '''
+    return __patch_object('Service', kubernetes.client.CoreV1Api,
+                          kubernetes.client.V1Service, __dict_to_service_spec,
+                          name, namespace, metadata, spec, source, template,
+                          saltenv, test, **kwargs)
+
+
+def patch_pod(name,
+              namespace='default',
+              metadata=None,
+              spec=None,
+              source=None,
+              template=None,
+              saltenv='base',
+              test=False,
+              **kwargs):
+    '''
+    Updates an existing pod to the given metadata and spec, the same way
+    patch_deployment does. Note that most of the spec of a pod can't be changed
+    once it's created, the API server rejects such patches.
+
+    CLI Examples::
+
+        salt '*' kubernetes.patch_pod my-pod metadata='{"labels": {"app": "web"}}'
+    '''
+    return __patch_object('Pod', kubernetes.client.CoreV1Api,
+                          kubernetes.client.V1Pod, __dict_to_pod_spec,
+                          name, namespace, metadata, spec, source, template,
+                          saltenv, test, **kwargs)
+
+
 def __create_object_body(kind,
                          obj_class,
                          spec_creator,
@@ -7,7 +7,15 @@ This module provides methods for interacting with Hashicorp Vault.
 
 from __future__ import absolute_import
 
+import base64
+import contextlib
+import fnmatch
+import hashlib
 import logging
+import os
+import re
+import threading
+import time
 from datetime import datetime, timedelta
 
 log = logging.getLogger(__name__)
@@ -22,6 +30,14 @@ except ImportError:
 __all__ = ['initialize', 'is_initialized']
 
 SEVEN_DAYS = (7 * 24 * 60 * 60)
+ONE_HOUR = (60 * 60)
+
+# How many requests to have in flight at the same time for bulk operations
+DEFAULT_MAX_WORKERS = 10
+
+# Local cache of cached_read/cached_write results, in front of the cache in Vault
+_local_cache = {}
+_local_cache_lock = threading.Lock()
 
 
 def __init__(opts):
@@ -88,75 +104,449 @@ def initialize(secret_shares=5, secret_threshold=3, pgp_keys=None,
     return success, sealing_keys, root_token
 
 
-def scan_leases(prefix='', time_horizon=SEVEN_DAYS, send_events=True):
-    """Scan all leases and generate an event for any that are near expiration
+def request_stats():
+    """Get counters for the requests this process made to Vault, including how
+    many of them were retries and how long requests were held back by the rate
+    limit.
+
+    :rtype: dict
+
+    """
+    return __utils__['mdl_vault.request_stats']()
+
+
+def stats(reset=False, send_event=False):
+    """Get aggregates for the requests this process made to Vault, with p50, p95
+    and p99 latencies per path prefix and the total wall time spent waiting on
+    Vault.
+
+    Call this with `send_event=True` at the end of a run to report where its
+    Vault time went, e.g. from the last state of an orchestration.
+
+    :param reset: Clear the aggregates and request counters after reading them
+    :param send_event: Also send the aggregates as a vault/stats event
+    :rtype: dict
+
+    """
+    if send_event:
+        return __utils__['mdl_vault.send_stats_event'](reset=reset)
+    return __utils__['mdl_vault.stats'](reset=reset)
+
+
+def _join_path(*parts):
+    return '/'.join(part.strip('/') for part in parts if part.strip('/'))
+
+
+def _parse_vault_time(timestamp):
+    """Parse a RFC 3339 timestamp from Vault into a naive UTC datetime.
+
+    Vault gives nanosecond precision, which is more than datetime can handle, so
+    the fraction is truncated to microseconds.
+    """
+    match = re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?'
+                     r'(Z|[+-]\d\d:\d\d)$', timestamp)
+    if not match:
+        raise ValueError('Unknown timestamp format: %s' % timestamp)
+    seconds, fraction, offset = match.groups()
+    parsed = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    if fraction:
+        parsed += timedelta(microseconds=int(fraction[:6].ljust(6, '0')))
+    if offset != 'Z':
+        sign = 1 if offset[0] == '+' else -1
+        parsed -= sign*timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+    return parsed
+
+
+def _walk_lease_tree(client, prefix, max_workers, stats):
+    """Walk the lease tree under prefix breadth-first.
+
+    Each level of the tree is listed concurrently, and the leases found on that
+    level are looked up with up to max_workers lookups in flight. Yields a
+    (directory, subdirectories, leases, failed) tuple for each directory as soon
+    as all of its leases have been looked up, where leases is the lease info of
+    the leases directly in it and failed is the number of leases that couldn't
+    be looked up.
+    """
+    run_concurrently = __utils__['mdl_vault.run_concurrently']
+    lock = threading.Lock()
+
+    def list_directory(directory):
+        response = client.list(_join_path('sys/leases/lookup', directory))
+        if not response:
+            return []
+        return response.get('data', {}).get('keys', [])
+
+    def lookup_lease(item):
+        lease_id = item[1]
+        with lock:
+            stats['in_flight'] += 1
+            stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            return client.write('sys/leases/lookup', lease_id=lease_id)
+        finally:
+            with lock:
+                stats['in_flight'] -= 1
+
+    level = [prefix.strip('/')]
+    while level:
+        subdirectories = {}
+        lease_ids = {}
+        for directory, keys, error in run_concurrently(list_directory, level,
+                max_workers=max_workers, ordered=False):
+            stats['directories'] += 1
+            if error is not None:
+                log.error('Failed to retrieve lease information for prefix %s: %s',
+                          directory, error)
+                continue
+            subdirectories[directory] = [_join_path(directory, key)
+                                         for key in keys if key.endswith('/')]
+            lease_ids[directory] = [_join_path(directory, key)
+                                    for key in keys if not key.endswith('/')]
+
+        remaining = {}
+        leases = {}
+        failed = {}
+        for directory, directory_lease_ids in lease_ids.items():
+            if directory_lease_ids:
+                remaining[directory] = len(directory_lease_ids)
+                leases[directory] = []
+                failed[directory] = 0
+            else:
+                yield directory, subdirectories[directory], [], 0
+
+        pending_lookups = ((directory, lease_id)
+                           for directory, directory_lease_ids in lease_ids.items()
+                           for lease_id in directory_lease_ids)
+        for (directory, lease_id), lease_info, error in run_concurrently(
+                lookup_lease, pending_lookups, max_workers=max_workers,
+                ordered=False):
+            stats['lookups'] += 1
+            if error is not None or not lease_info:
+                log.error('Failed to retrieve lease information for %s: %s',
+                          lease_id, error)
+                stats['failed_lookups'] += 1
+                failed[directory] += 1
+            else:
+                leases[directory].append(lease_info.get('data', {}))
+            remaining[directory] -= 1
+            if not remaining[directory]:
+                yield (directory, subdirectories[directory], leases.pop(directory),
+                    failed.pop(directory))
+
+        level = [subdirectory for directory in subdirectories
+                 for subdirectory in subdirectories[directory]]
+
+
+def _lease_expires_within(lease, time_horizon):
+    if not lease.get('expire_time'):
+        # Leases without an expire time never expire
+        return False
+    lease_lifetime = _parse_vault_time(lease['expire_time']) - datetime.utcnow()
+    return lease_lifetime < timedelta(seconds=time_horizon)
+
+
+def _new_scan_stats():
+    return {
+        'directories': 0,
+        'lookups': 0,
+        'failed_lookups': 0,
+        'expiring': 0,
+        'in_flight': 0,
+        'max_in_flight': 0,
+        'started': time.time(),
+    }
+
+
+def _finish_scan_stats(stats):
+    elapsed = time.time() - stats.pop('started')
+    stats.pop('in_flight')
+    stats['elapsed_seconds'] = round(elapsed, 3)
+    stats['leases_per_second'] = round(stats['lookups'] / elapsed, 1) if elapsed else 0
+    return stats
+
+
+def scan_leases_iter(prefix='', time_horizon=SEVEN_DAYS,
+                     max_workers=DEFAULT_MAX_WORKERS, stats=None):
+    """Scan all leases under prefix and yield the ones that are near expiration
+
+    This is the streaming version of scan_leases, intended to be used from other
+    modules. Leases are yielded as soon as they have been looked up.
+
+    :param prefix: The prefix path of leases that you want to scan
+    :param time_horizon: How far in advance you want to be alerted for expiring leases (seconds)
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :param stats: Optional dict that will be updated with progress counters
+    :returns: Generator of lease info for leases expiring soon
+    :rtype: generator
+
+    """
+    if stats is None:
+        stats = _new_scan_stats()
+    client = __utils__['mdl_vault.build_client']()
+    for _, _, leases, _ in _walk_lease_tree(client, prefix, max_workers, stats):
+        for lease in leases:
+            if _lease_expires_within(lease, time_horizon):
+                stats['expiring'] += 1
+                yield lease
+
+
+def scan_leases(prefix='', time_horizon=SEVEN_DAYS, send_events=True,
+                max_workers=DEFAULT_MAX_WORKERS, event_batch_size=100,
+                return_stats=False):
+    """Scan all leases and generate events for any that are near expiration
+
+    Events are sent in batches with the tag vault/lease/expiring, where the data
+    holds the list of expiring leases under the key `leases`.
 
     :param prefix: The prefix path of leases that you want to scan
     :param time_horizon: How far in advance you want to be alerted for expiring leases (seconds)
     :param send_events: Boolean to specify whether to fire events for matched leases
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :param event_batch_size: The maximum number of leases to include in one event
+    :param return_stats: Return a dict with both the leases and throughput stats
+        for the scan
     :returns: List of lease info for leases expiring soon
     :rtype: list
 
     """
-    client = __utils__['mdl_vault.build_client']()
-    try:
-        prefixes = client.list('sys/leases/lookup/{0}'.format(prefix))
-    except __utils__['mdl_vault.vault_error']() as e:
-        log.exception('Failed to retrieve lease information for prefix %s',
-                      prefix)
-        return []
-    if prefixes:
-        prefixes = prefixes.get('data', {}).get('keys', [])
-    else:
-        prefixes = []
+    stats = _new_scan_stats()
     expiring_leases = []
-    for node in prefixes:
-        if node.endswith('/'):
-            log.debug('Recursing into path %s for prefix %s', node, prefix)
-            expiring_leases.extend(scan_leases('{0}/{1}'.format(
-                prefix.strip('/'), node), time_horizon))
-        else:
-            log.debug('Retrieving lease information for %s/%s', prefix, node)
-            try:
-                lease_info = client.write(
-                    'sys/leases/lookup',
-                    lease_id='{0}/{1}'.format(prefix.strip('/'), node))
-            except __utils__['mdl_vault.vault_error']() as e:
-                log.exception('Failed to retrieve lease information for %s',
-                              '{0}/{1}'.format(prefix.strip('/'), node))
-                continue
-            lease_expiry = datetime.strptime(
-                lease_info.get('data', {}).get('expire_time')[:-4],
-                '%Y-%m-%dT%H:%M:%S.%f')
-            lease_lifetime = lease_expiry - datetime.utcnow()
-            if lease_lifetime < timedelta(seconds=time_horizon):
-                if send_events:
-                    __salt__['event.send'](
-                        'vault/lease/expiring/{0}/{1}'.format(prefix, node),
-                        data=lease_info.get('data', {}))
-                expiring_leases.append(lease_info.get('data', {}))
+    batch = []
+    for lease in scan_leases_iter(prefix, time_horizon, max_workers=max_workers,
+                                  stats=stats):
+        expiring_leases.append(lease)
+        if send_events:
+            batch.append(lease)
+            if len(batch) >= event_batch_size:
+                __salt__['event.send']('vault/lease/expiring', data={'leases': batch})
+                batch = []
+    if batch:
+        __salt__['event.send']('vault/lease/expiring', data={'leases': batch})
+
+    stats = _finish_scan_stats(stats)
+    log.info('Scanned %d leases under %r in %.1fs (%.1f leases/s), %d expiring',
+             stats['lookups'], prefix, stats['elapsed_seconds'],
+             stats['leases_per_second'], stats['expiring'])
+    if return_stats:
+        return {'leases': expiring_leases, 'stats': stats}
     return expiring_leases
 
 
-def clean_expired_leases(prefix='', time_horizon=0):
-    """Scan all leases and delete any that have an expiration beyond the specified time horizon
+def clean_expired_leases(prefix='', time_horizon=0, max_workers=DEFAULT_MAX_WORKERS,
+                         use_revoke_prefix=False):
+    """Scan all leases and revoke any that expire within the specified time horizon
+
+    Leases are revoked while the scan is still running. With use_revoke_prefix,
+    when every lease in a directory without subdirectories should be revoked the
+    whole directory is revoked with a single revoke-prefix call instead of lease
+    by lease. Note that this also revokes any lease created in the directory
+    after it was scanned. Rate limited requests are retried by the client.
 
     :param prefix: The prefix path of leases that you want to scan
-    :param time_horizon: How far in advance you want to be alerted for expiring leases (seconds)
-    :returns: List of lease info for leases that were deleted
-    :rtype: list
+    :param time_horizon: Revoke leases that expire within this many seconds
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :param use_revoke_prefix: Whether to revoke whole directories when possible
+    :returns: The lease info of the revoked leases under `revoked`, the
+        directories revoked with revoke-prefix under `revoked_prefixes`, and the
+        lease ids and errors of leases that couldn't be revoked under `failed`
+    :rtype: dict
 
     """
     client = __utils__['mdl_vault.build_client']()
-    expired_leases = scan_leases(prefix, time_horizon, send_events=False)
-    for index, lease in enumerate(expired_leases):
+    vault_error = __utils__['mdl_vault.vault_error']
+    stats = _new_scan_stats()
+
+    def revocations():
+        for directory, subdirectories, leases, failed in _walk_lease_tree(
+                client, prefix, max_workers, stats):
+            expiring = [lease for lease in leases
+                        if _lease_expires_within(lease, time_horizon)]
+            if (use_revoke_prefix and len(expiring) > 1 and not subdirectories and
+                    not failed and len(expiring) == len(leases)):
+                yield directory, expiring
+            else:
+                for lease in expiring:
+                    yield None, [lease]
+
+    def revoke(item):
+        directory, leases = item
+        if directory is not None:
+            try:
+                client.revoke_secret_prefix(directory)
+                return True, [(lease, None) for lease in leases]
+            except vault_error('Forbidden'):
+                log.info('Not allowed to revoke prefix %s, revoking leases '
+                         'individually', directory)
+        results = []
+        for lease in leases:
+            try:
+                client.write('sys/leases/revoke', lease_id=lease['id'])
+                results.append((lease, None))
+            except vault_error() as e:
+                results.append((lease, e))
+        return False, results
+
+    ret = {
+        'revoked': [],
+        'revoked_prefixes': [],
+        'failed': [],
+    }
+    for (directory, leases), result, error in __utils__['mdl_vault.run_concurrently'](
+            revoke, revocations(), max_workers=max_workers, ordered=False):
+        if error is not None:
+            results = [(lease, error) for lease in leases]
+        else:
+            revoked_prefix, results = result
+            if revoked_prefix:
+                ret['revoked_prefixes'].append(directory)
+        for lease, lease_error in results:
+            if lease_error is None:
+                ret['revoked'].append(lease)
+            else:
+                log.error('Failed to revoke lease %s: %s', lease['id'], lease_error)
+                ret['failed'].append({'id': lease['id'], 'error': str(lease_error)})
+
+    log.info('Revoked %d leases under %r, %d failed', len(ret['revoked']),
+             prefix, len(ret['failed']))
+    return ret
+
+
+@contextlib.contextmanager
+def _atomic_write(path):
+    """Write to a temporary file only readable by the owner and move it to path
+    when done, so readers never see a partially written file."""
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            yield tmp_file
+        os.rename(tmp_path, path)
+    except BaseException:
         try:
-            client.write('sys/leases/revoke', lease_id=lease['id'])
-        except __utils__['mdl_vault.vault_error']():
-            log.exception('Failed to revoke lease %s', lease['id'])
-            expired_leases.pop(index)
-            continue
-    return expired_leases
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _local_cache_crypticle():
+    # The local cache holds live credentials, so it's encrypted with a key derived
+    # from the private key of the minion (or master), which is only readable by
+    # the user salt is running as anyway
+    import salt.crypt
+    key_name = 'master.pem' if __opts__.get('__role') == 'master' else 'minion.pem'
+    with open(os.path.join(__opts__['pki_dir'], key_name), 'rb') as key_file:
+        key = hashlib.sha512(key_file.read()).digest()
+    key_size = 192
+    key = key[:key_size//8 + salt.crypt.Crypticle.SIG_SIZE]
+    return salt.crypt.Crypticle(__opts__, base64.b64encode(key), key_size=key_size)
+
+
+def _local_cache_dir():
+    return os.path.join(__opts__['cachedir'], 'mdl_vault')
+
+
+def _local_cache_file(cache_path):
+    return os.path.join(_local_cache_dir(),
+                        hashlib.sha256(cache_path.encode('utf-8')).hexdigest())
+
+
+def _local_cache_expiry(vault_data):
+    """Get the timestamp after which locally cached data should no longer be used.
+
+    This is when the lease would be considered too close to expiry by
+    check_cached_lease. Returns None when the data shouldn't be cached locally.
+
+    """
+    lease_duration = vault_data.get('lease_duration')
+    if not lease_duration or 'created' not in vault_data:
+        return None
+    renewal_threshold = __opts__.get('vault.lease_renewal_threshold',
+                                    {'days': 7})
+    created = datetime.strptime(vault_data['created'][:19], '%Y-%m-%dT%H:%M:%S')
+    expires = (created + timedelta(seconds=lease_duration) -
+               timedelta(**renewal_threshold))
+    expires = time.time() + (expires - datetime.utcnow()).total_seconds()
+    if expires <= time.time():
+        return None
+    return expires
+
+
+def _local_cache_get(cache_path):
+    if not __opts__.get('vault.local_cache', True):
+        return None
+
+    with _local_cache_lock:
+        entry = _local_cache.get(cache_path)
+    if entry is None:
+        try:
+            with open(_local_cache_file(cache_path), 'rb') as cache_file:
+                entry = _local_cache_crypticle().loads(cache_file.read())
+        except (IOError, OSError):
+            return None
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug('Ignoring unreadable local cache for %s: %s', cache_path, e)
+            return None
+        if entry.get('path') != cache_path:
+            return None
+        with _local_cache_lock:
+            _local_cache[cache_path] = entry
+
+    if entry['expires'] <= time.time():
+        _local_cache_delete(cache_path)
+        return None
+    return entry['data']
+
+
+def _local_cache_set(cache_path, vault_data):
+    if not __opts__.get('vault.local_cache', True):
+        return
+    expires = _local_cache_expiry(vault_data)
+    if expires is None:
+        return
+
+    entry = {'path': cache_path, 'expires': expires, 'data': vault_data}
+    with _local_cache_lock:
+        _local_cache[cache_path] = entry
+    try:
+        if not os.path.isdir(_local_cache_dir()):
+            os.makedirs(_local_cache_dir(), 0o700)
+        with _atomic_write(_local_cache_file(cache_path)) as cache_file:
+            cache_file.write(_local_cache_crypticle().dumps(entry))
+    except Exception as e:  # pylint: disable=broad-except
+        log.debug('Failed to write local cache for %s: %s', cache_path, e)
+
+
+def _local_cache_delete(cache_path):
+    with _local_cache_lock:
+        _local_cache.pop(cache_path, None)
+    try:
+        os.remove(_local_cache_file(cache_path))
+    except (IOError, OSError):
+        pass
+
+
+def purge_local_cache():
+    """Remove everything from the local cache in front of the cache in Vault.
+
+    :returns: How many entries were removed from disk
+    :rtype: int
+
+    """
+    with _local_cache_lock:
+        _local_cache.clear()
+    removed = 0
+    if os.path.isdir(_local_cache_dir()):
+        for name in os.listdir(_local_cache_dir()):
+            os.remove(os.path.join(_local_cache_dir(), name))
+            removed += 1
+    return removed
+
+
+def _cache_path(path, cache_prefix):
+    cache_base_path = __opts__.get('vault.cache_base_path',
+                                   'secret/pillar_cache')
+    return '/'.join((cache_base_path, cache_prefix, path))
 
 
 def check_cached_lease(path, cache_prefix='', **kwargs):
@@ -169,9 +559,7 @@ def check_cached_lease(path, cache_prefix='', **kwargs):
 
     """
     lease_valid = None
-    cache_base_path = __opts__.get('vault.cache_base_path',
-                                   'secret/pillar_cache')
-    cache_path = '/'.join((cache_base_path, cache_prefix, path))
+    cache_path = _cache_path(path, cache_prefix)
     renewal_threshold = __opts__.get('vault.lease_renewal_threshold',
                                     {'days': 7})
     vault_client = __utils__['mdl_vault.build_client']()
@@ -188,6 +576,7 @@ def check_cached_lease(path, cache_prefix='', **kwargs):
         else:
             lease_valid = False
             vault_client.delete(cache_path)
+            _local_cache_delete(cache_path)
             vault_data = None
 
     if not vault_data or not lease_valid:
@@ -200,25 +589,42 @@ def check_cached_lease(path, cache_prefix='', **kwargs):
     return cache_path, vault_client, vault_data
 
 
+def _store_cached_lease(vault_client, cache_path, vault_data, source):
+    """Store newly generated data in the cache in Vault, with where it came from
+    so renew_cached_leases can generate it again."""
+    vault_data['created'] = datetime.utcnow().isoformat()
+    vault_data['source'] = source
+    vault_client.write(cache_path, value=vault_data)
+    return vault_client.read(cache_path)['data']['value']
+
+
 def cached_read(path, cache_prefix='', **kwargs):
     """Generate new secret through vault read function and copy it to the vault
     cache path.
 
+    Results are also cached locally on the minion until the lease gets within
+    `vault.lease_renewal_threshold` of expiring, so repeated calls don't need to
+    talk to Vault at all. Set `vault.local_cache` to False to disable this.
+
     :param path: path to the full vault cache path
     :param cache_prefix: usually the minion_id
     :param **kwargs: other data that the function might require
     :rtype: list, dict
 
     """
+    vault_data = _local_cache_get(_cache_path(path, cache_prefix))
+    if vault_data:
+        return vault_data
+
     cache_path, vault_client, vault_data = check_cached_lease(path,
                                                               cache_prefix=cache_prefix,
                                                               **kwargs)
     if not vault_data:
-        vault_data = vault_client.read(path)
-        vault_data['created'] = datetime.utcnow().isoformat()
-        vault_client.write(cache_path, value=vault_data)
-        vault_data = vault_client.read(cache_path)['data']['value']
+        vault_data = _store_cached_lease(vault_client, cache_path,
+                                         vault_client.read(path),
+                                         {'method': 'read', 'path': path})
 
+    _local_cache_set(cache_path, vault_data)
     return vault_data
 
 
@@ -226,73 +632,334 @@ def cached_write(path, cache_prefix='', **kwargs):
     """Generate new secret through vault write function and copy it to the vault
     cache path.
 
+    Results are also cached locally on the minion until the lease gets within
+    `vault.lease_renewal_threshold` of expiring, so repeated calls don't need to
+    talk to Vault at all. Set `vault.local_cache` to False to disable this.
+
     :param path: path to the full vault cache path
     :param cache_prefix: usually the minion_id
     :param **kwargs: other data that the function might require
     :rtype: list, dict
 
     """
+    vault_data = _local_cache_get(_cache_path(path, cache_prefix))
+    if vault_data:
+        return vault_data
+
     cache_path, vault_client, vault_data = check_cached_lease(path,
                                                               cache_prefix=cache_prefix,
                                                               **kwargs)
     if not vault_data:
-        vault_data = vault_client.write(path, **kwargs)
-        vault_data['created'] = datetime.utcnow().isoformat()
-        vault_client.write(cache_path, value=vault_data)
-        vault_data = vault_client.read(cache_path)['data']['value']
+        vault_data = _store_cached_lease(vault_client, cache_path,
+                                         vault_client.write(path, **kwargs),
+                                         {'method': 'write', 'path': path,
+                                          'kwargs': kwargs})
 
+    _local_cache_set(cache_path, vault_data)
     return vault_data
 
 
-def list_cache_paths(prefix=None, cache_filter=''):
+def _glob_segments_match(pattern, segments, partial=False):
+    """Match path segments against glob pattern segments, where ** matches any
+    number of segments. With partial set, check whether any path below segments
+    could match instead.
+    """
+    if pattern and pattern[0] == '**':
+        return (_glob_segments_match(pattern[1:], segments, partial) or
+                bool(segments) and _glob_segments_match(pattern, segments[1:], partial))
+    if not segments:
+        return partial or not pattern
+    if not pattern:
+        return False
+    return (fnmatch.fnmatchcase(segments[0], pattern[0]) and
+            _glob_segments_match(pattern[1:], segments[1:], partial))
+
+
+def _cache_filter_matchers(cache_filter):
+    """Get functions to check whether a directory could contain matching paths,
+    and whether a path matches cache_filter.
+
+    Filters containing glob characters are matched against the whole path one
+    segment at a time, which allows skipping directories that can't contain
+    matches. Other filters match any path containing them.
+    """
+    if not any(char in cache_filter for char in '*?['):
+        return (lambda directory: True), (lambda path: cache_filter in path)
+
+    pattern = cache_filter.strip('/').split('/')
+
+    def could_contain(directory):
+        return _glob_segments_match(pattern, directory.strip('/').split('/'),
+                                    partial=True)
+
+    def matches(path):
+        return _glob_segments_match(pattern, path.strip('/').split('/'))
+
+    return could_contain, matches
+
+
+def _walk_cache_tree(client, prefix, cache_filter, max_workers):
+    """Yield the paths under prefix matching cache_filter.
+
+    The tree is walked breadth-first with each level listed concurrently, and
+    paths are yielded as soon as the directory containing them is listed.
+    """
+    run_concurrently = __utils__['mdl_vault.run_concurrently']
+    could_contain, matches = _cache_filter_matchers(cache_filter)
+
+    def list_directory(directory):
+        response = client.list(directory)
+        if not response:
+            return []
+        return response.get('data', {}).get('keys', [])
+
+    level = [prefix.strip('/')]
+    while level:
+        next_level = []
+        for directory, keys, error in run_concurrently(list_directory, level,
+                max_workers=max_workers, ordered=False):
+            if error is not None:
+                log.error('Failed to list cache path %s: %s', directory, error)
+                continue
+            for key in keys:
+                path = _join_path(directory, key)
+                if not key.endswith('/'):
+                    if matches(path):
+                        yield path
+                elif could_contain(path):
+                    log.debug('Recursing into path %s for prefix %s', key, directory)
+                    next_level.append(path)
+        level = next_level
+
+
+def list_cache_paths(prefix=None, cache_filter='', max_workers=DEFAULT_MAX_WORKERS):
+    """List the paths in the cache in Vault.
+
+    :param prefix: The path to list the cache under, defaults to
+        `vault.cache_base_path`
+    :param cache_filter: Only list paths containing this string, or matching it
+        when it's a glob pattern like `secret/pillar_cache/web*/**`
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :rtype: list
+
+    """
     client = __utils__['mdl_vault.build_client']()
     if not prefix:
         prefix = __opts__.get('vault.cache_base_path',
                               'secret/pillar_cache')
 
-    caches = client.list(
-        prefix
-    ).get('data', {}).get('keys', [])
-    cache_paths = []
-    for node in caches:
-        if node.endswith('/'):
-            log.debug('Recursing into path %s for prefix %s', node, prefix)
-            cache_paths.extend(list_cache_paths(prefix='{0}/{1}'.format(
-                prefix.strip('/'), node), cache_filter=cache_filter))
-        else:
-            cache_paths.append('{0}/{1}'.format(prefix.strip('/'), node))
-
-    cache_paths = [path for path in cache_paths if cache_filter in path]
-    return cache_paths
+    return sorted(_walk_cache_tree(client, prefix, cache_filter, max_workers))
 
 
-def list_cached_data(prefix=None, cache_filter='', attribute_path=''):
+def list_cached_data(prefix=None, cache_filter='', attribute_path='',
+                     max_workers=DEFAULT_MAX_WORKERS):
     client = __utils__['mdl_vault.build_client']()
-    cache_paths = list_cache_paths(prefix, cache_filter)
+    if not prefix:
+        prefix = __opts__.get('vault.cache_base_path',
+                              'secret/pillar_cache')
+
+    # Cached data is read while the tree is still being listed
     cached_data = []
-    for path in cache_paths:
-        cache_data = client.read(path)
+    for path, cache_data, error in __utils__['mdl_vault.run_concurrently'](
+            client.read, _walk_cache_tree(client, prefix, cache_filter, max_workers),
+            max_workers=max_workers, ordered=False):
+        if error is not None:
+            raise error
         if attribute_path:
             cache_data = __utils__['data.traverse_dict'](cache_data,
                                                          attribute_path)
         cached_data.append((path, cache_data))
-    return cached_data
+    return sorted(cached_data, key=lambda item: item[0])
 
 
-def purge_cache_data(cache_filter):
+def purge_cache_data(cache_filter, max_workers=DEFAULT_MAX_WORKERS):
     """Scan cached leases and delete any that match the given prefix
 
-    :param prefix: The prefix path of cached leases that you want to purge
-    :returns: List of lease ids that were deleted
+    Paths are deleted concurrently while the cache is still being listed.
+
+    :param cache_filter: Delete cached leases with paths containing this string,
+        or matching it when it's a glob pattern
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :returns: List of cache paths that were deleted
     :rtype: list
 
     """
     client = __utils__['mdl_vault.build_client']()
-    cached_leases = list_cache_paths(cache_filter=cache_filter)
-    for path in cached_leases:
-        client.delete(path)
+    prefix = __opts__.get('vault.cache_base_path', 'secret/pillar_cache')
+    cached_leases = []
+    for path, _, error in __utils__['mdl_vault.run_concurrently'](
+            client.delete, _walk_cache_tree(client, prefix, cache_filter, max_workers),
+            max_workers=max_workers, ordered=False):
+        if error is not None:
+            log.error('Failed to delete cached lease %s: %s', path, error)
+            continue
+        _local_cache_delete(path)
+        cached_leases.append(path)
+
+    return sorted(cached_leases)
+
+
+def transit_encrypt_file(name, source, destination, context=None,
+                         mount_point='transit', chunk_size=None):
+    """Encrypt a file with a data key from a transit key, without reading it all
+    into memory
+
+    Vault is only asked for a data key, which is stored in the header of the
+    output wrapped by the transit key. The file itself is encrypted locally one
+    chunk at a time, so this works for files of any size with a single call to
+    Vault, unlike transit_encrypt_data.
+
+    :param name: The transit key to generate the data key with
+    :param source: Path of the file to encrypt
+    :param destination: Path to write the encrypted file to
+    :param context: Base64 encoded context for keys with key derivation
+    :param mount_point: Where the transit backend is mounted
+    :param chunk_size: How many bytes to encrypt at a time, 1 MiB by default
+    :returns: How many bytes were encrypted
+    :rtype: int
+
+    """
+    client = __utils__['mdl_vault.build_client']()
+    kwargs = {}
+    if chunk_size:
+        kwargs['chunk_size'] = int(chunk_size)
+    with open(source, 'rb') as source_file, \
+            _atomic_write(destination) as destination_file:
+        return __utils__['mdl_vault.transit_encrypt_stream'](
+            client, name, source_file, destination_file, context=context,
+            mount_point=mount_point, **kwargs)
+
+
+def transit_decrypt_file(source, destination):
+    """Decrypt a file encrypted with transit_encrypt_file
 
-    return cached_leases
+    The transit key and data key are read from the header of the file, so this
+    only needs a single call to Vault to unwrap the data key.
+
+    :param source: Path of the encrypted file
+    :param destination: Path to write the decrypted file to
+    :returns: How many bytes were decrypted
+    :rtype: int
+
+    """
+    client = __utils__['mdl_vault.build_client']()
+    with open(source, 'rb') as source_file, \
+            _atomic_write(destination) as destination_file:
+        return __utils__['mdl_vault.transit_decrypt_stream'](
+            client, source_file, destination_file)
+
+
+def renew_cached_leases(prefix=None, renew_ahead=ONE_HOUR,
+                        max_workers=DEFAULT_MAX_WORKERS, event_batch_size=100):
+    """Renew or regenerate cached leases before check_cached_lease would find
+    them too close to expiry
+
+    This keeps regenerating credentials off the critical path of pillar renders.
+    Run it regularly, with the mdl_vault_renewal engine or as a scheduled job,
+    with renew_ahead longer than the time between runs:
+
+    .. code-block:: yaml
+
+        schedule:
+          vault-lease-renewal:
+            function: mdl_vault.renew_cached_leases
+            minutes: 30
+
+    Leases under `vault.cache_base_path` that expire within
+    `vault.lease_renewal_threshold` plus renew_ahead are renewed when they're
+    renewable and can be renewed for long enough. Otherwise the secret is
+    generated again and replaces the cached one, the old lease is left to expire
+    since it might still be in use. Secrets cached before their source was
+    recorded can't be regenerated and are skipped.
+
+    Events are sent in batches with the tags vault/cache/renewed and
+    vault/cache/regenerated, where the data holds the list of cache paths under
+    the key `paths`.
+
+    :param prefix: The path to renew the cache under, defaults to
+        `vault.cache_base_path`
+    :param renew_ahead: How many seconds before the renewal threshold to renew
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :param event_batch_size: The maximum number of paths to include in one event
+    :returns: The cache paths that were renewed under `renewed`, regenerated
+        under `regenerated` and skipped under `skipped`, and the paths and
+        errors of those that failed under `failed`
+    :rtype: dict
+
+    """
+    client = __utils__['mdl_vault.build_client']()
+    if not prefix:
+        prefix = __opts__.get('vault.cache_base_path', 'secret/pillar_cache')
+    renewal_threshold = __opts__.get('vault.lease_renewal_threshold', {'days': 7})
+    horizon = timedelta(**renewal_threshold).total_seconds() + renew_ahead
+
+    def renew(cache_path):
+        cached = client.read(cache_path)
+        if not cached or not cached['data']['value'].get('lease_id'):
+            return None
+        vault_data = cached['data']['value']
+        lease = client.get_lease(vault_data['lease_id'])
+        if lease and lease['data']['ttl'] > horizon:
+            return None
+
+        if lease and lease['data'].get('renewable'):
+            renewed = client.renew_secret(vault_data['lease_id'],
+                                          increment=vault_data.get('lease_duration'))
+            if renewed.get('lease_duration', 0) > horizon:
+                vault_data['lease_duration'] = renewed['lease_duration']
+                vault_data['created'] = datetime.utcnow().isoformat()
+                client.write(cache_path, value=vault_data)
+                _local_cache_delete(cache_path)
+                return 'renewed'
+
+        source = vault_data.get('source')
+        if not source:
+            return 'skipped'
+        if source['method'] == 'read':
+            new_data = client.read(source['path'])
+        else:
+            new_data = client.write(source['path'], **source.get('kwargs', {}))
+        _store_cached_lease(client, cache_path, new_data, source)
+        _local_cache_delete(cache_path)
+        return 'regenerated'
+
+    ret = {
+        'renewed': [],
+        'regenerated': [],
+        'skipped': [],
+        'failed': [],
+    }
+    batches = {'renewed': [], 'regenerated': []}
+
+    def send_batch(outcome):
+        __salt__['event.send']('vault/cache/{0}'.format(outcome),
+                               data={'paths': batches[outcome]})
+        batches[outcome] = []
+
+    for cache_path, outcome, error in __utils__['mdl_vault.run_concurrently'](
+            renew, _walk_cache_tree(client, prefix, '', max_workers),
+            max_workers=max_workers, ordered=False):
+        if error is not None:
+            log.error('Failed to renew cached lease %s: %s', cache_path, error)
+            ret['failed'].append({'path': cache_path, 'error': str(error)})
+            continue
+        if outcome is None:
+            continue
+        ret[outcome].append(cache_path)
+        if outcome in batches:
+            batches[outcome].append(cache_path)
+            if len(batches[outcome]) >= event_batch_size:
+                send_batch(outcome)
+    for outcome in batches:
+        if batches[outcome]:
+            send_batch(outcome)
+
+    for outcome in ('renewed', 'regenerated', 'skipped'):
+        ret[outcome].sort()
+    ret['failed'].sort(key=lambda failure: failure['path'])
+    log.info('Renewed %d and regenerated %d cached leases under %r, %d failed',
+             len(ret['renewed']), len(ret['regenerated']), prefix, len(ret['failed']))
+    return ret
 
 
 def _register_functions():
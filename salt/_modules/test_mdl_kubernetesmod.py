@@ -46,6 +46,9 @@ class KubernetesTestCase(TestCase):
     Test cases for mdl_kubernetes
     """
 
+    def tearDown(self):
+        kubernetes._client_cache.clear()
+
     def test_create_secret(self):
         with mock_kubernetes_library() as mock_kubernetes_lib:
             with patch.dict(
@@ -206,31 +209,68 @@ class KubernetesTestCase(TestCase):
         :return:
         """
         with mock_kubernetes_library() as mock_kubernetes_lib:
-            with patch(
-                "mdl_kubernetesmod.show_deployment", Mock(return_value=None)
+            with patch.dict(
+                kubernetes.__salt__,
+                {"config.option": Mock(side_effect=self.settings)},
             ):
-                with patch.dict(
-                    kubernetes.__salt__,
-                    {"config.option": Mock(side_effect=self.settings)},
-                ):
-                    mock_kubernetes_lib.client.V1DeleteOptions = Mock(return_value="")
-                    mock_kubernetes_lib.client.ExtensionsV1beta1Api.return_value = Mock(
-                        **{
-                            "delete_namespaced_deployment.return_value.to_dict.return_value": {
-                                "code": ""
-                            }
-                        }
-                    )
-                    self.assertEqual(
-                        kubernetes.delete_deployment("test"), {"code": 200}
-                    )
-                    # pylint: disable=E1120
-                    self.assertTrue(
-                        kubernetes.kubernetes.client.ExtensionsV1beta1Api()
-                        .delete_namespaced_deployment()
-                        .to_dict.called
-                    )
-                    # pylint: enable=E1120
+                mock_kubernetes_lib.client.V1DeleteOptions = Mock(return_value="")
+                mock_kubernetes_lib.client.ExtensionsV1beta1Api.return_value = Mock(
+                    **{
+                        "delete_namespaced_deployment.return_value.to_dict.return_value": {
+                            "code": ""
+                        },
+                        "list_namespaced_deployment.return_value.items": [],
+                    }
+                )
+                self.assertEqual(
+                    kubernetes.delete_deployment("test"), {"code": 200}
+                )
+                # pylint: disable=E1120
+                api = kubernetes.kubernetes.client.ExtensionsV1beta1Api()
+                self.assertTrue(api.delete_namespaced_deployment().to_dict.called)
+                api.list_namespaced_deployment.assert_called_once_with(
+                    field_selector="metadata.name=test", namespace="default"
+                )
+                mock_kubernetes_lib.watch.Watch.assert_not_called()
+                # pylint: enable=E1120
+
+    def test_wait_for_deletion_watches_object(self):
+        """
+        Tests that deletion waits watch the object from the listed
+        resourceVersion, and list again when it has expired
+        :return:
+        """
+        with mock_kubernetes_library() as mock_kubernetes_lib:
+            listing = Mock(items=[Mock()])
+            listing.metadata.resource_version = "42"
+            list_func = Mock(return_value=listing)
+            mock_kubernetes_lib.watch.Watch.return_value.stream.side_effect = [
+                iter([{"type": "ERROR", "object": {"code": 410}}]),
+                iter([{"type": "MODIFIED"}, {"type": "DELETED"}]),
+            ]
+
+            self.assertTrue(
+                kubernetes._wait_for_deletion(list_func, "test", 30, namespace="default")
+            )
+
+            self.assertEqual(list_func.call_count, 2)
+            stream_kwargs = mock_kubernetes_lib.watch.Watch().stream.call_args[1]
+            self.assertEqual(stream_kwargs["field_selector"], "metadata.name=test")
+            self.assertEqual(stream_kwargs["resource_version"], "42")
+            self.assertEqual(stream_kwargs["namespace"], "default")
+            self.assertLessEqual(stream_kwargs["timeout_seconds"], 30)
+
+    def test_wait_for_deletion_times_out(self):
+        """
+        Tests that deletion waits give up after the timeout
+        :return:
+        """
+        with mock_kubernetes_library() as mock_kubernetes_lib:
+            list_func = Mock(return_value=Mock(items=[Mock()]))
+            mock_kubernetes_lib.watch.Watch.return_value.stream.return_value = iter([])
+
+            self.assertFalse(kubernetes._wait_for_deletion(list_func, "test", 0))
+            mock_kubernetes_lib.watch.Watch.assert_not_called()
 
     def test_create_deployments(self):
         """
@@ -297,7 +337,16 @@ class KubernetesTestCase(TestCase):
             with patch.dict(
                 kubernetes.__salt__, {"config.option": Mock(side_effect=self.settings)}
             ):
-                mock_kubernetes_lib.config.load_kube_config = Mock()
+                loaded = {}
+
+                def new_client_from_config(config_file, context, persist_config):
+                    loaded["config_file"] = config_file
+                    with salt.utils.files.fopen(config_file, "r") as kcfg:
+                        loaded["data"] = kcfg.read()
+
+                mock_kubernetes_lib.config.new_client_from_config = Mock(
+                    side_effect=new_client_from_config
+                )
                 config = kubernetes._setup_conn(
                     kubeconfig_data="MTIzNDU2Nzg5MAo=", context="newcontext"
                 )
@@ -309,13 +358,58 @@ class KubernetesTestCase(TestCase):
                         os.environ.get("TMPDIR", "/tmp"), "salt-kubeconfig-"
                     )
                 self.assertTrue(
-                    config["kubeconfig"].lower().startswith(check_path.lower())
+                    loaded["config_file"].lower().startswith(check_path.lower())
                 )
-                self.assertTrue(os.path.exists(config["kubeconfig"]))
-                with salt.utils.files.fopen(config["kubeconfig"], "r") as kcfg:
-                    self.assertEqual("1234567890\n", kcfg.read())
+                self.assertEqual("1234567890\n", loaded["data"])
+                # The kubeconfig data is only kept in memory
+                self.assertFalse(os.path.exists(loaded["config_file"]))
+                self.assertIsNone(config["kubeconfig"])
                 kubernetes._cleanup(**config)
 
+    def test_setup_conn_is_cached(self):
+        """
+        Test that the client is only created once per config
+        :return:
+        """
+        with mock_kubernetes_library() as mock_kubernetes_lib:
+            with patch.dict(
+                kubernetes.__salt__, {"config.option": Mock(side_effect=self.settings)}
+            ):
+                first = kubernetes._setup_conn()
+                kubernetes._cleanup(**first)
+                self.assertIs(first, kubernetes._setup_conn())
+
+                data_config = kubernetes._setup_conn(kubeconfig_data="MTIzNDU2Nzg5MAo=")
+                kubernetes._cleanup(**data_config)
+                self.assertIs(
+                    data_config,
+                    kubernetes._setup_conn(kubeconfig_data="MTIzNDU2Nzg5MAo="),
+                )
+                self.assertIsNot(
+                    first, kubernetes._setup_conn(context="othercontext")
+                )
+
+                self.assertEqual(
+                    mock_kubernetes_lib.config.new_client_from_config.call_count, 3
+                )
+
+    def test_setup_conn_reloads_changed_kubeconfig(self):
+        """
+        Test that the client is recreated when the kubeconfig changes, replacing
+        the cached one
+        :return:
+        """
+        with mock_kubernetes_library():
+            with patch.dict(
+                kubernetes.__salt__, {"config.option": Mock(side_effect=self.settings)}
+            ), patch("mdl_kubernetesmod.os.path.getmtime", Mock(side_effect=[1, 1, 2])):
+                first = kubernetes._setup_conn()
+                self.assertIs(first, kubernetes._setup_conn())
+                rotated = kubernetes._setup_conn()
+
+        self.assertIsNot(first, rotated)
+        self.assertEqual(len(kubernetes._client_cache), 1)
+
     def test_node_labels(self):
         """
         Test kubernetes.node_labels
@@ -335,6 +429,254 @@ class KubernetesTestCase(TestCase):
                 {"kubernetes.io/hostname": "minikube", "kubernetes.io/os": "linux"},
             )
 
+    def test_node_reads_single_node(self):
+        """
+        Test that kubernetes.node fetches only the requested node
+        :return:
+        """
+        with mock_kubernetes_library() as mock_kubernetes_lib:
+            with patch.dict(
+                kubernetes.__salt__, {"config.option": Mock(side_effect=self.settings)}
+            ):
+                mock_kubernetes_lib.client.CoreV1Api.return_value = Mock(
+                    **{
+                        "read_node.return_value.to_dict.return_value": {
+                            "metadata": {"name": "minikube"}
+                        }
+                    }
+                )
+                self.assertEqual(
+                    kubernetes.node("minikube"), {"metadata": {"name": "minikube"}}
+                )
+                api = mock_kubernetes_lib.client.CoreV1Api()
+                api.read_node.assert_called_once_with("minikube")
+                api.list_node.assert_not_called()
+
+    def test_node_labels_cached(self):
+        """
+        Test that node_labels with use_cache only fetches each node once per
+        run, and sees the labels changed through the module
+        :return:
+        """
+        with patch("mdl_kubernetesmod.node") as mock_node, patch.object(
+            kubernetes, "__context__", {}, create=True
+        ):
+            mock_node.return_value = {"metadata": {"labels": {"foo": "bar"}}}
+
+            labels = kubernetes.node_labels("minikube", use_cache=True)
+            labels["mutated"] = "yes"
+            self.assertEqual(
+                kubernetes.node_labels("minikube", use_cache=True), {"foo": "bar"}
+            )
+            mock_node.assert_called_once_with("minikube")
+
+            kubernetes._update_node_cache(
+                "minikube",
+                Mock(**{"to_dict.return_value": {"metadata": {"labels": {}}}}),
+                {},
+            )
+            self.assertEqual(kubernetes.node_labels("minikube", use_cache=True), {})
+            self.assertEqual(kubernetes.node_labels("minikube"), {"foo": "bar"})
+            self.assertEqual(mock_node.call_count, 2)
+
+    def test_node_labels_cache_is_per_job(self):
+        """
+        Test that the node cache isn't reused by the next job when __context__
+        outlives the job
+        :return:
+        """
+        with patch("mdl_kubernetesmod.node") as mock_node, patch.object(
+            kubernetes, "__context__", {}, create=True
+        ):
+            mock_node.return_value = {"metadata": {"labels": {"foo": "bar"}}}
+
+            kubernetes.node_labels("minikube", use_cache=True, __pub_jid="1")
+            kubernetes.node_labels("minikube", use_cache=True, __pub_jid="1")
+            self.assertEqual(mock_node.call_count, 1)
+
+            mock_node.return_value = {"metadata": {"labels": {"foo": "baz"}}}
+            self.assertEqual(
+                kubernetes.node_labels("minikube", use_cache=True, __pub_jid="2"),
+                {"foo": "baz"},
+            )
+            self.assertEqual(mock_node.call_count, 2)
+
+    def test_node_labels_managed_single_patch(self):
+        """
+        Test that node_labels_managed sends one patch per node with all the
+        label changes, and none for nodes already in the desired state
+        :return:
+        """
+        nodes = {
+            "node-1": {"metadata": {"labels": {
+                "keep": "1", "role": "db", "old.example.com/a": "x",
+                "old.example.com/b": "y", "gone": "z",
+            }}},
+            "node-2": {"metadata": {"labels": {
+                "keep": "1", "role": "web", "old.example.com/b": "y",
+            }}},
+        }
+        with mock_kubernetes_library() as mock_kubernetes_lib, patch(
+            "mdl_kubernetesmod.node", Mock(side_effect=lambda name, **kwargs: nodes.get(name))
+        ), patch.object(kubernetes, "__context__", {}, create=True):
+            with patch.dict(
+                kubernetes.__salt__, {"config.option": Mock(side_effect=self.settings)}
+            ):
+                ret = kubernetes.node_labels_managed(
+                    ["node-1", "node-2", "node-3"],
+                    labels={"role": "web", "old.example.com/b": "y"},
+                    absent=["gone"],
+                    folders_absent=["old.example.com/"],
+                )
+
+                self.assertEqual(ret, {
+                    "node-1": {
+                        "role": {"old": "db", "new": "web"},
+                        "old.example.com/a": {"old": "x", "new": None},
+                        "gone": {"old": "z", "new": None},
+                    },
+                    "node-2": {},
+                    "node-3": None,
+                })
+                mock_kubernetes_lib.client.CoreV1Api().patch_node.assert_called_once_with(
+                    "node-1", {"metadata": {"labels": {
+                        "role": "web", "old.example.com/a": None, "gone": None,
+                    }}},
+                )
+
+    def test_object_patch(self):
+        """
+        Test that only the fields that differ from the live object end up in
+        the patch, ignoring defaulted fields
+        :return:
+        """
+        live = {
+            "metadata": {"name": "web", "uid": "1234", "labels": {"app": "web"}},
+            "spec": {
+                "replicas": 2,
+                "template": {"spec": {"containers": [
+                    {"name": "web", "image": "nginx:1", "imagePullPolicy": "IfNotPresent"},
+                    {"name": "sidecar", "image": "proxy:1"},
+                ]}},
+            },
+        }
+        desired = {
+            "metadata": {"name": "web", "labels": {"app": "web"}},
+            "spec": {
+                "replicas": 2,
+                "template": {"spec": {"containers": [{"name": "web", "image": "nginx:1"}]}},
+            },
+        }
+        changes = {}
+        self.assertEqual(kubernetes._object_patch(desired["metadata"], live["metadata"], changes), None)
+        self.assertEqual(changes, {})
+
+        desired["spec"]["replicas"] = 3
+        patch = kubernetes._object_patch(desired, live, changes)
+
+        self.assertEqual(patch, {"spec": {
+            "replicas": 3,
+            "template": {"spec": {"containers": [
+                {"name": "sidecar", "$patch": "delete"},
+            ]}},
+        }})
+        self.assertEqual(
+            sorted(changes), ["spec.replicas", "spec.template.spec.containers[sidecar]"]
+        )
+        self.assertEqual(changes["spec.replicas"], {"old": 2, "new": 3})
+
+    def test_object_patch_removes_list_items_by_merge_key(self):
+        """
+        Test that items removed from lists merged by another key than the name
+        get deleted by that key, so that the next run has nothing to change
+        :return:
+        """
+        live_service = {"spec": {"ports": [
+            {"name": "http", "port": 80, "protocol": "TCP", "targetPort": 8080},
+            {"name": "https", "port": 443, "protocol": "TCP", "targetPort": 8443},
+        ]}}
+        desired_service = {"spec": {"ports": [
+            {"name": "http", "port": 80, "targetPort": 8080},
+        ]}}
+        changes = {}
+        self.assertEqual(
+            kubernetes._object_patch(desired_service, live_service, changes),
+            {"spec": {"ports": [{"port": 443, "$patch": "delete"}]}},
+        )
+        self.assertEqual(list(changes), ["spec.ports[443]"])
+        live_service["spec"]["ports"].pop()
+        self.assertEqual(kubernetes._object_patch(desired_service, live_service, {}), None)
+
+        live_pod = {"spec": {"containers": [{
+            "name": "web",
+            "image": "nginx:1",
+            "ports": [{"containerPort": 80, "protocol": "TCP"}],
+            "volumeMounts": [
+                {"name": "config", "mountPath": "/etc/nginx"},
+                {"name": "config", "mountPath": "/etc/old", "subPath": "old"},
+            ],
+        }]}}
+        desired_pod = {"spec": {"containers": [{
+            "name": "web",
+            "image": "nginx:1",
+            "ports": [{"containerPort": 8080}],
+            "volumeMounts": [{"name": "config", "mountPath": "/etc/nginx"}],
+        }]}}
+        changes = {}
+        self.assertEqual(
+            kubernetes._object_patch(desired_pod, live_pod, changes),
+            {"spec": {"containers": [{
+                "name": "web",
+                "ports": [
+                    {"containerPort": 8080},
+                    {"containerPort": 80, "$patch": "delete"},
+                ],
+                "volumeMounts": [{"mountPath": "/etc/old", "$patch": "delete"}],
+            }]}},
+        )
+        self.assertEqual(sorted(changes), [
+            "spec.containers[web].ports[8080]",
+            "spec.containers[web].ports[80]",
+            "spec.containers[web].volumeMounts[/etc/old]",
+        ])
+
+    def test_patch_deployment_unchanged(self):
+        """
+        Test that an up to date deployment costs a single read and no write
+        :return:
+        """
+        live = {
+            "metadata": {
+                "name": "web",
+                "namespace": "default",
+                "resourceVersion": "42",
+                "annotations": {"kubernetes.io/change-cause": "salt-call earlier"},
+            },
+            "spec": {"replicas": 2, "template": {"spec": {"containers": [
+                {"name": "web", "image": "nginx:1", "imagePullPolicy": "IfNotPresent"},
+            ]}}},
+            "status": {"replicas": 2},
+        }
+        api = Mock(**{"read_namespaced_deployment.return_value": live})
+        api.api_client = kubernetes.kubernetes.client.ApiClient()
+        spec = {"replicas": 2, "template": {"spec": {"containers": [
+            {"name": "web", "image": "nginx:1"},
+        ]}}}
+        with patch("mdl_kubernetesmod._setup_conn", Mock(return_value={})), patch.object(
+            kubernetes.kubernetes.client, "ExtensionsV1beta1Api", Mock(return_value=api)
+        ):
+            self.assertEqual(kubernetes.patch_deployment("web", spec=spec), {})
+            api.patch_namespaced_deployment.assert_not_called()
+
+            spec["replicas"] = 3
+            changes = kubernetes.patch_deployment("web", spec=spec)
+
+        self.assertEqual(changes, {"spec.replicas": {"old": 2, "new": 3}})
+        body = api.patch_namespaced_deployment.call_args[0][2]
+        self.assertEqual(body["spec"], {"replicas": 3})
+        self.assertIn("kubernetes.io/change-cause", body["metadata"]["annotations"])
+        api.read_namespaced_deployment.assert_called_with("web", "default")
+
     def test_adding_change_cause_annotation(self):
         """
         Tests adding a `kubernetes.io/change-cause` annotation just like
@@ -0,0 +1,456 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from datetime import datetime, timedelta
+from functools import reduce
+
+try:
+    from unittest.mock import Mock, patch
+except:
+    from mock import Mock, patch
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import mdl_vault
+
+
+class VaultError(Exception):
+    pass
+
+
+class Forbidden(VaultError):
+    pass
+
+
+def vault_error(error_type=None):
+    return {
+        None: VaultError,
+        'Forbidden': Forbidden,
+    }[error_type]
+
+
+def run_sequentially(func, items, max_workers=None, ordered=True):
+    for item in items:
+        try:
+            yield item, func(item), None
+        except Exception as e:
+            yield item, None, e
+
+
+def vault_time(delta):
+    return (datetime.utcnow() + delta).strftime('%Y-%m-%dT%H:%M:%S.%f') + '123Z'
+
+
+class FakeVault(object):
+    '''
+    A client with a lease tree, where leases are given as a dict of lease id to
+    how long until it expires.
+    '''
+
+    def __init__(self, leases):
+        self.leases = leases
+        self.revoked = []
+        self.revoked_prefixes = []
+        self.allow_revoke_prefix = True
+
+    def list(self, path):
+        prefix = path[len('sys/leases/lookup/'):].strip('/')
+        prefix = prefix + '/' if prefix else ''
+        keys = set()
+        for lease_id in self.leases:
+            if lease_id.startswith(prefix):
+                rest = lease_id[len(prefix):]
+                if '/' in rest:
+                    keys.add(rest.split('/')[0] + '/')
+                else:
+                    keys.add(rest)
+        if not keys:
+            return None
+        return {'data': {'keys': sorted(keys)}}
+
+    def write(self, path, lease_id=None, **kwargs):
+        if path == 'sys/leases/lookup':
+            if lease_id not in self.leases:
+                raise VaultError('invalid lease')
+            return {'data': {
+                'id': lease_id,
+                'expire_time': vault_time(self.leases[lease_id]),
+            }}
+        if path == 'sys/leases/revoke':
+            self.revoked.append(lease_id)
+            return None
+        raise NotImplementedError(path)
+
+    def revoke_secret_prefix(self, path_prefix):
+        if not self.allow_revoke_prefix:
+            raise Forbidden('permission denied')
+        self.revoked_prefixes.append(path_prefix)
+
+
+@pytest.fixture
+def fake_vault():
+    client = FakeVault({
+        'database/creds/app/expiring1': timedelta(hours=1),
+        'database/creds/app/expiring2': timedelta(hours=2),
+        'database/creds/app/valid': timedelta(days=30),
+        'database/creds/other/expiring': timedelta(minutes=5),
+        'aws/creds/deploy/valid': timedelta(days=10),
+    })
+    mdl_vault.__utils__ = {
+        'mdl_vault.build_client': lambda: client,
+        'mdl_vault.run_concurrently': run_sequentially,
+        'mdl_vault.vault_error': vault_error,
+    }
+    mdl_vault.__salt__ = {
+        'event.send': Mock(),
+    }
+    yield client
+    del mdl_vault.__utils__
+    del mdl_vault.__salt__
+
+
+def test_parse_vault_time():
+    assert mdl_vault._parse_vault_time('2020-01-02T03:04:05.123456789Z') == \
+        datetime(2020, 1, 2, 3, 4, 5, 123456)
+    assert mdl_vault._parse_vault_time('2020-01-02T03:04:05Z') == \
+        datetime(2020, 1, 2, 3, 4, 5)
+    assert mdl_vault._parse_vault_time('2020-01-02T03:04:05.5+01:00') == \
+        datetime(2020, 1, 2, 2, 4, 5, 500000)
+
+
+def test_scan_leases(fake_vault):
+    leases = mdl_vault.scan_leases(time_horizon=24*60*60)
+
+    assert sorted(lease['id'] for lease in leases) == [
+        'database/creds/app/expiring1',
+        'database/creds/app/expiring2',
+        'database/creds/other/expiring',
+    ]
+
+
+def test_scan_leases_with_prefix(fake_vault):
+    leases = mdl_vault.scan_leases('database/creds/other', time_horizon=24*60*60)
+
+    assert [lease['id'] for lease in leases] == ['database/creds/other/expiring']
+
+
+def test_scan_leases_sends_batched_events(fake_vault):
+    mdl_vault.scan_leases(time_horizon=24*60*60, event_batch_size=2)
+
+    event_send = mdl_vault.__salt__['event.send']
+    assert event_send.call_count == 2
+    batch_sizes = [len(call[1]['data']['leases']) for call in event_send.call_args_list]
+    assert batch_sizes == [2, 1]
+    assert event_send.call_args[0][0] == 'vault/lease/expiring'
+
+
+def test_scan_leases_stats(fake_vault):
+    ret = mdl_vault.scan_leases(time_horizon=24*60*60, send_events=False,
+                                return_stats=True)
+
+    assert len(ret['leases']) == 3
+    assert ret['stats']['lookups'] == 5
+    assert ret['stats']['expiring'] == 3
+    assert ret['stats']['max_in_flight'] == 1
+    mdl_vault.__salt__['event.send'].assert_not_called()
+
+
+def test_clean_expired_leases(fake_vault):
+    ret = mdl_vault.clean_expired_leases(time_horizon=24*60*60)
+
+    assert sorted(fake_vault.revoked) == [
+        'database/creds/app/expiring1',
+        'database/creds/app/expiring2',
+        'database/creds/other/expiring',
+    ]
+    assert fake_vault.revoked_prefixes == []
+    assert sorted(lease['id'] for lease in ret['revoked']) == sorted(fake_vault.revoked)
+    assert ret['failed'] == []
+
+
+def test_clean_expired_leases_revokes_leases_one_by_one_by_default(fake_vault):
+    ret = mdl_vault.clean_expired_leases(time_horizon=60*24*60*60)
+
+    assert fake_vault.revoked_prefixes == []
+    assert len(fake_vault.revoked) == 5
+    assert ret['revoked_prefixes'] == []
+
+
+def test_clean_expired_leases_revokes_prefix(fake_vault):
+    ret = mdl_vault.clean_expired_leases(time_horizon=60*24*60*60,
+                                         use_revoke_prefix=True)
+
+    # Every lease in database/creds/app expires, thus the directory can be
+    # revoked as a whole, while single leases are still revoked one by one
+    assert fake_vault.revoked_prefixes == ['database/creds/app']
+    assert sorted(fake_vault.revoked) == [
+        'aws/creds/deploy/valid',
+        'database/creds/other/expiring',
+    ]
+    assert ret['revoked_prefixes'] == ['database/creds/app']
+    assert len(ret['revoked']) == 5
+
+
+def test_clean_expired_leases_falls_back_without_prefix_permission(fake_vault):
+    fake_vault.allow_revoke_prefix = False
+
+    ret = mdl_vault.clean_expired_leases(time_horizon=60*24*60*60,
+                                         use_revoke_prefix=True)
+
+    assert len(fake_vault.revoked) == 5
+    assert ret['revoked_prefixes'] == []
+    assert ret['failed'] == []
+
+
+def test_clean_expired_leases_reports_failures(fake_vault):
+    lookup = fake_vault.write
+
+    def write(path, lease_id=None, **kwargs):
+        if path == 'sys/leases/revoke' and lease_id.startswith('database/creds/app/'):
+            raise VaultError('permission denied')
+        return lookup(path, lease_id=lease_id, **kwargs)
+
+    with patch.object(fake_vault, 'write', write):
+        ret = mdl_vault.clean_expired_leases(time_horizon=24*60*60)
+
+    assert [lease['id'] for lease in ret['revoked']] == ['database/creds/other/expiring']
+    assert sorted(failure['id'] for failure in ret['failed']) == [
+        'database/creds/app/expiring1',
+        'database/creds/app/expiring2',
+    ]
+    assert ret['failed'][0]['error'] == 'permission denied'
+
+
+@pytest.fixture
+def local_cache(tmp_path):
+    pki_dir = tmp_path / 'pki'
+    pki_dir.mkdir()
+    (pki_dir / 'minion.pem').write_text(u'not really a private key')
+    mdl_vault.__opts__ = {
+        'cachedir': str(tmp_path / 'cache'),
+        'pki_dir': str(pki_dir),
+        'vault.lease_renewal_threshold': {'hours': 1},
+    }
+    stored = {}
+    client = Mock()
+
+    def read(path):
+        if path.startswith('secret/pillar_cache/'):
+            return {'data': {'value': stored[path]}} if path in stored else None
+        return {'lease_id': 'database/creds/app/1', 'lease_duration': 7200,
+                'data': {'password': 'hunter2'}}
+
+    client.read.side_effect = read
+    client.write.side_effect = lambda path, value: stored.__setitem__(path, value)
+    client.get_lease.return_value = {'data': {'ttl': 7000}}
+    mdl_vault.__utils__ = {
+        'mdl_vault.build_client': lambda: client,
+    }
+    mdl_vault.__salt__ = {
+        'event.send': Mock(),
+    }
+    mdl_vault._local_cache.clear()
+    yield client
+    mdl_vault._local_cache.clear()
+    del mdl_vault.__opts__
+    del mdl_vault.__utils__
+    del mdl_vault.__salt__
+
+
+def test_cached_read_uses_local_cache(local_cache, tmp_path):
+    first = mdl_vault.cached_read('database/creds/app', cache_prefix='minion')
+    calls = len(local_cache.mock_calls)
+
+    second = mdl_vault.cached_read('database/creds/app', cache_prefix='minion')
+    # A new process only has the cache on disk to go on
+    mdl_vault._local_cache.clear()
+    third = mdl_vault.cached_read('database/creds/app', cache_prefix='minion')
+
+    assert first == second == third
+    assert third['data'] == {'password': 'hunter2'}
+    assert len(local_cache.mock_calls) == calls
+    cache_files = list((tmp_path / 'cache' / 'mdl_vault').iterdir())
+    assert len(cache_files) == 1
+    assert b'hunter2' not in cache_files[0].read_bytes()
+
+
+def test_cached_read_skips_local_cache_close_to_expiry(local_cache):
+    mdl_vault.__opts__['vault.lease_renewal_threshold'] = {'hours': 3}
+
+    mdl_vault.cached_read('database/creds/app', cache_prefix='minion')
+    calls = len(local_cache.mock_calls)
+    mdl_vault.cached_read('database/creds/app', cache_prefix='minion')
+
+    assert len(local_cache.mock_calls) > calls
+    assert mdl_vault._local_cache == {}
+
+
+def test_purge_local_cache(local_cache):
+    mdl_vault.cached_read('database/creds/app', cache_prefix='minion')
+
+    assert mdl_vault.purge_local_cache() == 1
+    assert mdl_vault._local_cache == {}
+
+
+class FakeCache(object):
+    '''
+    A client with a key value tree of the given paths, that keeps track of which
+    directories were listed.
+    '''
+
+    def __init__(self, paths):
+        self.data = dict((path, {'data': {'value': path}}) for path in paths)
+        self.listed = []
+
+    def list(self, path):
+        self.listed.append(path)
+        prefix = path.strip('/') + '/'
+        keys = set()
+        for key in self.data:
+            if key.startswith(prefix):
+                rest = key[len(prefix):]
+                keys.add(rest.split('/')[0] + '/' if '/' in rest else rest)
+        if not keys:
+            return None
+        return {'data': {'keys': sorted(keys)}}
+
+    def read(self, path):
+        return self.data.get(path)
+
+    def delete(self, path):
+        del self.data[path]
+
+
+@pytest.fixture
+def fake_cache():
+    client = FakeCache([
+        'secret/pillar_cache/web1/database/creds/app',
+        'secret/pillar_cache/web1/aws/creds/deploy',
+        'secret/pillar_cache/web2/database/creds/app',
+        'secret/pillar_cache/db1/database/creds/admin',
+    ])
+    mdl_vault.__opts__ = {'cachedir': '/nonexistent'}
+    mdl_vault.__utils__ = {
+        'mdl_vault.build_client': lambda: client,
+        'mdl_vault.run_concurrently': run_sequentially,
+        'data.traverse_dict': lambda data, key: reduce(
+            lambda value, part: value[part], key.split(':'), data),
+    }
+    yield client
+    del mdl_vault.__opts__
+    del mdl_vault.__utils__
+
+
+def test_list_cache_paths(fake_cache):
+    assert mdl_vault.list_cache_paths(cache_filter='database') == [
+        'secret/pillar_cache/db1/database/creds/admin',
+        'secret/pillar_cache/web1/database/creds/app',
+        'secret/pillar_cache/web2/database/creds/app',
+    ]
+
+
+def test_list_cache_paths_prunes_glob(fake_cache):
+    paths = mdl_vault.list_cache_paths(
+        cache_filter='secret/pillar_cache/web*/database/**')
+
+    assert paths == [
+        'secret/pillar_cache/web1/database/creds/app',
+        'secret/pillar_cache/web2/database/creds/app',
+    ]
+    assert 'secret/pillar_cache/db1' not in fake_cache.listed
+    assert 'secret/pillar_cache/web1/aws' not in fake_cache.listed
+
+
+def test_list_cached_data(fake_cache):
+    cached_data = mdl_vault.list_cached_data(cache_filter='web2',
+                                             attribute_path='data:value')
+
+    assert cached_data == [(
+        'secret/pillar_cache/web2/database/creds/app',
+        'secret/pillar_cache/web2/database/creds/app',
+    )]
+
+
+def test_purge_cache_data(fake_cache):
+    deleted = mdl_vault.purge_cache_data('web1')
+
+    assert deleted == [
+        'secret/pillar_cache/web1/aws/creds/deploy',
+        'secret/pillar_cache/web1/database/creds/app',
+    ]
+    assert sorted(fake_cache.data) == [
+        'secret/pillar_cache/db1/database/creds/admin',
+        'secret/pillar_cache/web2/database/creds/app',
+    ]
+
+
+def cached_lease(lease_id, source=None):
+    value = {'lease_id': lease_id, 'lease_duration': 7200, 'data': {'password': lease_id}}
+    if source:
+        value['source'] = {'method': 'read', 'path': source}
+    return {'data': {'value': value}}
+
+
+@pytest.fixture
+def lease_cache():
+    client = FakeCache([])
+    client.data.update({
+        'secret/pillar_cache/web1/database/creds/app':
+            cached_lease('db/renewable', 'database/creds/app'),
+        'secret/pillar_cache/web2/database/creds/app':
+            cached_lease('db/expiring', 'database/creds/app'),
+        'secret/pillar_cache/web3/database/creds/app':
+            cached_lease('db/valid', 'database/creds/app'),
+        'secret/pillar_cache/web4/database/creds/app': cached_lease('db/unknown'),
+        'secret/pillar_cache/web5/static': {'data': {'value': {'data': {}}}},
+        'database/creds/app': {'lease_id': 'db/new', 'lease_duration': 7200,
+                               'data': {'password': 'new'}},
+    })
+    ttls = {'db/renewable': 60, 'db/expiring': 60, 'db/valid': 30000, 'db/unknown': 60}
+    client.get_lease = lambda lease_id: {'data': {
+        'ttl': ttls[lease_id], 'renewable': lease_id == 'db/renewable'}}
+    client.renew_secret = Mock(return_value={'lease_duration': 7200})
+    client.write = lambda path, value: client.data.__setitem__(path, {'data': {'value': value}})
+    mdl_vault.__opts__ = {
+        'cachedir': '/nonexistent',
+        'vault.lease_renewal_threshold': {'hours': 1},
+    }
+    mdl_vault.__utils__ = {
+        'mdl_vault.build_client': lambda: client,
+        'mdl_vault.run_concurrently': run_sequentially,
+    }
+    mdl_vault.__salt__ = {'event.send': Mock()}
+    yield client
+    del mdl_vault.__opts__
+    del mdl_vault.__utils__
+    del mdl_vault.__salt__
+
+
+def test_renew_cached_leases(lease_cache):
+    ret = mdl_vault.renew_cached_leases(renew_ahead=600)
+
+    assert ret == {
+        'renewed': ['secret/pillar_cache/web1/database/creds/app'],
+        'regenerated': ['secret/pillar_cache/web2/database/creds/app'],
+        'skipped': ['secret/pillar_cache/web4/database/creds/app'],
+        'failed': [],
+    }
+    lease_cache.renew_secret.assert_called_once_with('db/renewable', increment=7200)
+    regenerated = lease_cache.data['secret/pillar_cache/web2/database/creds/app']
+    assert regenerated['data']['value']['lease_id'] == 'db/new'
+    assert regenerated['data']['value']['source'] == {
+        'method': 'read', 'path': 'database/creds/app'}
+    assert mdl_vault.__salt__['event.send'].call_count == 2
+    mdl_vault.__salt__['event.send'].assert_any_call('vault/cache/renewed',
+        data={'paths': ['secret/pillar_cache/web1/database/creds/app']})
+
+
+def test_renew_cached_leases_regenerates_when_renewal_is_too_short(lease_cache):
+    lease_cache.renew_secret.return_value = {'lease_duration': 600}
+
+    ret = mdl_vault.renew_cached_leases(renew_ahead=600)
+
+    assert 'secret/pillar_cache/web1/database/creds/app' in ret['regenerated']
@@ -86,6 +86,7 @@ import copy
 import logging
 
 # Import 3rd-party libs
+from salt.exceptions import CommandExecutionError
 from salt.ext import six
 
 log = logging.getLogger(__name__)
@@ -108,6 +109,37 @@ def _error(ret, err_msg):
     return ret
 
 
+def _patched(ret, kind, name, namespace, metadata, spec, source, template, **kwargs):
+    '''
+    Patch the differences between the existing object and the desired one into
+    ret. Returns False if the object doesn't exist yet.
+    '''
+    changes = __salt__['mdl_kubernetes.patch_{0}'.format(kind)](
+        name=name,
+        namespace=namespace,
+        metadata=metadata,
+        spec=spec,
+        source=source,
+        template=template,
+        saltenv=__env__,
+        test=__opts__['test'],
+        **kwargs)
+    if changes is None:
+        return False
+
+    ret['changes'] = changes
+    if not changes:
+        ret['result'] = True
+        ret['comment'] = 'The {0} is already in the desired state'.format(kind)
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'The {0} is going to be updated'.format(kind)
+    else:
+        ret['result'] = True
+        ret['comment'] = 'The {0} has been updated'.format(kind)
+    return True
+
+
 def deployment_absent(name, namespace='default', **kwargs):
     '''
     Ensures that the named deployment is absent from the given namespace.
@@ -156,11 +188,13 @@ def deployment_present(
         spec=None,
         source='',
         template='',
+        force_replace=False,
         **kwargs):
     '''
     Ensures that the named deployment is present inside of the specified
     namespace with the given metadata and spec.
-    If the deployment exists it will be replaced.
+    If the deployment exists, only the fields that differ from the given metadata
+    and spec are patched, fields that are not given are left alone.
 
     name
         The name of the deployment.
@@ -181,6 +215,10 @@ def deployment_present(
 
     template
         Template engine to be used to render the source file.
+
+    force_replace
+        Replace the existing deployment on every run instead of patching the
+        differences, like it used to be done.
     '''
     ret = {'name': name,
            'changes': {},
@@ -200,7 +238,13 @@ def deployment_present(
     if spec is None:
         spec = {}
 
-    deployment = __salt__['mdl_kubernetes.show_deployment'](name, namespace, **kwargs)
+    if not force_replace:
+        if _patched(ret, 'deployment', name, namespace, metadata, spec, source,
+                    template, **kwargs):
+            return ret
+        deployment = None
+    else:
+        deployment = __salt__['mdl_kubernetes.show_deployment'](name, namespace, **kwargs)
 
     if deployment is None:
         if __opts__['test']:
@@ -223,7 +267,6 @@ def deployment_present(
             ret['result'] = None
             return ret
 
-        # TODO: improve checks  # pylint: disable=fixme
         log.info('Forcing the recreation of the deployment')
         ret['comment'] = 'The deployment is already present. Forcing recreation'
         res = __salt__['mdl_kubernetes.replace_deployment'](
@@ -251,11 +294,13 @@ def service_present(
         spec=None,
         source='',
         template='',
+        force_replace=False,
         **kwargs):
     '''
     Ensures that the named service is present inside of the specified namespace
     with the given metadata and spec.
-    If the deployment exists it will be replaced.
+    If the service exists, only the fields that differ from the given metadata
+    and spec are patched, fields that are not given are left alone.
 
     name
         The name of the service.
@@ -276,6 +321,10 @@ def service_present(
 
     template
         Template engine to be used to render the source file.
+
+    force_replace
+        Replace the existing service on every run instead of patching the
+        differences, like it used to be done.
     '''
     ret = {'name': name,
            'changes': {},
@@ -295,7 +344,13 @@ def service_present(
     if spec is None:
         spec = {}
 
-    service = __salt__['mdl_kubernetes.show_service'](name, namespace, **kwargs)
+    if not force_replace:
+        if _patched(ret, 'service', name, namespace, metadata, spec, source,
+                    template, **kwargs):
+            return ret
+        service = None
+    else:
+        service = __salt__['mdl_kubernetes.show_service'](name, namespace, **kwargs)
 
     if service is None:
         if __opts__['test']:
@@ -318,7 +373,6 @@ def service_present(
             ret['result'] = None
             return ret
 
-        # TODO: improve checks  # pylint: disable=fixme
         log.info('Forcing recreation of the service')
         ret['comment'] = 'The service is already present. Forcing recreation'
         res = __salt__['mdl_kubernetes.replace_service'](
@@ -770,11 +824,13 @@ def pod_present(
         spec=None,
         source='',
         template='',
+        force_replace=False,
         **kwargs):
     '''
     Ensures that the named pod is present inside of the specified
     namespace with the given metadata and spec.
-    If the pod exists it will be replaced.
+    If the pod exists, the fields that differ from the given metadata and
+    spec are patched, which the API server only allows for some of them.
 
     name
         The name of the pod.
@@ -795,6 +851,10 @@ def pod_present(
 
     template
         Template engine to be used to render the source file.
+
+    force_replace
+        Use the old behaviour of refusing to touch an existing pod, instead of
+        patching it.
     '''
     ret = {'name': name,
            'changes': {},
@@ -814,7 +874,13 @@ def pod_present(
     if spec is None:
         spec = {}
 
-    pod = __salt__['mdl_kubernetes.show_pod'](name, namespace, **kwargs)
+    if not force_replace:
+        if _patched(ret, 'pod', name, namespace, metadata, spec, source,
+                    template, **kwargs):
+            return ret
+        pod = None
+    else:
+        pod = __salt__['mdl_kubernetes.show_pod'](name, namespace, **kwargs)
 
     if pod is None:
         if __opts__['test']:
@@ -868,7 +934,7 @@ def node_label_absent(name, node, **kwargs):
            'result': False,
            'comment': ''}
 
-    labels = __salt__['mdl_kubernetes.node_labels'](node, **kwargs)
+    labels = __salt__['mdl_kubernetes.node_labels'](node, use_cache=True, **kwargs)
 
     if name not in labels:
         ret['result'] = True if not __opts__['test'] else None
@@ -909,7 +975,7 @@ def node_label_folder_absent(name, node, **kwargs):
            'changes': {},
            'result': False,
            'comment': ''}
-    labels = __salt__['mdl_kubernetes.node_labels'](node, **kwargs)
+    labels = __salt__['mdl_kubernetes.node_labels'](node, use_cache=True, **kwargs)
 
     folder = name.strip("/") + "/"
     labels_to_drop = []
@@ -930,11 +996,11 @@ def node_label_folder_absent(name, node, **kwargs):
         ret['result'] = None
         return ret
 
-    for label in labels_to_drop:
-        __salt__['mdl_kubernetes.node_remove_label'](
-            node_name=node,
-            label_name=label,
-            **kwargs)
+    __salt__['mdl_kubernetes.node_labels_managed'](
+        node,
+        folders_absent=[folder],
+        use_cache=True,
+        **kwargs)
 
     ret['result'] = True
     ret['changes'] = {
@@ -972,7 +1038,7 @@ def node_label_present(
            'result': False,
            'comment': ''}
 
-    labels = __salt__['mdl_kubernetes.node_labels'](node, **kwargs)
+    labels = __salt__['mdl_kubernetes.node_labels'](node, use_cache=True, **kwargs)
 
     if name not in labels:
         if __opts__['test']:
@@ -1009,3 +1075,82 @@ def node_label_present(
     ret['result'] = True
 
     return ret
+
+
+def node_labels_managed(
+        name,
+        labels=None,
+        absent=None,
+        folders_absent=None,
+        nodes=None,
+        max_workers=10,
+        **kwargs):
+    '''
+    Ensures the labels of one or more nodes are in the given state, with one
+    read and at most one patch per node, no matter how many labels change.
+
+    name
+        The name of the node, unless `nodes` is given
+
+    labels
+        Dict of labels that should be set to the given values
+
+    absent
+        List of labels that should be removed
+
+    folders_absent
+        List of label folders whose labels should be removed, except for those
+        in `labels`
+
+    nodes
+        List of nodes to manage the labels of, all processed concurrently
+
+    .. code-block:: yaml
+
+        node-labels:
+          mdl_kubernetes.node_labels_managed:
+            - nodes:
+              - node-1
+              - node-2
+            - labels:
+                example.com/role: web
+            - folders_absent:
+              - old.example.com
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': False,
+           'comment': ''}
+
+    try:
+        node_changes = __salt__['mdl_kubernetes.node_labels_managed'](
+            nodes or [name],
+            labels=labels,
+            absent=absent,
+            folders_absent=folders_absent,
+            test=__opts__['test'],
+            use_cache=True,
+            max_workers=max_workers,
+            **kwargs)
+    except CommandExecutionError as exc:
+        ret['changes'] = {node: changes for node, changes in
+            six.iteritems((exc.info or {}).get('changes', {})) if changes}
+        return _error(ret, six.text_type(exc))
+
+    missing = sorted(node for node, changes in six.iteritems(node_changes) if changes is None)
+    ret['changes'] = {node: changes for node, changes in six.iteritems(node_changes) if changes}
+
+    if missing:
+        return _error(ret, 'Nodes not found: {0}'.format(', '.join(missing)))
+
+    if not ret['changes']:
+        ret['result'] = True
+        ret['comment'] = 'The node labels are already in the desired state'
+    elif __opts__['test']:
+        ret['result'] = None
+        ret['comment'] = 'The labels of {0} node(s) are going to be changed'.format(len(ret['changes']))
+    else:
+        ret['result'] = True
+        ret['comment'] = 'Changed the labels of {0} node(s)'.format(len(ret['changes']))
+
+    return ret
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 
 import logging
 import os
+from functools import partial
 
 import salt.config
 import salt.syspaths
@@ -11,6 +12,11 @@ import salt.utils
 import salt.exceptions
 from salt.utils.dictdiffer import RecursiveDictDiffer
 
+try:
+    from salt.utils.ctx import RequestContext
+except ImportError:
+    RequestContext = None
+
 log = logging.getLogger(__name__)
 
 try:
@@ -22,11 +28,68 @@ except ImportError:
 
 __all__ = ['initialize']
 
+DEFAULT_MAX_WORKERS = 10
+
+# What _snapshot lists for each kind of snapshot
+_SNAPSHOT_LISTINGS = {
+    'auth': 'mdl_vault.list_auth_backends',
+    'mounts': 'mdl_vault.list_secrets_engines',
+    'audit': 'mdl_vault.list_audit_backends',
+}
+
 
 def __virtual__():
     return DEPS_INSTALLED
 
 
+def _current_jid():
+    """
+    The jid of the state run, the same way salt's logging finds it.
+    """
+    if RequestContext is None:
+        return None
+    return RequestContext.current.get('data', {}).get('jid')
+
+
+def _run_cache():
+    """
+    What's cached for the current state run. __context__ outlives the job when
+    the minion runs with multiprocessing disabled, so the cache is dropped when
+    the jid changes.
+    """
+    jid = _current_jid()
+    cache = __context__.get('mdl_vault.run_cache')
+    if cache is None or cache['jid'] != jid:
+        cache = __context__['mdl_vault.run_cache'] = {'jid': jid}
+    return cache
+
+
+def _snapshot(kind):
+    """
+    The auth backends, secrets engines or audit backends in Vault, listed once
+    per state run and shared by all states. States that change them call
+    _snapshot_changes, so the next state sees the changes.
+    """
+    cache = _run_cache()
+    key = 'snapshot.{0}'.format(kind)
+    if key not in cache:
+        cache[key] = __salt__[_SNAPSHOT_LISTINGS[kind]]().get('data', {})
+    return cache[key]
+
+
+def _invalidate_snapshot(kind):
+    _run_cache().pop('snapshot.{0}'.format(kind), None)
+
+
+def _snapshot_changes(kind, before):
+    """
+    Invalidate the snapshot after a change to Vault and return how the new one
+    differs from before.
+    """
+    _invalidate_snapshot(kind)
+    return _dict_diff(before, _snapshot(kind))
+
+
 def auth_backend_enabled(name, backend_type, description='', mount_point=None):
     """
     Ensure that the named backend has been enabled
@@ -38,7 +101,7 @@ def auth_backend_enabled(name, backend_type, description='', mount_point=None):
     :returns: The result of the state execution
     :rtype: dict
     """
-    existing_backends = __salt__['mdl_vault.list_auth_backends']()
+    existing_backends = _snapshot('auth')
     setting_dict = {'type': backend_type, 'description': description}
     backend_enabled = False
     ret = {
@@ -48,7 +111,7 @@ def auth_backend_enabled(name, backend_type, description='', mount_point=None):
         'changes': {},
     }
 
-    for path, settings in existing_backends.get('data', {}).items():
+    for path, settings in existing_backends.items():
         if (path.strip('/') == mount_point or backend_type and
             settings['type'] == backend_type):
             backend_enabled = True
@@ -68,11 +131,11 @@ def auth_backend_enabled(name, backend_type, description='', mount_point=None):
                                                       description=description,
                                                       mount_point=mount_point)
                 ret['result'] = True
-                new_backends = __salt__['mdl_vault.list_auth_backends']()['data']
-                ret['changes'] = _dict_diff(existing_backends['data'], new_backends)
+                ret['changes'] = _snapshot_changes('auth', existing_backends)
             except __utils__['mdl_vault.vault_error']('InvalidRequest') as e:
                 if (len(e.errors) == 1 and
                         e.errors[0].startswith('path is already in use')):
+                    _invalidate_snapshot('auth')
                     ret['result'] = True
                     ret['comment'] = ('The {backend} backend was already mounted at '
                         '/{mount} by someone else'.format(
@@ -226,16 +289,16 @@ def audit_backend_enabled(name, backend_type, description='', options=None,
                           backend_name=None):
     if not backend_name:
         backend_name = backend_type
-    backends = __salt__['mdl_vault.list_audit_backends']().get('data', {})
+    backends = _snapshot('audit')
     setting_dict = {'type': backend_type, 'description': description}
     backend_enabled = False
     ret = {'name': name,
            'comment': '',
            'result': '',
-           'changes': {'old': backends}}
+           'changes': {}}
 
-    for path, settings in __salt__['mdl_vault.list_audit_backends']().items():
-        if (path.strip('/') == backend_type and
+    for path, settings in backends.items():
+        if (path.strip('/') == backend_name and
             settings['type'] == backend_type):
             backend_enabled = True
 
@@ -252,8 +315,7 @@ def audit_backend_enabled(name, backend_type, description='', options=None,
                                                    description=description,
                                                    name=backend_name)
             ret['result'] = True
-            ret['changes']['new'] = __salt__[
-                'mdl_vault.list_audit_backends']()
+            ret['changes'] = _snapshot_changes('audit', backends)
             ret['comment'] = ('The {backend} audit backend has been '
                               'successfully enabled.'.format(
                                   backend=backend_type))
@@ -292,7 +354,7 @@ def secrets_engine_enabled(name, engine_type, description='', mount_point=None,
     :rtype: dict
 
     """
-    engines = __salt__['mdl_vault.list_secrets_engines']().get('data', {})
+    engines = _snapshot('mounts')
     engine_enabled = False
     ret = {
         'name': name,
@@ -319,13 +381,13 @@ def secrets_engine_enabled(name, engine_type, description='', mount_point=None,
                                                         mount_point=mount_point,
                                                         options=options)
                 ret['result'] = True
-                new_engines = __salt__['mdl_vault.list_secrets_engines']()['data']
-                ret['changes'] = _dict_diff(engines, new_engines)
+                ret['changes'] = _snapshot_changes('mounts', engines)
             except __utils__['mdl_vault.vault_error']('InvalidRequest') as e:
                 # This guards against a race condition where multiple minions tried to
                 # mount at the same time
                 if (len(e.errors) == 1 and
                         e.errors[0].startswith('path is already in use')):
+                    _invalidate_snapshot('mounts')
                     ret['result'] = True
                     ret['comment'] = ('The secrets engine {type} was already mounted at '
                         '{mount} by someone else\n'.format(
@@ -369,6 +431,7 @@ def secrets_engine_enabled(name, engine_type, description='', mount_point=None,
                 __salt__['mdl_vault.write'](ttl_config_path,
                                         default_lease_ttl=ttl_default,
                                         max_lease_ttl=ttl_max)
+                _invalidate_snapshot('mounts')
             except __utils__['mdl_vault.vault_error']() as e:
                 ret['comment'] += ('The secrets engine was enabled but the connection '
                                   'ttl could not be tuned\n'.format(e))
@@ -402,6 +465,36 @@ def secrets_engine_enabled(name, engine_type, description='', mount_point=None,
     return ret
 
 
+def _existing_policies():
+    """
+    All policies in Vault by name, listed once per state run and read
+    concurrently. Policies that couldn't be read up front are None and read on
+    demand by _current_policy.
+    """
+    cache = _run_cache()
+    if 'policies' not in cache:
+        paths = ['sys/policy/{0}'.format(policy_name)
+                 for policy_name in __salt__['mdl_vault.list_policies']()]
+        policies = {}
+        for path, policy in __salt__['mdl_vault.read_many'](paths).items():
+            if policy and 'error' not in policy:
+                policy = policy['rules']
+            else:
+                policy = None
+            policies[path[len('sys/policy/'):]] = policy
+        cache['policies'] = policies
+    return cache['policies']
+
+
+def _current_policy(name):
+    policies = _existing_policies()
+    if name not in policies:
+        return None
+    if policies[name] is None:
+        policies[name] = __salt__['mdl_vault.get_policy'](name)
+    return policies[name]
+
+
 def policy_present(name, rules):
     """
     Ensure that the named policy exists and has the defined rules set
@@ -411,12 +504,14 @@ def policy_present(name, rules):
     :returns: The result of the state execution
     :rtype: dict
     """
-    current_policy = __salt__['mdl_vault.get_policy'](name)
+    current_policy = _current_policy(name)
     ret = {'name': name,
            'comment': '',
            'result': False,
            'changes': {}}
-    if current_policy == rules:
+    normalize_policy = __utils__['mdl_vault.normalize_policy']
+    if (current_policy is not None and
+            normalize_policy(current_policy) == normalize_policy(rules)):
         ret['result'] = True
         ret['comment'] = ('The {policy_name} policy already exists with the '
                           'given rules.'.format(policy_name=name))
@@ -431,6 +526,7 @@ def policy_present(name, rules):
     else:
         try:
             __salt__['mdl_vault.set_policy'](name, rules)
+            _existing_policies()[name] = rules
             ret['result'] = True
             ret['comment'] = ('The {policy_name} policy was successfully '
                               'created/updated.'.format(policy_name=name))
@@ -451,7 +547,7 @@ def policy_absent(name):
     :returns: The result of the state execution
     :rtype: dict
     """
-    current_policy = __salt__['mdl_vault.get_policy'](name)
+    current_policy = _current_policy(name)
     ret = {'name': name,
            'comment': '',
            'result': False,
@@ -471,6 +567,7 @@ def policy_absent(name):
     else:
         try:
             __salt__['mdl_vault.delete_policy'](name)
+            _existing_policies().pop(name, None)
             ret['result'] = True
             ret['comment'] = ('The {policy_name} policy was successfully '
                               'deleted.')
@@ -565,5 +662,229 @@ def role_absent(name, mount_point):
     return ret
 
 
+def _write(path, data):
+    return __salt__['mdl_vault.write'](path, **data)
+
+
+def _config_diff(current, desired):
+    """
+    How the keys set in desired differ from current. Keys that are only in
+    current are ignored, like in the other states.
+    """
+    current = current or {}
+    return _dict_diff({key: current.get(key) for key in desired}, desired)
+
+
+def _plan_config(policies, auth_backends, secrets_engines, max_workers):
+    """
+    Read the current config once and return the writes needed to get to the
+    desired config, as dicts with the path written to, the changes, the write
+    itself, the phase it runs in and the mount it requires.
+    """
+    plan = []
+    errors = []
+    mounts = _snapshot('mounts')
+    auths = _snapshot('auth')
+
+    normalize_policy = __utils__['mdl_vault.normalize_policy']
+    for policy_name, rules in policies.items():
+        current_policy = _current_policy(policy_name)
+        if (current_policy is None or
+                normalize_policy(current_policy) != normalize_policy(rules)):
+            plan.append({
+                'path': 'sys/policy/{0}'.format(policy_name),
+                'changes': {'old': current_policy, 'new': rules},
+                'apply': partial(__salt__['mdl_vault.set_policy'], policy_name, rules),
+                'phase': 0,
+                'requires': None,
+            })
+
+    # Mount point, type, path in the listing, write to enable it and the reads
+    # and writes of what it has configured
+    backends = []
+    for auth_backend in auth_backends:
+        mount_point = auth_backend.get('mount_point') or auth_backend['backend_type']
+        configs = []
+        if auth_backend.get('config'):
+            configs.append(('auth/{0}/config'.format(mount_point),
+                auth_backend['config'],
+                partial(__salt__['mdl_vault.configure_auth_backend'], mount_point)))
+        for role in auth_backend.get('roles', []):
+            configs.append(('auth/{0}/role/{1}'.format(mount_point, role['name']),
+                __salt__['mdl_pillar.resolve_leaf_values'](role['config']),
+                partial(__salt__['mdl_vault.configure_auth_backend_role'],
+                        mount_point, role['name'])))
+        backends.append((mount_point, auth_backend['backend_type'], auths,
+            'sys/auth/{0}'.format(mount_point),
+            partial(__salt__['mdl_vault.enable_auth_backend'],
+                    auth_backend['backend_type'],
+                    description=auth_backend.get('description'),
+                    mount_point=mount_point),
+            configs))
+    for secrets_engine in secrets_engines:
+        mount_point = secrets_engine.get('mount_point') or secrets_engine['type']
+        configs = []
+        for role in secrets_engine.get('roles', []):
+            path = '{0}/roles/{1}'.format(mount_point, role['name'])
+            configs.append((path, role['options'], partial(_write, path)))
+        backends.append((mount_point, secrets_engine['type'], mounts,
+            'sys/mounts/{0}'.format(mount_point),
+            partial(__salt__['mdl_vault.enable_secrets_engine'],
+                    secrets_engine['type'],
+                    description=secrets_engine.get('description'),
+                    mount_point=mount_point,
+                    options=secrets_engine.get('options')),
+            configs))
+
+    # Read everything configured on existing mounts at once
+    paths = [path for mount_point, _, listing, _, _, configs in backends
+             if mount_point + '/' in listing for path, _, _ in configs]
+    current = __salt__['mdl_vault.read_many'](paths, max_workers=max_workers) if paths else {}
+
+    for mount_point, backend_type, listing, mount_path, enable, configs in backends:
+        mounted = listing.get(mount_point + '/')
+        if mounted and mounted['type'] != backend_type:
+            errors.append('{0} is mounted with type {1} instead of {2}'.format(
+                mount_path, mounted['type'], backend_type))
+            continue
+        if not mounted:
+            plan.append({
+                'path': mount_path,
+                'changes': {'old': None, 'new': {'type': backend_type}},
+                'apply': enable,
+                'phase': 0,
+                'requires': None,
+            })
+        for path, config, write in configs:
+            existing = current.get(path)
+            if existing and 'error' in existing:
+                errors.append('Failed to read {0}: {1}'.format(path, existing['error']))
+                continue
+            existing = existing['data'] if existing else None
+            changes = _config_diff(existing, config) if existing else {
+                'old': None, 'new': config}
+            if changes:
+                plan.append({
+                    'path': path,
+                    'changes': changes,
+                    'apply': partial(write, config),
+                    'phase': 1,
+                    'requires': None if mounted else mount_path,
+                })
+
+    return plan, errors
+
+
+def config_reconciled(name, policies=None, auth_backends=None, secrets_engines=None,
+                      max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Ensure Vault has the given policies, auth backends and secrets engines, with
+    their config and roles, in one go.
+
+    The current config is read once, concurrently, and only what differs is
+    written. Mounts and policies are written first, then what is configured on
+    the mounts, with up to max_workers writes in flight at a time. In test mode
+    the changes are the exact writes that would be made.
+
+    .. code-block:: yaml
+
+        vault-config:
+            mdl_vault.config_reconciled:
+                - policies:
+                    reader: 'path "secret/*" { capabilities = ["read"] }'
+                - auth_backends:
+                    - backend_type: gcp
+                      config:
+                        credentials_pillar: gcp:credentials
+                      roles:
+                        - name: my-role
+                          config:
+                            type: iam
+                - secrets_engines:
+                    - type: database
+                      mount_point: db
+                      roles:
+                        - name: readonly
+                          options:
+                            db_name: postgres
+
+    :param name: ID for the state definition
+    :param policies: Dictionary of policy names to rules
+    :param auth_backends: List of auth backends, with backend_type, and
+        optionally mount_point, description, config and roles with a name and
+        config each. Role config keys can be suffixed with `_pillar` like for
+        auth_backend_role_present.
+    :param secrets_engines: List of secrets engines, with type, and optionally
+        mount_point, description, options and roles with a name and options each,
+        which are written to <mount_point>/roles/<name>.
+    :param max_workers: How many requests to Vault to have in flight at the same time
+    :returns: The result of the state execution
+    :rtype: dict
+    """
+    ret = {
+        'name': name,
+        'comment': '',
+        'result': True,
+        'changes': {},
+    }
+    plan, errors = _plan_config(policies or {}, auth_backends or [],
+                                secrets_engines or [], max_workers)
+    if errors:
+        ret['result'] = False
+        ret['comment'] = '\n'.join(errors)
+        return ret
+
+    if not plan:
+        ret['comment'] = 'The Vault config is already up to date.'
+        return ret
+
+    if __opts__['test']:
+        ret['result'] = None
+        ret['changes'] = {write['path']: write['changes'] for write in plan}
+        ret['comment'] = 'The Vault config will be updated with {0} writes:\n{1}'.format(
+            len(plan), '\n'.join(write['path'] for write in plan))
+        return ret
+
+    failed = set()
+    for phase in (0, 1):
+        writes = []
+        for write in plan:
+            if write['phase'] != phase:
+                continue
+            if write['requires'] in failed:
+                errors.append('Skipped {0} since {1} failed'.format(
+                    write['path'], write['requires']))
+                failed.add(write['path'])
+                continue
+            writes.append(write)
+
+        for write, _, error in __utils__['mdl_vault.run_concurrently'](
+                lambda write: write['apply'](), writes, max_workers=max_workers,
+                ordered=False):
+            if error is not None:
+                log.error('Failed to write %s: %s', write['path'], error)
+                errors.append('Failed to write {0}: {1}'.format(write['path'], error))
+                failed.add(write['path'])
+            else:
+                ret['changes'][write['path']] = write['changes']
+
+    for write in plan:
+        if write['path'] in failed:
+            continue
+        if write['path'].startswith('sys/policy/'):
+            _existing_policies()[write['path'][len('sys/policy/'):]] = write['changes']['new']
+        elif write['path'].startswith('sys/auth/'):
+            _invalidate_snapshot('auth')
+        elif write['path'].startswith('sys/mounts/'):
+            _invalidate_snapshot('mounts')
+
+    if errors:
+        ret['result'] = False
+        ret['comment'] = '\n'.join(errors)
+    else:
+        ret['comment'] = 'The Vault config was updated with {0} writes.'.format(len(plan))
+    return ret
+
+
 def _dict_diff(old_dict, new_dict):
     return RecursiveDictDiffer(old_dict, new_dict, ignore_missing_keys=False).diffs
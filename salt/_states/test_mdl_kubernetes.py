@@ -105,3 +105,62 @@ class KubernetesTestCase(TestCase):
         self.mock_create_secret.assert_not_called()
         replace_call_kwargs = self.mock_replace_secret.call_args[1]
         assert replace_call_kwargs['data'] == {'foo': 'bar'}
+
+
+    def test_node_labels_managed(self):
+        manage = Mock(return_value={
+            'node-1': {'role': {'old': None, 'new': 'web'}},
+            'node-2': {},
+        })
+        with patch.dict(kubernetes.__salt__, {'mdl_kubernetes.node_labels_managed': manage}):
+            ret = kubernetes.node_labels_managed('labels', nodes=['node-1', 'node-2'],
+                labels={'role': 'web'})
+
+        assert ret['result'] == True
+        assert ret['changes'] == {'node-1': {'role': {'old': None, 'new': 'web'}}}
+        manage.assert_called_once_with(['node-1', 'node-2'], labels={'role': 'web'},
+            absent=None, folders_absent=None, test=False, use_cache=True, max_workers=10)
+
+
+    def test_node_labels_managed_missing_node(self):
+        manage = Mock(return_value={'node-1': None})
+        with patch.dict(kubernetes.__salt__, {'mdl_kubernetes.node_labels_managed': manage}):
+            ret = kubernetes.node_labels_managed('node-1', absent=['role'])
+
+        assert ret['result'] == False
+        assert 'node-1' in ret['comment']
+
+
+    def test_deployment_present_unchanged(self):
+        patch_deployment = Mock(return_value={})
+        replace_deployment = Mock()
+        with patch.dict(kubernetes.__salt__, {
+                'mdl_kubernetes.patch_deployment': patch_deployment,
+                'mdl_kubernetes.replace_deployment': replace_deployment}):
+            ret = kubernetes.deployment_present('web', spec={'replicas': 2})
+
+        assert ret['result'] == True
+        assert ret['changes'] == {}
+        assert patch_deployment.call_args[1]['test'] == False
+        replace_deployment.assert_not_called()
+
+
+    def test_deployment_present_reports_diff(self):
+        changes = {'spec.replicas': {'old': 2, 'new': 3}}
+        with patch.dict(kubernetes.__salt__, {
+                'mdl_kubernetes.patch_deployment': Mock(return_value=changes)}):
+            ret = kubernetes.deployment_present('web', spec={'replicas': 3})
+
+        assert ret['result'] == True
+        assert ret['changes'] == changes
+
+
+    def test_deployment_present_creates_missing(self):
+        create_deployment = Mock(return_value={'metadata': {'name': 'web'}})
+        with patch.dict(kubernetes.__salt__, {
+                'mdl_kubernetes.patch_deployment': Mock(return_value=None),
+                'mdl_kubernetes.create_deployment': create_deployment}):
+            ret = kubernetes.deployment_present('web', spec={'replicas': 3})
+
+        assert ret['result'] == True
+        create_deployment.assert_called_once()
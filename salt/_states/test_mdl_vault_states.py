@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+try:
+    from unittest.mock import Mock, patch
+except:
+    from mock import Mock, patch
+
+try:
+    from importlib.util import module_from_spec, spec_from_file_location
+except ImportError:
+    # py2
+    from imp import load_source
+else:
+    def load_source(name, path):
+        spec = spec_from_file_location(name, path)
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+import pytest
+
+
+def _load(name, path):
+    return load_source(name, os.path.join(os.path.dirname(__file__), path))
+
+
+# The execution and utils modules are also called mdl_vault, load these under
+# different names to not clash with them
+mdl_vault = _load('mdl_vault_states', 'mdl_vault.py')
+mdl_vault_utils = _load('mdl_vault_states_utils', '../_utils/mdl_vault.py')
+
+
+POLICY = '''
+path "secret/*" {
+  capabilities = ["read", "list"]
+}
+'''
+
+
+@pytest.fixture
+def vault():
+    policies = {
+        'reader': {'name': 'reader', 'rules': POLICY},
+        'other': {'name': 'other', 'rules': 'path "other/*" {}'},
+    }
+    salt = {
+        'mdl_vault.list_policies': Mock(return_value=list(policies)),
+        'mdl_vault.read_many': Mock(side_effect=lambda paths: {
+            path: policies[path.split('/')[-1]] for path in paths}),
+        'mdl_vault.get_policy': Mock(return_value=None),
+        'mdl_vault.set_policy': Mock(),
+        'mdl_vault.delete_policy': Mock(),
+    }
+    mdl_vault.__salt__ = salt
+    mdl_vault.__utils__ = {
+        'mdl_vault.normalize_policy': mdl_vault_utils.normalize_policy,
+        'mdl_vault.vault_error': mdl_vault_utils.vault_error,
+    }
+    mdl_vault.__opts__ = {'test': False}
+    mdl_vault.__context__ = {}
+    yield salt
+    del mdl_vault.__salt__, mdl_vault.__utils__, mdl_vault.__opts__, mdl_vault.__context__
+
+
+def test_policy_present_ignores_formatting(vault):
+    reformatted = 'path "secret/*" { capabilities = ["read", "list"] }'
+
+    ret = mdl_vault.policy_present('reader', reformatted)
+
+    assert ret['result'] is True
+    assert ret['changes'] == {}
+    vault['mdl_vault.set_policy'].assert_not_called()
+
+
+def test_policy_present_lists_policies_once(vault):
+    for _ in range(3):
+        assert mdl_vault.policy_present('reader', POLICY)['changes'] == {}
+    ret = mdl_vault.policy_present('new', POLICY)
+    mdl_vault.policy_present('new', POLICY)
+
+    assert ret['changes'] == {'old': None, 'new': POLICY}
+    vault['mdl_vault.set_policy'].assert_called_once_with('new', POLICY)
+    vault['mdl_vault.list_policies'].assert_called_once_with()
+    vault['mdl_vault.read_many'].assert_called_once()
+    vault['mdl_vault.get_policy'].assert_not_called()
+
+
+def test_policy_present_updates_changed_policy(vault):
+    ret = mdl_vault.policy_present('reader', {'path': {'secret/*': {'capabilities': ['read']}}})
+
+    assert ret['result'] is True
+    assert ret['changes']['old'] == POLICY
+    vault['mdl_vault.set_policy'].assert_called_once()
+
+
+def test_policy_absent_deletes_once(vault):
+    assert mdl_vault.policy_absent('other')['changes']['old'] == 'path "other/*" {}'
+    assert mdl_vault.policy_absent('other')['changes'] == {}
+
+    vault['mdl_vault.delete_policy'].assert_called_once_with('other')
+
+
+@pytest.fixture
+def mounts(vault):
+    engines = {'secret/': {'type': 'kv'}}
+    vault.update({
+        'mdl_vault.list_secrets_engines': Mock(
+            side_effect=lambda: {'data': dict(engines)}),
+        'mdl_vault.enable_secrets_engine': Mock(
+            side_effect=lambda engine_type, mount_point, **kwargs:
+                engines.update({mount_point + '/': {'type': engine_type}})),
+        'mdl_vault.list_auth_backends': Mock(
+            return_value={'data': {'token/': {'type': 'token'}}}),
+    })
+    return vault
+
+
+def test_secrets_engine_enabled_lists_mounts_once(mounts):
+    for _ in range(3):
+        ret = mdl_vault.secrets_engine_enabled('kv', 'kv', mount_point='secret')
+        assert ret['result'] is True
+    for _ in range(3):
+        assert mdl_vault.auth_backend_enabled('token', 'token')['result'] is True
+
+    assert mounts['mdl_vault.list_secrets_engines'].call_count == 1
+    assert mounts['mdl_vault.list_auth_backends'].call_count == 1
+
+
+def test_secrets_engine_enabled_sees_own_changes(mounts):
+    ret = mdl_vault.secrets_engine_enabled('transit', 'transit', mount_point='transit')
+    assert ret['changes']['transit/']['new'] == {'type': 'transit'}
+
+    ret = mdl_vault.secrets_engine_enabled('transit', 'transit', mount_point='transit')
+
+    assert ret['changes'] == {}
+    mounts['mdl_vault.enable_secrets_engine'].assert_called_once()
+    # Once up front and once after enabling transit
+    assert mounts['mdl_vault.list_secrets_engines'].call_count == 2
+
+
+def test_mounts_are_listed_again_by_the_next_job(mounts):
+    with patch.object(mdl_vault, '_current_jid', Mock(return_value='1')):
+        mdl_vault.secrets_engine_enabled('kv', 'kv', mount_point='secret')
+        mdl_vault.secrets_engine_enabled('kv', 'kv', mount_point='secret')
+    assert mounts['mdl_vault.list_secrets_engines'].call_count == 1
+
+    with patch.object(mdl_vault, '_current_jid', Mock(return_value='2')):
+        mdl_vault.secrets_engine_enabled('kv', 'kv', mount_point='secret')
+    assert mounts['mdl_vault.list_secrets_engines'].call_count == 2
+
+
+@pytest.fixture
+def config(mounts):
+    stored = {
+        'auth/gcp/config': {'data': {'project': 'old', 'ttl': 60}},
+        'auth/gcp/role/app': {'data': {'type': 'iam', 'policies': ['reader']}},
+        'sys/policy/reader': {'rules': POLICY},
+        'sys/policy/other': {'rules': 'path "other/*" {}'},
+    }
+    auths = {'token/': {'type': 'token'}, 'gcp/': {'type': 'gcp'}}
+    mounts.update({
+        'mdl_vault.list_auth_backends': Mock(side_effect=lambda: {'data': dict(auths)}),
+        'mdl_vault.read_many': Mock(side_effect=lambda paths, max_workers=10: {
+            path: stored.get(path) for path in paths}),
+        'mdl_vault.enable_auth_backend': Mock(),
+        'mdl_vault.configure_auth_backend': Mock(),
+        'mdl_vault.configure_auth_backend_role': Mock(),
+        'mdl_vault.write': Mock(),
+        'mdl_pillar.resolve_leaf_values': lambda config: config,
+    })
+    mdl_vault.__utils__['mdl_vault.run_concurrently'] = mdl_vault_utils.run_concurrently
+    return mounts
+
+
+CONFIG = {
+    'policies': {'reader': POLICY, 'writer': 'path "secret/*" {}'},
+    'auth_backends': [{
+        'backend_type': 'gcp',
+        'config': {'project': 'new'},
+        'roles': [{'name': 'app', 'config': {'type': 'iam'}}],
+    }],
+    'secrets_engines': [{
+        'type': 'database',
+        'mount_point': 'db',
+        'roles': [{'name': 'readonly', 'options': {'db_name': 'postgres'}}],
+    }],
+}
+
+
+def test_config_reconciled_test_mode_reports_plan(config):
+    mdl_vault.__opts__['test'] = True
+
+    ret = mdl_vault.config_reconciled('vault', **CONFIG)
+
+    assert ret['result'] is None
+    assert sorted(ret['changes']) == [
+        'auth/gcp/config',
+        'db/roles/readonly',
+        'sys/mounts/db',
+        'sys/policy/writer',
+    ]
+    assert ret['changes']['auth/gcp/config'] == {'project': {'old': 'old', 'new': 'new'}}
+    # Only the config of existing mounts is read
+    config['mdl_vault.read_many'].assert_any_call(
+        ['auth/gcp/config', 'auth/gcp/role/app'], max_workers=10)
+    config['mdl_vault.set_policy'].assert_not_called()
+    config['mdl_vault.enable_secrets_engine'].assert_not_called()
+
+
+def test_config_reconciled_applies_minimal_writes(config):
+    ret = mdl_vault.config_reconciled('vault', **CONFIG)
+
+    assert ret['result'] is True
+    assert len(ret['changes']) == 4
+    config['mdl_vault.set_policy'].assert_called_once_with('writer', 'path "secret/*" {}')
+    config['mdl_vault.enable_secrets_engine'].assert_called_once_with('database',
+        description=None, mount_point='db', options=None)
+    config['mdl_vault.configure_auth_backend'].assert_called_once_with(
+        'gcp', {'project': 'new'})
+    config['mdl_vault.configure_auth_backend_role'].assert_not_called()
+    config['mdl_vault.write'].assert_called_once_with('db/roles/readonly', db_name='postgres')
+
+    assert mdl_vault.config_reconciled('vault', **CONFIG)['changes'] == {
+        'auth/gcp/config': {'project': {'old': 'old', 'new': 'new'}},
+        'db/roles/readonly': {'old': None, 'new': {'db_name': 'postgres'}},
+    }
+
+
+def test_config_reconciled_skips_writes_to_failed_mounts(config):
+    config['mdl_vault.enable_secrets_engine'].side_effect = \
+        mdl_vault_utils.VaultError('mount failed')
+
+    ret = mdl_vault.config_reconciled('vault', **CONFIG)
+
+    assert ret['result'] is False
+    assert 'Skipped db/roles/readonly' in ret['comment']
+    assert 'sys/mounts/db' not in ret['changes']
+    config['mdl_vault.write'].assert_not_called()
+
+
+def test_policies_are_listed_again_by_the_next_job(vault):
+    with patch.object(mdl_vault, '_current_jid', Mock(return_value='1')):
+        mdl_vault.policy_present('reader', POLICY)
+        mdl_vault.policy_present('other', 'path "other/*" {}')
+    assert vault['mdl_vault.list_policies'].call_count == 1
+
+    with patch.object(mdl_vault, '_current_jid', Mock(return_value='2')):
+        mdl_vault.policy_present('reader', POLICY)
+    assert vault['mdl_vault.list_policies'].call_count == 2
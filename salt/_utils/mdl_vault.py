@@ -12,14 +12,25 @@ documented in the execution module docs.
 
 from __future__ import absolute_import, print_function, unicode_literals
 import base64
+import collections
+import hashlib
+import inspect
+import itertools
 import logging
+import math
 import os
+import random
 import requests
 import json
+import struct
+import threading
 import time
-from functools import wraps
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial, wraps
 
 import six
+from requests.adapters import HTTPAdapter
 import salt.crypt
 import salt.exceptions
 import salt.utils.versions
@@ -31,9 +42,22 @@ except ImportError:
     HAS_HCL_PARSER = False
 
 try:
-    from urlparse import urljoin
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    HAS_AESGCM = True
 except ImportError:
-    from urllib.parse import urljoin
+    HAS_AESGCM = False
+
+try:
+    from Cryptodome.Cipher import AES
+    HAS_CRYPTODOME = True
+except ImportError:
+    HAS_CRYPTODOME = False
+
+try:
+    from urlparse import urljoin, urlparse
+except ImportError:
+    from urllib.parse import urljoin, urlparse
 
 log = logging.getLogger(__name__)
 logging.getLogger("requests").setLevel(logging.WARNING)
@@ -41,6 +65,126 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 # Load the __salt__ dunder if not already loaded (when called from utils-module)
 __salt__ = None
 
+# Refresh tokens this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 10
+
+# Vault connection details (url, token, verify) keyed by role and minion id
+_connection_cache = {}
+_connection_cache_lock = threading.Lock()
+_connection_cache_counters = {'hits': 0, 'refreshes': 0}
+
+# Minion tokens the master keeps for rendering pillars, override with
+# vault:token_pool:size and vault:token_pool:refresh_ahead. Tokens are only
+# revoked when they're evicted to make room for other minions, the ones still in
+# the pool when a master worker exits stay valid until they expire. Set
+# vault:token_pool:ttl and vault:token_pool:uses to bound that, which needs a
+# vault.generate_token runner that accepts them (salt 2019.2's doesn't).
+DEFAULT_TOKEN_POOL_SIZE = 2000
+DEFAULT_TOKEN_REFRESH_AHEAD = 60
+_token_pool = None
+_token_pool_lock = threading.Lock()
+
+# Size of the connection pools of the shared session, override with
+# vault:pool_connections and vault:pool_maxsize
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+
+# Number of concurrent requests used by the bulk operations, keep this at or below
+# the pool size to not open connections that will be discarded afterwards
+DEFAULT_MAX_WORKERS = 10
+
+# Transit batch operations are split into requests of at most this many items
+# and roughly this many bytes of input
+DEFAULT_TRANSIT_BATCH_SIZE = 250
+DEFAULT_TRANSIT_BATCH_BYTES = 1024 * 1024
+
+# Url of a path in Vault, bound once since it's built for almost every request
+_path_url = '/v1/{0}'.format
+_LIST_PARAMS = {'list': True}
+
+# Policies normalized by normalize_policy, by the hash of their rules
+MAX_NORMALIZED_POLICIES = 1024
+_normalized_policies = collections.OrderedDict()
+_normalized_policies_lock = threading.Lock()
+
+# Files encrypted with transit_encrypt_stream start with this, followed by the
+# length of the json header, the header and the encrypted chunks
+ENVELOPE_MAGIC = b'MDLVENV1'
+DEFAULT_ENVELOPE_CHUNK_SIZE = 1024 * 1024
+_ENVELOPE_LENGTH = struct.Struct('>I')
+# Whether the chunk is the last one, and the length of the encrypted chunk
+_ENVELOPE_FRAME = struct.Struct('>BI')
+
+
+# How requests that fail because Vault is busy or briefly unavailable are retried,
+# override with vault:retry. 429 and 503 responses are always safe to retry since
+# Vault didn't process the request, the others only for idempotent methods.
+DEFAULT_RETRY_POLICY = {
+    'max_attempts': 4,
+    'backoff_base': 0.5,
+    'backoff_max': 30,
+}
+ALWAYS_RETRY_STATUSES = (429, 503)
+IDEMPOTENT_RETRY_STATUSES = (500, 502, 504)
+IDEMPOTENT_METHODS = ('get', 'head', 'delete')
+
+# Fail fast after this many consecutive failures to reach Vault, until
+# reset_timeout seconds have passed. Override with vault:circuit_breaker.
+DEFAULT_CIRCUIT_BREAKER = {
+    'failure_threshold': 5,
+    'reset_timeout': 30,
+}
+
+# The health endpoint uses 429 and 503 to report standby and sealed nodes, so
+# those responses are answers rather than failures
+NO_RETRY_RESOURCES = ('/v1/sys/health',)
+
+_request_counters = {
+    'requests': 0,
+    'retries': 0,
+    'throttled': 0,
+    'throttled_seconds': 0.0,
+    'circuit_open': 0,
+}
+_request_counters_lock = threading.Lock()
+
+# Per process rate limiter, created from vault:rate_limit on first use
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+# Circuit breakers keyed by the Vault url
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+# How many seconds to keep sending requests straight to the active node of a HA
+# cluster once we've learned it, override with vault:leader_ttl. 0 disables it.
+DEFAULT_LEADER_TTL = 60
+
+# The active node learned from redirects and sys/leader, keyed by the configured
+# Vault url
+_leaders = {}
+_leaders_lock = threading.Lock()
+
+# Functions called with a record of every request made to Vault
+_request_hooks = []
+
+# Requests are aggregated by the first this many segments of their path, like
+# secret/pillar_cache or sys/leases
+PATH_TEMPLATE_DEPTH = 2
+
+# How many latencies to keep per path prefix for the percentiles
+MAX_LATENCY_SAMPLES = 10000
+
+_request_aggregates = {}
+_request_aggregates_lock = threading.Lock()
+_wall_time = {'in_flight': 0, 'started': None, 'seconds': 0.0}
+
+# Details about the request currently being made by this thread
+_request_context = threading.local()
+
 
 def __virtual__():  # pylint: disable=expected-2-blank-lines-found-0
     try:
@@ -53,6 +197,72 @@ def __virtual__():  # pylint: disable=expected-2-blank-lines-found-0
         return False
 
 
+def get_session(pool_connections=None, pool_maxsize=None):
+    '''
+    Get the requests session shared by all Vault calls in this process. Keeping
+    the connections alive in a pool means we only pay for the TLS handshake when
+    a new connection has to be opened, instead of on every request.
+    '''
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            config = __opts__.get('vault', {})
+            if pool_connections is None:
+                pool_connections = config.get('pool_connections',
+                                              DEFAULT_POOL_CONNECTIONS)
+            if pool_maxsize is None:
+                pool_maxsize = config.get('pool_maxsize', DEFAULT_POOL_MAXSIZE)
+            log.debug('Creating Vault session with %d connection pools of size %d',
+                pool_connections, pool_maxsize)
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def run_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS, ordered=True):
+    '''
+    Call func with each of items from a bounded pool of threads, yielding
+    (item, result, error) tuples as the calls finish, where error is the
+    exception raised by the call, if any. Results are yielded in the order of
+    items, or as soon as they are ready if ordered is False.
+
+    Only a couple of items per worker are taken from items at a time, thus it can
+    be a generator that produces more work as results are consumed.
+    '''
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:  # pylint: disable=broad-except
+            return item, None, e
+
+    max_workers = max(1, max_workers)
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = collections.deque(
+        executor.submit(call, item) for item in itertools.islice(items, 2*max_workers))
+    try:
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                finished = wait(pending, return_when=FIRST_COMPLETED)[0]
+                done = [future for future in pending if future in finished]
+                for future in done:
+                    pending.remove(future)
+            for item in itertools.islice(items, len(done)):
+                pending.append(executor.submit(call, item))
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
 def _get_token_and_url_from_master():
     '''
     Get a token with correct policies for the minion, and the url to the Vault
@@ -72,18 +282,41 @@ def _get_token_and_url_from_master():
         result = __salt__['publish.runner'](
             'vault.generate_token', arg=[minion_id, signature])
     else:
-        private_key = '{0}/master.pem'.format(pki_dir)
-        log.debug(
-            'Running on master, signing token request for %s with key %s',
-            minion_id, private_key)
-        signature = base64.b64encode(
-            salt.crypt.sign_message(private_key, minion_id))
-        result = __salt__['saltutil.runner'](
-            'vault.generate_token',
-            minion_id=minion_id,
-            signature=signature,
-            impersonated_by_master=True)
+        return _generate_minion_token(minion_id, __salt__['saltutil.runner'],
+                                      pki_dir)
+    return _token_details(result)
 
+
+def _generate_minion_token(minion_id, runner, pki_dir, ttl=None, uses=None):
+    '''
+    Get a token for minion_id from the vault runner on the master. This doesn't
+    use any dunders, so that the token pool can call it from its own threads.
+    '''
+    private_key = '{0}/master.pem'.format(pki_dir)
+    log.debug(
+        'Running on master, signing token request for %s with key %s',
+        minion_id, private_key)
+    signature = base64.b64encode(
+        salt.crypt.sign_message(private_key, minion_id))
+    kwargs = {}
+    if ttl is not None:
+        kwargs['ttl'] = ttl
+    if uses is not None:
+        kwargs['uses'] = uses
+    result = runner(
+        'vault.generate_token',
+        minion_id=minion_id,
+        signature=signature,
+        impersonated_by_master=True,
+        **kwargs)
+    return _token_details(result)
+
+
+def _token_details(result):
+    '''
+    Check the result of the vault.generate_token runner and turn it into
+    connection details
+    '''
     if not result:
         log.error('Failed to get token from master! No result returned - '
                   'is the peer publish configuration correct?')
@@ -100,10 +333,15 @@ def _get_token_and_url_from_master():
         'url': result['url'],
         'token': result['token'],
         'verify': result['verify'],
+        # Older masters don't tell us the ttl and uses of the token, assume
+        # the runner defaults of no ttl and a single use
+        'lease_duration': result.get('lease_duration'),
+        'issued': result.get('issued', int(time.time())),
+        'uses': result.get('uses', 1),
     }
 
 
-def _get_vault_connection():
+def _fetch_vault_connection():
     '''
     Get the connection details for calling Vault, from local configuration if
     it exists, or from the master otherwise
@@ -111,10 +349,12 @@ def _get_vault_connection():
 
     def _use_local_config():
         log.debug('Using Vault connection details from local config')
+        lease_duration = uses = None
         try:
             if __opts__['vault']['auth']['method'] == 'approle':
                 verify = __opts__['vault'].get('verify', None)
-                if _selftoken_expired():
+                token_info = _lookup_self_token()
+                if token_info is None:
                     log.debug('Vault token expired. Recreating one')
                     # Requesting a short ttl token
                     url = '{0}/v1/auth/approle/login'.format(
@@ -123,16 +363,25 @@ def _get_vault_connection():
                     if 'secret_id' in __opts__['vault']['auth']:
                         payload['secret_id'] = __opts__['vault']['auth'][
                             'secret_id']
-                    response = requests.post(url, json=payload, verify=verify)
+                    response = get_session().post(url, json=payload,
+                                                  verify=verify)
                     if response.status_code != 200:
                         errmsg = 'An error occured while getting a token from approle'
                         raise salt.exceptions.CommandExecutionError(errmsg)
-                    __opts__['vault']['auth']['token'] = response.json()[
-                        'auth']['client_token']
+                    auth = response.json()['auth']
+                    __opts__['vault']['auth']['token'] = auth['client_token']
+                    lease_duration = auth.get('lease_duration')
+                    uses = auth.get('num_uses')
+                else:
+                    lease_duration = token_info.get('ttl')
+                    uses = token_info.get('num_uses')
             return {
                 'url': __opts__['vault']['url'],
                 'token': __opts__['vault']['auth']['token'],
-                'verify': __opts__['vault'].get('verify', None)
+                'verify': __opts__['vault'].get('verify', None),
+                'lease_duration': lease_duration,
+                'issued': int(time.time()),
+                'uses': uses,
             }
         except KeyError as err:
             errmsg = 'Minion has "vault" config section, but could not find key "{0}" within'.format(
@@ -149,49 +398,785 @@ def _get_vault_connection():
         return _get_token_and_url_from_master()
 
 
-def make_request(session, method, resource, **args):
+def _connection_cache_key():
+    return (__opts__.get('__role', 'minion'), __grains__['id'])
+
+
+def _connection_expired(connection):
+    if connection['uses'] is not None and connection['uses'] <= 0:
+        return True
+    if connection['expires'] is not None and connection['expires'] <= time.time():
+        return True
+    return False
+
+
+def _get_vault_connection():
+    '''
+    Get the connection details for calling Vault. These are cached per role and
+    minion id and reused until the token is about to expire or has run out of
+    uses, so that we don't have to go through the master for every request.
+    '''
+    if _use_token_pool():
+        return _get_token_pool().connection(__grains__['id'])
+
+    key = _connection_cache_key()
+    # The lock is held while fetching a new token to prevent concurrent requests
+    # from all asking the master for one at the same time
+    with _connection_cache_lock:
+        connection = _connection_cache.get(key)
+        if connection is not None and not _connection_expired(connection):
+            _connection_cache_counters['hits'] += 1
+            from_cache = True
+        else:
+            log.debug('Refreshing Vault connection details for %s', key)
+            details = _fetch_vault_connection()
+            _connection_cache_counters['refreshes'] += 1
+            from_cache = False
+            expires = None
+            # A lease duration of 0 means the token never expires
+            if details.get('lease_duration'):
+                expires = (details['issued'] + details['lease_duration'] -
+                    TOKEN_EXPIRY_MARGIN)
+            connection = {
+                'url': details['url'],
+                'token': details['token'],
+                'verify': details['verify'],
+                'expires': expires,
+                # Vault uses 0 to signal unlimited uses
+                'uses': details.get('uses') or None,
+                # Shared by every request with this token, never modified
+                'headers': {
+                    'X-Vault-Token': details['token'],
+                    'Content-Type': 'application/json',
+                },
+            }
+            _connection_cache[key] = connection
+
+        if connection['uses'] is not None:
+            connection['uses'] -= 1
+        return {
+            'url': connection['url'],
+            'token': connection['token'],
+            'verify': connection['verify'],
+            'headers': connection['headers'],
+            'from_cache': from_cache,
+        }
+
+
+def invalidate_vault_connection():
+    '''
+    Forget the cached connection details for the current role and minion, forcing
+    a new token to be fetched on the next request.
+    '''
+    if _use_token_pool():
+        _get_token_pool().invalidate(__grains__['id'])
+        return
+    with _connection_cache_lock:
+        _connection_cache.pop(_connection_cache_key(), None)
+
+
+def _revoke_tokens(url, verify, tokens, max_workers=DEFAULT_MAX_WORKERS):
+    '''
+    Revoke tokens, each with itself so no other permissions are needed
+    '''
+    def revoke(token):
+        response = get_session().post(
+            '{0}/v1/auth/token/revoke-self'.format(url),
+            headers={'X-Vault-Token': token}, verify=verify)
+        # Tokens that expired or ran out of uses in the meantime are gone already
+        if response.status_code not in (204, 403):
+            raise VaultError('Revoking token failed with status {0}'.format(
+                response.status_code))
+
+    revoked = 0
+    for _, _, error in run_concurrently(revoke, tokens, max_workers=max_workers,
+                                        ordered=False):
+        if error is not None:
+            log.debug('Failed to revoke evicted minion token: %s', error)
+        else:
+            revoked += 1
+    return revoked
+
+
+class MinionTokenPool(object):
+    '''
+    Tokens the master uses to render pillars on behalf of minions, keyed by
+    minion id. Tokens are reused until they expire or run out of uses, tokens
+    with a ttl are replaced in the background refresh_ahead seconds before they
+    expire, and when there are more than max_size minions the tokens of the
+    least recently used ones are revoked, in bulk.
+
+    fetch is called with a minion id and returns the same details as
+    _fetch_vault_connection, revoke is called with lists of (url, verify, token).
+    '''
+
+    def __init__(self, fetch, revoke, max_size=None, refresh_ahead=None):
+        self.fetch = fetch
+        self.revoke = revoke
+        self.max_size = max_size or DEFAULT_TOKEN_POOL_SIZE
+        self.refresh_ahead = (DEFAULT_TOKEN_REFRESH_AHEAD if refresh_ahead is None
+                              else refresh_ahead)
+        self.tokens = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'fetches': 0, 'refreshes': 0, 'evictions': 0,
+                         'revoked': 0}
+        # Minion ids being fetched, so only one token is fetched per minion at
+        # a time, and those being refreshed in the background
+        self.fetching = {}
+        self.refreshing = set()
+        self.evicted = []
+        self.revoking = False
+        self.executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS)
+
+    def connection(self, minion_id):
+        with self.lock:
+            entry = self._take(minion_id)
+            if entry is None:
+                fetching = self.fetching.setdefault(minion_id, threading.Lock())
+        if entry is not None:
+            return self._connection(entry, from_cache=True)
+
+        with fetching:
+            with self.lock:
+                entry = self._take(minion_id)
+            if entry is None:
+                entry = self._fetch(minion_id)
+                with self.lock:
+                    entry = self._store(minion_id, entry, take=True)
+        with self.lock:
+            if self.fetching.get(minion_id) is fetching:
+                del self.fetching[minion_id]
+        self._revoke_evicted()
+        return self._connection(entry, from_cache=False)
+
+    def invalidate(self, minion_id):
+        with self.lock:
+            self.tokens.pop(minion_id, None)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.tokens)
+        return stats
+
+    def close(self, revoke=True):
+        '''
+        Wait for background work to finish, and revoke all tokens in the pool
+        '''
+        if revoke:
+            with self.lock:
+                while self.tokens:
+                    self._evict(*self.tokens.popitem(last=False))
+            self._revoke_evicted()
+        self.executor.shutdown(wait=True)
+
+    @staticmethod
+    def _connection(entry, from_cache):
+        return {
+            'url': entry['url'],
+            'token': entry['token'],
+            'verify': entry['verify'],
+            'headers': entry['headers'],
+            'from_cache': from_cache,
+        }
+
+    def _fetch(self, minion_id):
+        details = self.fetch(minion_id)
+        expires = None
+        if details.get('lease_duration'):
+            expires = details['issued'] + details['lease_duration'] - TOKEN_EXPIRY_MARGIN
+        return {
+            'url': details['url'],
+            'token': details['token'],
+            'verify': details['verify'],
+            'expires': expires,
+            'uses': details.get('uses') or None,
+            'headers': {
+                'X-Vault-Token': details['token'],
+                'Content-Type': 'application/json',
+            },
+        }
+
+    def _take(self, minion_id):
+        # Called with the lock held
+        entry = self.tokens.get(minion_id)
+        if entry is None:
+            return None
+        if _connection_expired(entry):
+            del self.tokens[minion_id]
+            return None
+        # Mark it as most recently used
+        self.tokens[minion_id] = self.tokens.pop(minion_id)
+        if entry['uses'] is not None:
+            entry['uses'] -= 1
+        self.counters['hits'] += 1
+        if (entry['expires'] is not None and minion_id not in self.refreshing and
+                entry['expires'] - self.refresh_ahead <= time.time()):
+            self.refreshing.add(minion_id)
+            try:
+                self.executor.submit(self._refresh, minion_id)
+            except RuntimeError:
+                # Shut down already
+                self.refreshing.discard(minion_id)
+        return entry
+
+    def _store(self, minion_id, entry, take=False):
+        # Called with the lock held
+        if take:
+            self.counters['fetches'] += 1
+            if entry['uses'] is not None:
+                entry['uses'] -= 1
+        self.tokens.pop(minion_id, None)
+        self.tokens[minion_id] = entry
+        while len(self.tokens) > self.max_size:
+            self._evict(*self.tokens.popitem(last=False))
+        return entry
+
+    def _evict(self, minion_id, entry):
+        # Called with the lock held. Tokens that can't be used anymore don't
+        # need to be revoked.
+        self.counters['evictions'] += 1
+        if not _connection_expired(entry):
+            self.evicted.append((entry['url'], entry['verify'], entry['token']))
+
+    def _refresh(self, minion_id):
+        try:
+            entry = self._fetch(minion_id)
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug('Failed to refresh the Vault token of %s: %s', minion_id, e)
+            with self.lock:
+                self.refreshing.discard(minion_id)
+            return
+        with self.lock:
+            self.refreshing.discard(minion_id)
+            self.counters['refreshes'] += 1
+            # The old token is left to expire, requests might still be using it
+            self._store(minion_id, entry)
+        self._revoke_evicted()
+
+    def _revoke_evicted(self):
+        with self.lock:
+            if not self.evicted or self.revoking:
+                return
+            self.revoking = True
+        try:
+            self.executor.submit(self._revoke_all_evicted)
+        except RuntimeError:
+            # Shut down already, revoke them right here
+            self._revoke_all_evicted()
+
+    def _revoke_all_evicted(self):
+        while True:
+            with self.lock:
+                evicted, self.evicted = self.evicted, []
+                if not evicted:
+                    self.revoking = False
+                    return
+            try:
+                revoked = self.revoke(evicted)
+            except Exception as e:  # pylint: disable=broad-except
+                log.debug('Failed to revoke %d evicted minion tokens: %s',
+                          len(evicted), e)
+                revoked = 0
+            with self.lock:
+                self.counters['revoked'] += revoked
+
+
+def _revoke_pooled_tokens(evicted):
+    revoked = 0
+    by_url = collections.defaultdict(list)
+    for url, verify, token in evicted:
+        by_url[(url, verify)].append(token)
+    for (url, verify), tokens in by_url.items():
+        revoked += _revoke_tokens(url, verify, tokens)
+    return revoked
+
+
+def _use_token_pool():
+    '''
+    Whether to render pillars with tokens for the minions from the token pool,
+    which the master does when vault:token_pool is configured
+    '''
+    return (__opts__.get('__role', 'minion') == 'master' and
+            'token_pool' in __opts__.get('vault', {}) and 'id' in __grains__)
+
+
+def _get_token_pool():
+    global _token_pool
+    with _token_pool_lock:
+        if _token_pool is None:
+            config = __opts__['vault']['token_pool'] or {}
+            fetch = partial(_generate_minion_token,
+                            runner=__salt__['saltutil.runner'],
+                            pki_dir=__opts__['pki_dir'],
+                            ttl=config.get('ttl'),
+                            uses=config.get('uses'))
+            _token_pool = MinionTokenPool(fetch, _revoke_pooled_tokens,
+                max_size=config.get('size'),
+                refresh_ahead=config.get('refresh_ahead'))
+        return _token_pool
+
+
+def token_pool_stats():
+    '''
+    Return how many minion tokens the master's token pool served from the pool,
+    fetched, refreshed in the background, evicted and revoked, and how many it
+    holds. Returns None when the pool isn't used.
+    '''
+    with _token_pool_lock:
+        pool = _token_pool
+    return pool.stats() if pool is not None else None
+
+
+def connection_cache_stats():
+    '''
+    Return the number of requests that reused a cached token and the number of
+    times a new token had to be fetched.
+    '''
+    with _connection_cache_lock:
+        stats = dict(_connection_cache_counters)
+        stats['size'] = len(_connection_cache)
+    return stats
+
+
+def _request_headers(connection, headers):
+    if not headers:
+        return connection['headers']
+    headers = dict(headers)
+    headers.update(connection['headers'])
+    return headers
+
+
+def make_request(session, method, resource, base_url=None, headers=None, **args):
     '''
-    Make a request to Vault
+    Make a request to Vault, to base_url instead of the configured url if given
     '''
 
     connection = _get_vault_connection()
-    token, vault_url = connection['token'], connection['url']
     if 'verify' not in args:
         args['verify'] = connection['verify']
 
-    url = "{0}{1}".format(vault_url, resource)
-    headers = args.pop('headers', {})
-    headers.update({'X-Vault-Token': token, 'Content-Type': 'application/json'})
-    response = session.request(method, url, headers=headers, **args)
+    url = (base_url or connection['url']) + resource
+    _request_context.token_from_cache = connection['from_cache']
+    response = session.request(method, url,
+        headers=_request_headers(connection, headers), **args)
+
+    if response.status_code == 403 and connection['from_cache']:
+        # The token might have been revoked or used up by someone else, retry
+        # once with a fresh one
+        log.debug('Got 403 from Vault with a cached token, refreshing it')
+        invalidate_vault_connection()
+        connection = _get_vault_connection()
+        _request_context.token_from_cache = False
+        response = session.request(method, url,
+            headers=_request_headers(connection, headers), **args)
 
     return response
 
 
-def _selftoken_expired():
+def _count_request(counter, amount=1):
+    with _request_counters_lock:
+        _request_counters[counter] += amount
+
+
+def request_stats(reset=False):
     '''
-    Validate the current token exists and is still valid
+    Return counters for the requests made to Vault by this process: how many
+    were made, how many of those were retries, how often and for how long
+    requests were held back by the rate limit, and how many were rejected
+    because the circuit breaker was open. With reset, the counters are zeroed
+    afterwards.
+    '''
+    with _request_counters_lock:
+        counters = dict(_request_counters)
+        if reset:
+            _request_counters.update(dict.fromkeys(_request_counters, 0))
+    return counters
+
+
+class TokenBucket(object):
+    '''
+    Limit the rate of requests to rate per second, allowing bursts of up to burst
+    requests.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        '''
+        Take a token, returning how long to wait until it may be used.
+        '''
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens are reserved up front, so waiting threads queue up fairly
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self):
+        '''
+        Take a token, sleeping until one is available. Returns how long it slept.
+        '''
+        wait_time = self.reserve()
+        if wait_time:
+            time.sleep(wait_time)
+        return wait_time
+
+
+class CircuitBreaker(object):
+    '''
+    Stop sending requests after failure_threshold consecutive failures, until
+    reset_timeout seconds have passed. Then a single request is let through to
+    check whether Vault is back.
+    '''
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.reset_timeout:
+                # Half open, let this request through and keep the others out
+                # until it finishes
+                self.opened = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened is None:
+                    log.warning('Vault failed %d times in a row, not sending any '
+                                'requests for %ds', self.failures,
+                                self.reset_timeout)
+                self.opened = time.time()
+
+
+def _get_rate_limiter(config):
+    global _rate_limiter  # pylint: disable=global-statement
+    if not config:
+        return None
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = TokenBucket(config['rate'], config.get('burst'))
+        return _rate_limiter
+
+
+def _get_circuit_breaker(url, config):
+    # Only False disables it, None and {} use the defaults
+    if config is False:
+        return None
+    with _circuit_breakers_lock:
+        if url not in _circuit_breakers:
+            config = dict(DEFAULT_CIRCUIT_BREAKER, **(config or {}))
+            _circuit_breakers[url] = CircuitBreaker(config['failure_threshold'],
+                                                    config['reset_timeout'])
+        return _circuit_breakers[url]
+
+
+def _retry_after(headers):
+    '''
+    Get the number of seconds the Retry-After header asks us to wait, if any
+    '''
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    retry_at = parsedate_tz(value)
+    if retry_at is None:
+        return None
+    return max(0.0, mktime_tz(retry_at) - time.time())
+
+
+def register_request_hook(hook):
+    '''
+    Call hook with a dict describing each request made to Vault once it's done,
+    with the keys method, path (the path template the request is aggregated
+    under), status (None if no response was received), latency (seconds,
+    including retries), bytes, retries, token_from_cache and error.
+    '''
+    if hook not in _request_hooks:
+        _request_hooks.append(hook)
+
+
+def unregister_request_hook(hook):
+    if hook in _request_hooks:
+        _request_hooks.remove(hook)
+
+
+def _path_template(resource):
+    '''
+    Get the path to aggregate a request for resource under, which is the first
+    segments of the path with the rest replaced by *
+    '''
+    path = resource.split('?', 1)[0]
+    if path.startswith('/v1/'):
+        path = path[len('/v1/'):]
+    segments = path.strip('/').split('/', PATH_TEMPLATE_DEPTH)
+    if len(segments) > PATH_TEMPLATE_DEPTH:
+        segments[PATH_TEMPLATE_DEPTH] = '*'
+    return '/'.join(segments)
+
+
+def _request_started():
+    with _request_aggregates_lock:
+        if not _wall_time['in_flight']:
+            _wall_time['started'] = time.time()
+        _wall_time['in_flight'] += 1
+
+
+def _request_finished(record):
+    with _request_aggregates_lock:
+        _wall_time['in_flight'] -= 1
+        if not _wall_time['in_flight']:
+            _wall_time['seconds'] += time.time() - _wall_time['started']
+        aggregate = _request_aggregates.get(record['path'])
+        if aggregate is None:
+            aggregate = _request_aggregates[record['path']] = {
+                'count': 0,
+                'errors': 0,
+                'retries': 0,
+                'bytes': 0,
+                'total_seconds': 0.0,
+                'latencies': collections.deque(maxlen=MAX_LATENCY_SAMPLES),
+            }
+        aggregate['count'] += 1
+        aggregate['retries'] += record['retries']
+        aggregate['bytes'] += record['bytes']
+        aggregate['total_seconds'] += record['latency']
+        aggregate['latencies'].append(record['latency'])
+        if record['error'] is not None or (record['status'] or 0) >= 400:
+            aggregate['errors'] += 1
+
+    for hook in list(_request_hooks):
+        try:
+            hook(record)
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug('Vault request hook %r failed: %s', hook, e)
+
+
+def _percentile(ordered, percent):
+    # Nearest rank
+    if not ordered:
+        return None
+    rank = max(1, int(math.ceil(percent / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def stats(reset=False):
+    '''
+    Return aggregates for the requests made to Vault by this process, per path
+    prefix with p50/p95/p99 latencies, along with the total wall time spent
+    waiting on Vault and the request and connection cache counters. With reset,
+    the aggregates and request counters are cleared afterwards, the connection
+    cache counters describe the cache and are kept.
+    '''
+    with _request_aggregates_lock:
+        prefixes = {}
+        for path, aggregate in _request_aggregates.items():
+            latencies = sorted(aggregate['latencies'])
+            prefixes[path] = {
+                'count': aggregate['count'],
+                'errors': aggregate['errors'],
+                'retries': aggregate['retries'],
+                'bytes': aggregate['bytes'],
+                'total_seconds': round(aggregate['total_seconds'], 6),
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'p99': _percentile(latencies, 99),
+            }
+        wall_seconds = _wall_time['seconds']
+        if _wall_time['in_flight']:
+            wall_seconds += time.time() - _wall_time['started']
+        if reset:
+            _request_aggregates.clear()
+            _wall_time['seconds'] = 0.0
+    return {
+        'prefixes': prefixes,
+        'wall_seconds': round(wall_seconds, 6),
+        'requests': request_stats(reset=reset),
+        'connection_cache': connection_cache_stats(),
+    }
+
+
+def send_stats_event(tag='vault/stats', reset=True):
+    '''
+    Send the request aggregates as an event and return them, by default clearing
+    them so the next event only covers what happened since. Call this at the end
+    of a run, atexit handlers don't run in salt's job processes. Nothing is sent
+    when no requests were made.
+    '''
+    ret = stats(reset=reset)
+    if ret['prefixes']:
+        __salt__['event.send'](tag, data=ret)
+    return ret
+
+
+def _remember_leader(url, leader_url, ttl):
+    '''
+    Send requests for the Vault at url to leader_url for the next ttl seconds
+    '''
+    if not ttl:
+        return
+    leader_url = leader_url.rstrip('/')
+    with _leaders_lock:
+        _leaders[url] = {
+            'url': leader_url,
+            'expires': time.time() + ttl,
+        }
+    log.debug('Sending requests for %s to the active node %s for %ds',
+              url, leader_url, ttl)
+
+
+def _forget_leader(url):
+    with _leaders_lock:
+        _leaders.pop(url, None)
+
+
+def _optional_params(params, **optional):
+    '''
+    Add the optional parameters that are set to params
+    '''
+    for key, value in optional.items():
+        if value is not None:
+            params[key] = value
+    return params
+
+
+def _chunk_batch(items, max_items, max_bytes):
+    '''
+    Split items into lists of at most max_items items, which also stay below
+    max_bytes of string values unless a single item is larger than that
+    '''
+    chunk = []
+    size = 0
+    for item in items:
+        item_size = sum(len(value) for value in item.values()
+                        if isinstance(value, six.string_types))
+        if chunk and (len(chunk) >= max_items or size + item_size > max_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        yield chunk
+
+
+def _should_retry(method, status_code=None):
+    '''
+    Whether a request that got status_code, or no response at all if None,
+    should be retried
+    '''
+    idempotent = method.lower() in IDEMPOTENT_METHODS
+    if status_code is None:
+        return idempotent
+    return (status_code in ALWAYS_RETRY_STATUSES or
+            idempotent and status_code in IDEMPOTENT_RETRY_STATUSES)
+
+
+def _backoff_delay(policy, attempt, retry_after=None):
+    '''
+    How long to wait before the next attempt. Exponential backoff with full
+    jitter, so minions that failed at the same time don't all come back at the
+    same time, unless Vault told us how long to wait.
+    '''
+    if retry_after is not None:
+        return min(policy['backoff_max'], retry_after)
+    return random.uniform(0, min(policy['backoff_max'],
+                                 policy['backoff_base'] * 2 ** (attempt - 1)))
+
+
+def _retry_policy(retry):
+    policy = dict(DEFAULT_RETRY_POLICY, **(retry or {}))
+    if retry is False:
+        policy['max_attempts'] = 1
+    return policy
+
+
+def _raise_error(status_code, message=None, errors=None, data=None):
+    if status_code == 400:
+        raise InvalidRequest(message, errors=errors, data=data)
+    elif status_code == 401:
+        raise Unauthorized(message, errors=errors, data=data)
+    elif status_code == 403:
+        raise Forbidden(message, errors=errors, data=data)
+    elif status_code == 404:
+        raise InvalidPath(message, errors=errors, data=data)
+    elif status_code == 429:
+        raise RateLimitExceeded(message, errors=errors, data=data)
+    elif status_code == 500:
+        raise InternalServerError(message, errors=errors, data=data)
+    elif status_code == 501:
+        raise VaultNotInitialized(message, errors=errors, data=data)
+    elif status_code == 503:
+        raise VaultDown(message, errors=errors, data=data)
+    else:
+        raise UnexpectedError(message, data=data)
+
+
+def _error_message(method, url, status_code, text):
+    return 'Minion got vault error trying %s %s: %s (%s)' % (
+        method.upper(), url, status_code, text)
+
+
+def _lookup_self_token():
+    '''
+    Look up the configured token, returning its data if it exists and is still
+    valid, or None otherwise
     '''
     try:
         verify = __opts__['vault'].get('verify', None)
         url = '{0}/v1/auth/token/lookup-self'.format(__opts__['vault']['url'])
         if 'token' not in __opts__['vault']['auth']:
-            return True
+            return None
         headers = {'X-Vault-Token': __opts__['vault']['auth']['token']}
-        response = requests.get(url, headers=headers, verify=verify)
+        response = get_session().get(url, headers=headers, verify=verify)
         if response.status_code != 200:
-            return True
-        return False
+            return None
+        return response.json().get('data', {})
     except Exception as e:
         raise salt.exceptions.CommandExecutionError(
             'Error while looking up self token : {0}'.format(e))
 
 
+def _selftoken_expired():
+    '''
+    Validate the current token exists and is still valid
+    '''
+    return _lookup_self_token() is None
+
+
 class VaultError(Exception):
-    def __init__(self, message=None, errors=None):
+    def __init__(self, message=None, errors=None, data=None):
         if errors:
             message = '%s (errors=%s)' % (message, ', '.join(errors))
 
         self.errors = errors or []
+        # The decoded response body, if any
+        self.data = data
 
         super(VaultError, self).__init__(message)
 
@@ -241,14 +1226,27 @@ class VaultClient(object):
                  timeout=30,
                  proxies=None,
                  allow_redirects=True,
-                 session=None):
+                 session=None,
+                 pool_connections=None,
+                 pool_maxsize=None,
+                 retry=None,
+                 rate_limit=None,
+                 circuit_breaker=None,
+                 leader_ttl=DEFAULT_LEADER_TTL):
 
         if not session:
-            session = requests.Session()
+            session = get_session(pool_connections, pool_maxsize)
         self.allow_redirects = allow_redirects
         self.session = session
         self.token = token
 
+        # retry and circuit_breaker can be set to False to disable them, the
+        # rate limit is only applied when configured
+        self.retry_policy = _retry_policy(retry)
+        self.rate_limiter = _get_rate_limiter(rate_limit)
+        self.circuit_breaker = _get_circuit_breaker(url, circuit_breaker)
+        self.leader_ttl = leader_ttl
+
         self._url = url
         self._kwargs = {
             'cert': cert,
@@ -259,23 +1257,81 @@ class VaultClient(object):
             self._kwargs['verify'] = verify
 
 
+    def discover_leader(self):
+        """
+        GET /sys/leader
+
+        Look up the active node of a HA cluster and send requests straight to it
+        for the next leader_ttl seconds. Returns the address of the active node,
+        or None if Vault isn't running in HA mode.
+        """
+        leader = self._get('/v1/sys/leader', _leader=False).json()
+        if not leader.get('ha_enabled') or not leader.get('leader_address'):
+            self.forget_leader()
+            return None
+        self._remember_leader(leader['leader_address'])
+        return leader['leader_address']
+
+    def forget_leader(self):
+        """
+        Go back to sending requests to the configured url.
+        """
+        _forget_leader(self._url)
+
+    def _remember_leader(self, leader_url):
+        _remember_leader(self._url, leader_url, self.leader_ttl)
+
+    def _leader_url(self):
+        if not self.leader_ttl:
+            return None
+        with _leaders_lock:
+            leader = _leaders.get(self._url)
+        if leader is None:
+            return None
+        if leader['expires'] > time.time():
+            return leader['url']
+        # We know this is a HA cluster, so look up the active node again instead
+        # of waiting to be redirected to it
+        try:
+            return self.discover_leader()
+        except (VaultError, requests.RequestException) as e:
+            log.debug('Failed to look up the active Vault node: %s', e)
+            self.forget_leader()
+            return None
+
     def read(self, path, wrap_ttl=None):
         """
         GET /<path>
         """
         try:
             log.trace('Reading vault data from %s', path)
-            return self._get('/v1/{0}'.format(path), wrap_ttl=wrap_ttl).json()
+            return self._get(_path_url(path), wrap_ttl=wrap_ttl).json()
         except InvalidPath:
             return None
 
+    def read_many(self, paths, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        GET /<path> for each of paths, with up to max_workers requests in flight
+
+        Returns a dict mapping each path to the result of reading it, or to
+        {'error': <message>} if the read failed.
+        """
+        results = {}
+        for path, result, error in run_concurrently(self.read, paths,
+                max_workers=max_workers, ordered=False):
+            if error is not None:
+                log.debug('Failed to read %s: %s', path, error)
+                results[path] = {'error': str(error)}
+            else:
+                results[path] = result
+        return results
+
     def list(self, path):
         """
         GET /<path>?list=true
         """
         try:
-            payload = {'list': True}
-            return self._get('/v1/{}'.format(path), params=payload).json()
+            return self._get(_path_url(path), params=_LIST_PARAMS).json()
         except InvalidPath:
             return None
 
@@ -289,7 +1345,7 @@ class VaultClient(object):
                     kwargs[k] = v.replace(r'\n', '\n')
 
         response = self._put(
-            '/v1/{0}'.format(path), json=kwargs, wrap_ttl=wrap_ttl)
+            _path_url(path), json=kwargs, wrap_ttl=wrap_ttl)
 
         if response.status_code == 200:
             return response.json()
@@ -304,7 +1360,7 @@ class VaultClient(object):
                     kwargs[k] = v.replace(r'\n', '\n')
 
         response = self._post(
-            '/v1/{0}'.format(path), json=kwargs, wrap_ttl=wrap_ttl)
+            _path_url(path), json=kwargs, wrap_ttl=wrap_ttl)
 
         if response.status_code == 200:
             return response.json()
@@ -313,7 +1369,7 @@ class VaultClient(object):
         """
         DELETE /<path>
         """
-        self._delete('/v1/{0}'.format(path))
+        self._delete(_path_url(path))
 
     def unwrap(self, token):
         """
@@ -1283,19 +2339,9 @@ class VaultClient(object):
         POST /<mount_point>/encrypt/<name>
         """
         url = '/v1/{0}/encrypt/{1}'.format(mount_point, name)
-        params = {'plaintext': plaintext}
-        if context is not None:
-            params['context'] = context
-        if key_version is not None:
-            params['key_version'] = key_version
-        if nonce is not None:
-            params['nonce'] = nonce
-        if batch_input is not None:
-            params['batch_input'] = batch_input
-        if key_type is not None:
-            params['type'] = key_type
-        if convergent_encryption is not None:
-            params['convergent_encryption'] = convergent_encryption
+        params = _optional_params({'plaintext': plaintext}, context=context,
+            key_version=key_version, nonce=nonce, batch_input=batch_input,
+            type=key_type, convergent_encryption=convergent_encryption)
 
         return self._post(url, json=params).json()
 
@@ -1310,13 +2356,8 @@ class VaultClient(object):
         POST /<mount_point>/decrypt/<name>
         """
         url = '/v1/{0}/decrypt/{1}'.format(mount_point, name)
-        params = {'ciphertext': ciphertext}
-        if context is not None:
-            params['context'] = context
-        if nonce is not None:
-            params['nonce'] = nonce
-        if batch_input is not None:
-            params['batch_input'] = batch_input
+        params = _optional_params({'ciphertext': ciphertext}, context=context,
+            nonce=nonce, batch_input=batch_input)
 
         return self._post(url, json=params).json()
 
@@ -1332,18 +2373,109 @@ class VaultClient(object):
         POST /<mount_point>/rewrap/<name>
         """
         url = '/v1/{0}/rewrap/{1}'.format(mount_point, name)
-        params = {'ciphertext': ciphertext}
-        if context is not None:
-            params['context'] = context
-        if key_version is not None:
-            params['key_version'] = key_version
-        if nonce is not None:
-            params['nonce'] = nonce
-        if batch_input is not None:
-            params['batch_input'] = batch_input
+        params = _optional_params({'ciphertext': ciphertext}, context=context,
+            key_version=key_version, nonce=nonce, batch_input=batch_input)
 
         return self._post(url, json=params).json()
 
+    def transit_encrypt_batch(self,
+                              name,
+                              plaintexts,
+                              context=None,
+                              key_version=None,
+                              key_type=None,
+                              convergent_encryption=None,
+                              mount_point='transit',
+                              batch_size=DEFAULT_TRANSIT_BATCH_SIZE,
+                              batch_max_bytes=DEFAULT_TRANSIT_BATCH_BYTES,
+                              max_workers=DEFAULT_MAX_WORKERS):
+        """
+        POST /<mount_point>/encrypt/<name> with batch_input
+
+        Encrypt each of plaintexts, which are base64 encoded strings or batch
+        input items, in chunks of at most batch_size items sent concurrently.
+        Yields the result for each plaintext in order, which has an error key
+        instead of the ciphertext if that one failed.
+        """
+        return self._transit_batch('encrypt', name, plaintexts, 'plaintext',
+            mount_point, batch_size, batch_max_bytes, max_workers,
+            item_params=_optional_params({}, context=context),
+            params=_optional_params({}, key_version=key_version, type=key_type,
+                convergent_encryption=convergent_encryption))
+
+    def transit_decrypt_batch(self,
+                              name,
+                              ciphertexts,
+                              context=None,
+                              mount_point='transit',
+                              batch_size=DEFAULT_TRANSIT_BATCH_SIZE,
+                              batch_max_bytes=DEFAULT_TRANSIT_BATCH_BYTES,
+                              max_workers=DEFAULT_MAX_WORKERS):
+        """
+        POST /<mount_point>/decrypt/<name> with batch_input
+
+        Decrypt each of ciphertexts like transit_encrypt_batch encrypts.
+        """
+        return self._transit_batch('decrypt', name, ciphertexts, 'ciphertext',
+            mount_point, batch_size, batch_max_bytes, max_workers,
+            item_params=_optional_params({}, context=context))
+
+    def transit_rewrap_batch(self,
+                             name,
+                             ciphertexts,
+                             context=None,
+                             key_version=None,
+                             mount_point='transit',
+                             batch_size=DEFAULT_TRANSIT_BATCH_SIZE,
+                             batch_max_bytes=DEFAULT_TRANSIT_BATCH_BYTES,
+                             max_workers=DEFAULT_MAX_WORKERS):
+        """
+        POST /<mount_point>/rewrap/<name> with batch_input
+
+        Rewrap each of ciphertexts with the latest, or the given, version of the
+        key like transit_encrypt_batch encrypts.
+        """
+        return self._transit_batch('rewrap', name, ciphertexts, 'ciphertext',
+            mount_point, batch_size, batch_max_bytes, max_workers,
+            item_params=_optional_params({}, context=context),
+            params=_optional_params({}, key_version=key_version))
+
+    def _transit_batch(self, operation, name, items, item_key, mount_point,
+                       batch_size, batch_max_bytes, max_workers, item_params=None,
+                       params=None):
+        url = '/v1/{0}/{1}/{2}'.format(mount_point, operation, name)
+
+        def batch_items():
+            for item in items:
+                if not isinstance(item, dict):
+                    item = dict(item_params or {}, **{item_key: item})
+                yield item
+
+        def send(chunk):
+            payload = dict(params or {}, batch_input=chunk)
+            try:
+                results = self._post(url, json=payload).json()['data']['batch_results']
+            except InvalidRequest as e:
+                # Vault responds with 400 when any of the items failed, but
+                # still has the results for all of them
+                results = ((e.data or {}).get('data') or {}).get('batch_results')
+                if not results:
+                    raise
+            if len(results) != len(chunk):
+                raise UnexpectedError('Got %d results for a batch of %d items' % (
+                    len(results), len(chunk)))
+            return results
+
+        chunks = _chunk_batch(batch_items(), batch_size, batch_max_bytes)
+        for chunk, results, error in run_concurrently(send, chunks,
+                max_workers=max_workers):
+            if error is not None:
+                log.debug('Failed to %s a batch of %d items with %s: %s',
+                          operation, len(chunk), name, error)
+                results = [{'error': str(error)} for _ in chunk]
+            for result in results:
+                yield result
+
     def transit_generate_data_key(self,
                                   name,
                                   key_type,
@@ -1355,13 +2487,7 @@ class VaultClient(object):
         POST /<mount_point>/datakey/<type>/<name>
         """
         url = '/v1/{0}/datakey/{1}/{2}'.format(mount_point, key_type, name)
-        params = {}
-        if context is not None:
-            params['context'] = context
-        if nonce is not None:
-            params['nonce'] = nonce
-        if bits is not None:
-            params['bits'] = bits
+        params = _optional_params({}, context=context, nonce=nonce, bits=bits)
 
         return self._post(url, json=params).json()
 
@@ -1478,9 +2604,13 @@ class VaultClient(object):
 
     def close(self):
         """
-        Close the underlying Requests session
+        Close the underlying Requests session, unless it's the one shared by all
+        clients in this process, which keeps its connections alive for the others
         """
-        self.session.close()
+        with _session_lock:
+            shared = self.session is _session
+        if not shared:
+            self.session.close()
 
     def _get(self, url, **kwargs):
         return self.__request('get', url, **kwargs)
@@ -1494,60 +2624,150 @@ class VaultClient(object):
     def _delete(self, url, **kwargs):
         return self.__request('delete', url, **kwargs)
 
-    def __request(self, method, url, headers=None, **kwargs):
-        if not headers:
-            headers = {}
-
-        if self.token:
-            headers['X-Vault-Token'] = self.token
-
-        wrap_ttl = kwargs.pop('wrap_ttl', None)
-        if wrap_ttl:
-            headers['X-Vault-Wrap-TTL'] = str(wrap_ttl)
-
-        _kwargs = self._kwargs.copy()
-        _kwargs.update(kwargs)
+    def __request(self, method, url, headers=None, wrap_ttl=None, _leader=True,
+                  **kwargs):
+        # Most requests have no headers or arguments of their own, those share
+        # the ones built up front instead of copying them
+        if self.token or wrap_ttl:
+            headers = dict(headers or ())
+            if self.token:
+                headers['X-Vault-Token'] = self.token
+            if wrap_ttl:
+                headers['X-Vault-Wrap-TTL'] = str(wrap_ttl)
+
+        use_leader = _leader
+        if kwargs:
+            _kwargs = dict(self._kwargs, **kwargs)
+        else:
+            _kwargs = self._kwargs
 
-        response = make_request(self.session, method, url, headers=headers,
-            allow_redirects=False, **_kwargs)
+        base_url = self._leader_url() if use_leader else None
+        response = self.__send(method, url, headers, _kwargs, base_url,
+                               fallback=True)
 
         # NOTE(ianunruh): workaround for https://github.com/ianunruh/hvac/issues/51
+        # Standby nodes redirect to the active node, remember it to skip the
+        # redirect next time
         while response.is_redirect and self.allow_redirects:
-            url = urljoin(self._url, response.headers['Location'])
-            response = make_request(self.session, method, url, headers=headers,
-                allow_redirects=False, **_kwargs)
+            location = urlparse(urljoin(base_url or self._url,
+                                        response.headers['Location']))
+            base_url = '{0}://{1}'.format(location.scheme, location.netloc)
+            if use_leader:
+                self._remember_leader(base_url)
+            url = location.path
+            if location.query:
+                # Some callers put the query string in the url rather than in
+                # params, the Location has both
+                url = '{0}?{1}'.format(url, location.query)
+                if 'params' in _kwargs:
+                    _kwargs = dict(_kwargs)
+                    del _kwargs['params']
+            response = self.__send(method, url, headers, _kwargs, base_url)
 
         if response.status_code >= 400 and response.status_code < 600:
-            text = errors = None
+            text = errors = data = None
             if response.headers.get('Content-Type') == 'application/json':
-                errors = response.json().get('errors')
+                data = response.json()
+                errors = data.get('errors')
             if errors is None:
                 text = response.text
-            message = 'Minion got vault error trying %s %s: %s (%s)' % (
-                method.upper(), url, response.status_code, text)
-            self.__raise_error(response.status_code, message, errors=errors)
+            message = _error_message(method, url, response.status_code, text)
+            _raise_error(response.status_code, message, errors=errors, data=data)
 
         return response
 
-    def __raise_error(self, status_code, message=None, errors=None):
-        if status_code == 400:
-            raise InvalidRequest(message, errors=errors)
-        elif status_code == 401:
-            raise Unauthorized(message, errors=errors)
-        elif status_code == 403:
-            raise Forbidden(message, errors=errors)
-        elif status_code == 404:
-            raise InvalidPath(message, errors=errors)
-        elif status_code == 429:
-            raise RateLimitExceeded(message, errors=errors)
-        elif status_code == 500:
-            raise InternalServerError(message, errors=errors)
-        elif status_code == 501:
-            raise VaultNotInitialized(message, errors=errors)
-        elif status_code == 503:
-            raise VaultDown(message, errors=errors)
-        else:
-            raise UnexpectedError(message)
+    def __send(self, method, url, headers, kwargs, base_url=None, fallback=False):
+        """
+        Make the request, recording how it went for the request hooks and stats
+        """
+        record = {
+            'method': method.upper(),
+            'path': _path_template(url),
+            'status': None,
+            'latency': None,
+            'bytes': 0,
+            'retries': 0,
+            'token_from_cache': None,
+            'error': None,
+        }
+        _request_context.token_from_cache = None
+        started = time.time()
+        _request_started()
+        try:
+            response = self.__send_with_retries(method, url, headers, kwargs,
+                                                base_url, fallback, record)
+            record['status'] = response.status_code
+            record['bytes'] = len(response.content or b'')
+            return response
+        except Exception as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            record['latency'] = time.time() - started
+            record['token_from_cache'] = _request_context.token_from_cache
+            _request_finished(record)
+
+    def __send_with_retries(self, method, url, headers, kwargs, base_url, fallback,
+                            record):
+        """
+        Make the request, retrying it according to the retry policy when Vault is
+        busy or briefly unavailable. With fallback set, base_url is the
+        remembered active node, which is forgotten if it can't be reached.
+        """
+        policy = self.retry_policy
+        retryable = url not in NO_RETRY_RESOURCES
+        circuit_breaker = self.circuit_breaker if retryable else None
+        attempt = 1
+        while True:
+            if circuit_breaker and not circuit_breaker.allow_request():
+                _count_request('circuit_open')
+                raise VaultDown('Not sending %s %s, Vault failed too many times in '
+                                'a row' % (method.upper(), url))
+            if self.rate_limiter:
+                throttled = self.rate_limiter.acquire()
+                if throttled:
+                    _count_request('throttled')
+                    _count_request('throttled_seconds', throttled)
+
+            _count_request('requests')
+            response = error = None
+            try:
+                response = make_request(self.session, method, url, headers=headers,
+                    allow_redirects=False, base_url=base_url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if isinstance(error, requests.ConnectionError) and base_url and fallback:
+                log.info('Failed to connect to the active Vault node %s, falling '
+                         'back to %s: %s', base_url, self._url, error)
+                self.forget_leader()
+                base_url = None
+                fallback = False
+                continue
+
+            if error is not None or response.status_code >= 500:
+                if circuit_breaker:
+                    circuit_breaker.record_failure()
+            elif circuit_breaker and response.status_code != 429:
+                circuit_breaker.record_success()
+
+            should_retry = _should_retry(
+                method, response.status_code if error is None else None)
+            if not retryable or not should_retry or attempt >= policy['max_attempts']:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = _backoff_delay(policy, attempt, _retry_after(response.headers)
+                                   if response is not None else None)
+            log.info('Retrying %s %s in %.1fs after %s (attempt %d of %d)',
+                     method.upper(), url, delay,
+                     error if error is not None else response.status_code,
+                     attempt, policy['max_attempts'])
+            _count_request('retries')
+            record['retries'] += 1
+            time.sleep(delay)
+            attempt += 1
 
 
 def cache_client(client_builder):
@@ -1560,6 +2780,42 @@ def cache_client(client_builder):
     return get_client
 
 
+def normalize_policy(rules):
+    '''
+    Return policy rules, given as HCL or JSON text or as a dict, in a canonical
+    form so that policies only compare unequal when they differ in more than
+    formatting. Parsed rules are cached by the hash of the text, since the same
+    policies are compared on every state run.
+    '''
+    if rules is None:
+        return None
+    if isinstance(rules, dict):
+        return json.dumps(rules, sort_keys=True)
+
+    digest = hashlib.sha256(rules.encode('utf-8')).hexdigest()
+    with _normalized_policies_lock:
+        if digest in _normalized_policies:
+            # Mark it as most recently used
+            normalized = _normalized_policies.pop(digest)
+            _normalized_policies[digest] = normalized
+            return normalized
+
+    normalized = None
+    if HAS_HCL_PARSER:
+        try:
+            normalized = json.dumps(hcl.loads(rules), sort_keys=True)
+        except Exception as e:  # pylint: disable=broad-except
+            log.debug('Failed to parse policy, comparing it as text: %s', e)
+    if normalized is None:
+        normalized = ' '.join(rules.split())
+
+    with _normalized_policies_lock:
+        _normalized_policies[digest] = normalized
+        while len(_normalized_policies) > MAX_NORMALIZED_POLICIES:
+            _normalized_policies.popitem(last=False)
+    return normalized
+
+
 @cache_client
 def build_client(url='https://localhost:8200',
                  token=None,
@@ -1568,7 +2824,13 @@ def build_client(url='https://localhost:8200',
                  timeout=30,
                  proxies=None,
                  allow_redirects=True,
-                 session=None):
+                 session=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 retry=None,
+                 rate_limit=None,
+                 circuit_breaker=None,
+                 leader_ttl=DEFAULT_LEADER_TTL):
     client_kwargs = locals()
     for k, v in client_kwargs.items():
         if k.startswith('_'):
@@ -1610,7 +2872,11 @@ def bind_client(unbound_function):
         ignore_invalid = filtered_kwargs.pop('ignore_invalid', None)
         client = build_client()
         try:
-            return unbound_function(client, *args, **filtered_kwargs)
+            result = unbound_function(client, *args, **filtered_kwargs)
+            # Streaming methods can't be returned from execution modules as is
+            if inspect.isgenerator(result):
+                result = list(result)
+            return result
         except InvalidRequest:
             if ignore_invalid:
                 return None
@@ -1664,3 +2930,147 @@ def wait_after_init(client, retries=5):
             break
         retries -= 1
         time.sleep(1)
+
+
+def _read_full(source, size):
+    '''
+    Read size bytes from source, or less only at the end of it. Pipes can return
+    less than asked for before that.
+    '''
+    data = source.read(size)
+    while data and len(data) < size:
+        more = source.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _envelope_nonce(index):
+    # Every file has its own data key, so a counter is a safe nonce
+    return struct.pack('>4xQ', index)
+
+
+def _envelope_aad(header, index, final):
+    # Binds each chunk to the header and its position, so chunks can't be
+    # reordered or dropped, and the file can't be truncated
+    return header + struct.pack('>QB', index, final)
+
+
+def _aes_gcm_encrypt(key, nonce, plaintext, aad):
+    if HAS_AESGCM:
+        return AESGCM(key).encrypt(nonce, plaintext, aad)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return ciphertext + tag
+
+
+def _aes_gcm_decrypt(key, nonce, ciphertext, aad):
+    tampered = salt.exceptions.CommandExecutionError(
+        'Encrypted file is corrupt or has been tampered with')
+    if HAS_AESGCM:
+        try:
+            return AESGCM(key).decrypt(nonce, ciphertext, aad)
+        except InvalidTag:
+            raise tampered
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    try:
+        return cipher.decrypt_and_verify(ciphertext[:-16], ciphertext[-16:])
+    except ValueError:
+        raise tampered
+
+
+def transit_encrypt_stream(client, name, source, destination, context=None,
+                           mount_point='transit',
+                           chunk_size=DEFAULT_ENVELOPE_CHUNK_SIZE):
+    '''
+    Encrypt everything read from the file object source into destination with
+    a data key generated by the transit key name. Only the data key is sent to
+    Vault, the data is encrypted locally with AES-GCM one chunk at a time, so
+    memory use doesn't depend on the size of the source. The data key is stored
+    wrapped by the transit key in the header of the output.
+
+    Returns the number of bytes encrypted.
+    '''
+    if not HAS_AESGCM and not HAS_CRYPTODOME:
+        raise salt.exceptions.CommandExecutionError(
+            'Encrypting streams requires the cryptography or pycryptodomex library')
+
+    data_key = client.transit_generate_data_key(name, 'plaintext', context=context,
+        bits=256, mount_point=mount_point)['data']
+    key = base64.b64decode(data_key['plaintext'])
+    header = json.dumps({
+        'version': 1,
+        'key': name,
+        'mount_point': mount_point,
+        'context': context,
+        'wrapped_key': data_key['ciphertext'],
+        'chunk_size': chunk_size,
+    }, sort_keys=True).encode('utf-8')
+    destination.write(ENVELOPE_MAGIC + _ENVELOPE_LENGTH.pack(len(header)) + header)
+
+    total = 0
+    index = 0
+    chunk = _read_full(source, chunk_size)
+    while True:
+        # Read ahead to know whether this is the last chunk
+        next_chunk = _read_full(source, chunk_size) if len(chunk) == chunk_size else b''
+        final = not next_chunk
+        encrypted = _aes_gcm_encrypt(key, _envelope_nonce(index), chunk,
+                                     _envelope_aad(header, index, final))
+        destination.write(_ENVELOPE_FRAME.pack(final, len(encrypted)) + encrypted)
+        total += len(chunk)
+        if final:
+            return total
+        chunk = next_chunk
+        index += 1
+
+
+def transit_decrypt_stream(client, source, destination):
+    '''
+    Decrypt what transit_encrypt_stream wrote to source into destination, with a
+    single call to Vault to unwrap the data key.
+
+    Returns the number of bytes decrypted.
+    '''
+    if not HAS_AESGCM and not HAS_CRYPTODOME:
+        raise salt.exceptions.CommandExecutionError(
+            'Decrypting streams requires the cryptography or pycryptodomex library')
+
+    truncated = salt.exceptions.CommandExecutionError('Encrypted file is truncated')
+    if _read_full(source, len(ENVELOPE_MAGIC)) != ENVELOPE_MAGIC:
+        raise salt.exceptions.CommandExecutionError(
+            'Not a file encrypted with transit_encrypt_stream')
+    length = _read_full(source, _ENVELOPE_LENGTH.size)
+    if len(length) < _ENVELOPE_LENGTH.size:
+        raise truncated
+    header = _read_full(source, _ENVELOPE_LENGTH.unpack(length)[0])
+    metadata = json.loads(header.decode('utf-8'))
+    data_key = client.transit_decrypt_data(metadata['key'], metadata['wrapped_key'],
+        context=metadata['context'], mount_point=metadata['mount_point'])['data']
+    key = base64.b64decode(data_key['plaintext'])
+    # A chunk and its 16 byte GCM tag, don't trust the frame lengths beyond that
+    max_frame_length = metadata['chunk_size'] + 16
+
+    total = 0
+    index = 0
+    while True:
+        frame = _read_full(source, _ENVELOPE_FRAME.size)
+        if len(frame) < _ENVELOPE_FRAME.size:
+            raise truncated
+        final, length = _ENVELOPE_FRAME.unpack(frame)
+        if length > max_frame_length:
+            raise salt.exceptions.CommandExecutionError(
+                'Encrypted file is corrupt or has been tampered with')
+        encrypted = _read_full(source, length)
+        if len(encrypted) < length:
+            raise truncated
+        chunk = _aes_gcm_decrypt(key, _envelope_nonce(index), encrypted,
+                                 _envelope_aad(header, index, final))
+        destination.write(chunk)
+        total += len(chunk)
+        if final:
+            return total
+        index += 1
@@ -0,0 +1,675 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+
+try:
+    from unittest.mock import Mock, patch
+except:
+    from mock import Mock, patch
+
+try:
+    from importlib.util import module_from_spec, spec_from_file_location
+except ImportError:
+    # py2
+    from imp import load_source
+else:
+    def load_source(name, path):
+        spec = spec_from_file_location(name, path)
+        module = module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+import pytest
+
+
+# The execution and state modules are also called mdl_vault, load this one under a
+# different name to not clash with them
+mdl_vault = load_source('mdl_vault_utils',
+    os.path.join(os.path.dirname(__file__), 'mdl_vault.py'))
+
+
+@pytest.fixture(autouse=True)
+def dunders():
+    mdl_vault.__opts__ = {
+        'vault': {
+            'url': 'https://vault.example.com:8200',
+            'auth': {'method': 'token', 'token': 'test-token'},
+        },
+        'local': True,
+        'pki_dir': '/etc/salt/pki/minion',
+    }
+    mdl_vault.__grains__ = {'id': 'test-minion'}
+    mdl_vault._connection_cache.clear()
+    mdl_vault._connection_cache_counters.update({'hits': 0, 'refreshes': 0})
+    mdl_vault._session = None
+    mdl_vault._request_counters.update(dict.fromkeys(mdl_vault._request_counters, 0))
+    mdl_vault._rate_limiter = None
+    mdl_vault._circuit_breakers.clear()
+    mdl_vault._leaders.clear()
+    mdl_vault._request_aggregates.clear()
+    mdl_vault._wall_time.update({'in_flight': 0, 'started': None, 'seconds': 0.0})
+    mdl_vault._token_pool = None
+    yield
+    del mdl_vault.__opts__
+    del mdl_vault.__grains__
+
+
+def connection_details(token='token', lease_duration=3600, uses=0, issued=None):
+    return {
+        'url': 'https://vault.example.com:8200',
+        'token': token,
+        'verify': None,
+        'lease_duration': lease_duration,
+        'issued': mdl_vault.time.time() if issued is None else issued,
+        'uses': uses,
+    }
+
+
+def test_connection_is_cached():
+    fetch = Mock(return_value=connection_details())
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch):
+        first = mdl_vault._get_vault_connection()
+        second = mdl_vault._get_vault_connection()
+
+    assert fetch.call_count == 1
+    assert first['from_cache'] is False
+    assert second['from_cache'] is True
+    assert second['token'] == 'token'
+    stats = mdl_vault.connection_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['refreshes'] == 1
+
+
+def test_connection_cache_is_keyed_by_minion():
+    fetch = Mock(side_effect=[connection_details('a'), connection_details('b')])
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch):
+        mdl_vault._get_vault_connection()
+        mdl_vault.__grains__ = {'id': 'other-minion'}
+        connection = mdl_vault._get_vault_connection()
+
+    assert fetch.call_count == 2
+    assert connection['token'] == 'b'
+
+
+def test_connection_refreshed_when_out_of_uses():
+    fetch = Mock(side_effect=[connection_details('a', uses=2),
+                              connection_details('b', uses=2)])
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch):
+        tokens = [mdl_vault._get_vault_connection()['token'] for _ in range(3)]
+
+    assert tokens == ['a', 'a', 'b']
+
+
+def test_single_use_token_is_not_reused():
+    fetch = Mock(side_effect=[connection_details('a', uses=1),
+                              connection_details('b', uses=1)])
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch):
+        tokens = [mdl_vault._get_vault_connection()['token'] for _ in range(2)]
+
+    assert tokens == ['a', 'b']
+
+
+def test_connection_refreshed_before_expiry():
+    fetch = Mock(side_effect=[
+        connection_details('a', lease_duration=5),
+        connection_details('b'),
+    ])
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch):
+        tokens = [mdl_vault._get_vault_connection()['token'] for _ in range(2)]
+
+    # The token expires within the expiry margin and should thus not be reused
+    assert tokens == ['a', 'b']
+
+
+def token_pool(fetch, **kwargs):
+    revoke = Mock(side_effect=lambda evicted: len(evicted))
+    return mdl_vault.MinionTokenPool(fetch, revoke, **kwargs), revoke
+
+
+def test_token_pool_reuses_tokens_and_revokes_evicted():
+    fetch = Mock(side_effect=lambda minion_id: connection_details(
+        'token-' + minion_id, uses=3))
+    pool, revoke = token_pool(fetch, max_size=2)
+
+    tokens = [pool.connection(minion_id)['token']
+              for minion_id in ['a', 'a', 'b', 'a', 'c', 'a', 'b']]
+    pool.close(revoke=False)
+
+    assert tokens == ['token-a', 'token-a', 'token-b', 'token-a', 'token-c',
+                      'token-a', 'token-b']
+    # a ran out of uses, b was evicted when c was added and fetched again
+    assert [call[0][0] for call in fetch.call_args_list] == ['a', 'b', 'c', 'a', 'b']
+    evicted = [token for call in revoke.call_args_list for _, _, token in call[0][0]]
+    assert 'token-b' in evicted
+    assert pool.stats()['size'] == 2
+
+
+def test_token_pool_refreshes_ahead_of_expiry():
+    fetch = Mock(side_effect=[connection_details('a', lease_duration=100),
+                              connection_details('b', lease_duration=1000)])
+    pool, revoke = token_pool(fetch, refresh_ahead=200)
+
+    assert pool.connection('minion')['token'] == 'a'
+    # Still valid, but due to be refreshed
+    assert pool.connection('minion')['token'] == 'a'
+    pool.close(revoke=False)
+
+    assert pool.tokens['minion']['token'] == 'b'
+    assert pool.stats()['refreshes'] == 1
+    revoke.assert_not_called()
+
+
+def test_master_uses_token_pool():
+    mdl_vault.__opts__['__role'] = 'master'
+    mdl_vault.__opts__['vault']['token_pool'] = {'uses': 10}
+    runner = Mock(return_value={'url': 'https://vault', 'token': 'minion-token',
+                                'verify': None, 'uses': 10})
+    mdl_vault.__salt__ = {'saltutil.runner': runner}
+    with patch.object(mdl_vault.salt.crypt, 'sign_message', Mock(return_value=b'sig')):
+        tokens = [mdl_vault._get_vault_connection()['token'] for _ in range(5)]
+    mdl_vault._token_pool.close(revoke=False)
+    mdl_vault.__salt__ = None
+
+    assert tokens == ['minion-token'] * 5
+    # Only the configured options are passed, older runners don't accept a ttl
+    runner.assert_called_once_with('vault.generate_token', minion_id='test-minion',
+        signature=mdl_vault.base64.b64encode(b'sig'), impersonated_by_master=True,
+        uses=10)
+    assert mdl_vault.token_pool_stats()['hits'] == 4
+
+
+def test_make_request_refreshes_token_on_forbidden():
+    fetch = Mock(side_effect=[connection_details('a'), connection_details('b')])
+    session = Mock()
+    session.request.side_effect = [Mock(status_code=200), Mock(status_code=403),
+                                   Mock(status_code=200)]
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch):
+        mdl_vault.make_request(session, 'get', '/v1/secret/foo')
+        response = mdl_vault.make_request(session, 'get', '/v1/secret/foo')
+
+    assert response.status_code == 200
+    assert fetch.call_count == 2
+    last_headers = session.request.call_args[1]['headers']
+    assert last_headers['X-Vault-Token'] == 'b'
+
+
+def test_session_is_shared():
+    mdl_vault.__opts__['vault']['pool_maxsize'] = 32
+
+    session = mdl_vault.get_session()
+    client = mdl_vault.VaultClient()
+
+    assert client.session is session
+    assert mdl_vault.get_session() is session
+    adapter = session.get_adapter('https://vault.example.com:8200')
+    assert adapter._pool_maxsize == 32
+
+
+def test_token_lookup_uses_shared_session():
+    session = Mock()
+    session.get.return_value = Mock(status_code=200,
+        **{'json.return_value': {'data': {'ttl': 60, 'num_uses': 0}}})
+    mdl_vault._session = session
+
+    assert mdl_vault._lookup_self_token() == {'ttl': 60, 'num_uses': 0}
+    session.get.assert_called_once()
+
+
+def test_run_concurrently_keeps_order():
+    def slow_square(value):
+        mdl_vault.time.sleep(0.01 * (5 - value))
+        return value * value
+
+    results = list(mdl_vault.run_concurrently(slow_square, range(5), max_workers=5))
+
+    assert results == [(value, value * value, None) for value in range(5)]
+
+
+def test_run_concurrently_captures_errors():
+    def fail_on_odd(value):
+        if value % 2:
+            raise ValueError(value)
+        return value
+
+    results = sorted(mdl_vault.run_concurrently(fail_on_odd, range(4), ordered=False),
+        key=lambda result: result[0])
+
+    assert [error is None for _, _, error in results] == [True, False, True, False]
+    assert isinstance(results[1][2], ValueError)
+
+
+def test_read_many():
+    # threading.Barrier is py3 only
+    in_flight = []
+    all_in_flight = mdl_vault.threading.Event()
+
+    def read(path):
+        # Blocks unless all three reads are in flight at the same time
+        in_flight.append(path)
+        if len(in_flight) == 3:
+            all_in_flight.set()
+        assert all_in_flight.wait(5)
+        if path == 'secret/missing':
+            return None
+        if path == 'secret/forbidden':
+            raise mdl_vault.Forbidden('permission denied')
+        return {'data': {'value': path}}
+
+    client = mdl_vault.VaultClient()
+    with patch.object(client, 'read', read):
+        results = client.read_many(
+            ['secret/foo', 'secret/missing', 'secret/forbidden'], max_workers=3)
+
+    assert results == {
+        'secret/foo': {'data': {'value': 'secret/foo'}},
+        'secret/missing': None,
+        'secret/forbidden': {'error': 'permission denied'},
+    }
+
+
+def response(status_code, headers=None, content=b''):
+    return Mock(status_code=status_code, headers=headers or {}, is_redirect=False,
+                text='error', content=content)
+
+
+@pytest.fixture
+def vault_session():
+    session = Mock()
+    fetch = Mock(return_value=connection_details())
+    with patch.object(mdl_vault, '_fetch_vault_connection', fetch), \
+            patch.object(mdl_vault.time, 'sleep') as sleep:
+        session.sleep = sleep
+        yield session
+
+
+def test_request_retried_when_rate_limited(vault_session):
+    vault_session.request.side_effect = [
+        response(429, {'Retry-After': '2'}), response(200)]
+    client = mdl_vault.VaultClient(session=vault_session)
+
+    client.write('secret/foo', value='bar')
+
+    assert vault_session.request.call_count == 2
+    vault_session.sleep.assert_called_once_with(2.0)
+    stats = mdl_vault.request_stats()
+    assert stats['requests'] == 2
+    assert stats['retries'] == 1
+
+
+def test_retry_after():
+    with patch.object(mdl_vault.time, 'time', Mock(return_value=1445412470)):
+        assert mdl_vault._retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 10
+    assert mdl_vault._retry_after({'Retry-After': '2'}) == 2
+    assert mdl_vault._retry_after({'Retry-After': 'soon'}) is None
+    assert mdl_vault._retry_after({}) is None
+
+
+def test_request_gives_up_after_max_attempts(vault_session):
+    vault_session.request.return_value = response(503)
+    client = mdl_vault.VaultClient(session=vault_session, retry={'max_attempts': 3})
+
+    with pytest.raises(mdl_vault.VaultDown):
+        client.read('secret/foo')
+
+    assert vault_session.request.call_count == 3
+    assert all(call[0][0] <= 1.0 for call in vault_session.sleep.call_args_list)
+
+
+def test_server_error_only_retried_for_idempotent_requests(vault_session):
+    vault_session.request.side_effect = [response(500), response(500), response(200)]
+    client = mdl_vault.VaultClient(session=vault_session)
+
+    with pytest.raises(mdl_vault.InternalServerError):
+        client.write('database/creds/app')
+    client.read('secret/foo')
+
+    assert vault_session.request.call_count == 3
+
+
+def test_health_check_is_not_retried(vault_session):
+    vault_session.request.return_value = response(429)
+    client = mdl_vault.VaultClient(session=vault_session)
+
+    with pytest.raises(mdl_vault.RateLimitExceeded):
+        client.read('sys/health')
+
+    assert vault_session.request.call_count == 1
+
+
+def test_circuit_breaker_is_on_by_default(vault_session):
+    client = mdl_vault.VaultClient(url='https://vault.example.com:8200',
+                                   session=vault_session)
+
+    assert client.circuit_breaker is not None
+    assert client.circuit_breaker is mdl_vault.VaultClient(
+        url='https://vault.example.com:8200', session=vault_session,
+        circuit_breaker={}).circuit_breaker
+    assert mdl_vault.VaultClient(url='https://vault.example.com:8200',
+        session=vault_session, circuit_breaker=False).circuit_breaker is None
+
+
+def test_circuit_breaker_fails_fast(vault_session):
+    vault_session.request.side_effect = mdl_vault.requests.ConnectionError('down')
+    client = mdl_vault.VaultClient(
+        session=vault_session, retry=False,
+        circuit_breaker={'failure_threshold': 2, 'reset_timeout': 60})
+
+    for _ in range(2):
+        with pytest.raises(mdl_vault.requests.ConnectionError):
+            client.read('secret/foo')
+    with pytest.raises(mdl_vault.VaultDown):
+        client.read('secret/foo')
+
+    assert vault_session.request.call_count == 2
+    assert mdl_vault.request_stats()['circuit_open'] == 1
+
+
+def test_token_bucket_limits_rate():
+    with patch.object(mdl_vault.time, 'sleep') as sleep, \
+            patch.object(mdl_vault.time, 'time', return_value=1000.0):
+        bucket = mdl_vault.TokenBucket(rate=10, burst=2)
+        waits = [bucket.acquire() for _ in range(4)]
+
+    assert waits == [0, 0, pytest.approx(0.1), pytest.approx(0.2)]
+    assert sleep.call_count == 2
+
+
+def redirect(location):
+    return Mock(status_code=307, headers={'Location': location}, is_redirect=True,
+                content=b'')
+
+
+def requested_urls(session):
+    return [call[0][1] for call in session.request.call_args_list]
+
+
+def test_redirect_to_leader_is_remembered(vault_session):
+    vault_session.request.side_effect = [
+        redirect('https://vault-2:8200/v1/secret/foo'), response(200),
+        response(200)]
+    client = mdl_vault.VaultClient(url='https://vault.example.com:8200',
+                                   session=vault_session)
+
+    client.read('secret/foo')
+    client.read('secret/bar')
+
+    assert requested_urls(vault_session) == [
+        'https://vault.example.com:8200/v1/secret/foo',
+        'https://vault-2:8200/v1/secret/foo',
+        'https://vault-2:8200/v1/secret/bar',
+    ]
+
+
+def test_close_keeps_shared_session_open():
+    shared = mdl_vault.VaultClient(url='https://vault.example.com:8200')
+    own_session = Mock()
+    own = mdl_vault.VaultClient(url='https://vault.example.com:8200',
+                                session=own_session)
+
+    with patch.object(shared.session, 'close') as close:
+        shared.close()
+    own.close()
+
+    close.assert_not_called()
+    own_session.close.assert_called_once_with()
+
+
+def test_redirect_keeps_query_string(vault_session):
+    vault_session.request.side_effect = [
+        redirect('https://vault-2:8200/v1/transit/keys?list=true'), response(200)]
+    client = mdl_vault.VaultClient(url='https://vault.example.com:8200',
+                                   session=vault_session)
+
+    client.transit_list_keys()
+
+    assert requested_urls(vault_session) == [
+        'https://vault.example.com:8200/v1/transit/keys?list=true',
+        'https://vault-2:8200/v1/transit/keys?list=true',
+    ]
+
+
+def test_unreachable_leader_falls_back_to_configured_url(vault_session):
+    vault_session.request.side_effect = [
+        mdl_vault.requests.ConnectionError('refused'), response(200)]
+    client = mdl_vault.VaultClient(url='https://vault.example.com:8200',
+                                   session=vault_session)
+    client._remember_leader('https://vault-2:8200')
+
+    client.write('database/creds/app')
+
+    assert requested_urls(vault_session) == [
+        'https://vault-2:8200/v1/database/creds/app',
+        'https://vault.example.com:8200/v1/database/creds/app',
+    ]
+    assert client._leader_url() is None
+
+
+def test_expired_leader_is_looked_up(vault_session):
+    leader = response(200)
+    leader.json.return_value = {'ha_enabled': True, 'is_self': False,
+                                'leader_address': 'https://vault-3:8200'}
+    vault_session.request.side_effect = [leader, response(200)]
+    client = mdl_vault.VaultClient(url='https://vault.example.com:8200',
+                                   session=vault_session, leader_ttl=60)
+    client._remember_leader('https://vault-2:8200')
+    mdl_vault._leaders[client._url]['expires'] = 0
+
+    client.read('secret/foo')
+
+    assert requested_urls(vault_session) == [
+        'https://vault.example.com:8200/v1/sys/leader',
+        'https://vault-3:8200/v1/secret/foo',
+    ]
+
+
+def test_request_hooks(vault_session):
+    vault_session.request.side_effect = [
+        response(429), response(200, content=b'{"data": {}}')]
+    records = []
+    mdl_vault.register_request_hook(records.append)
+    try:
+        mdl_vault.VaultClient(session=vault_session).read('secret/pillar_cache/web1')
+    finally:
+        mdl_vault.unregister_request_hook(records.append)
+
+    assert len(records) == 1
+    record = records[0]
+    assert record['method'] == 'GET'
+    assert record['path'] == 'secret/pillar_cache/*'
+    assert record['status'] == 200
+    assert record['bytes'] == 12
+    assert record['retries'] == 1
+    assert record['token_from_cache'] is True
+    assert record['error'] is None
+
+
+def test_stats(vault_session):
+    vault_session.request.side_effect = [response(200), response(200), response(404),
+                                         response(200)]
+    client = mdl_vault.VaultClient(session=vault_session)
+
+    client.read('secret/pillar_cache/web1')
+    client.read('secret/pillar_cache/web2')
+    client.read('secret/pillar_cache/missing')
+    client.list('sys/leases/lookup')
+
+    stats = mdl_vault.stats(reset=True)
+    assert sorted(stats['prefixes']) == ['secret/pillar_cache/*', 'sys/leases/*']
+    pillar_cache = stats['prefixes']['secret/pillar_cache/*']
+    assert pillar_cache['count'] == 3
+    assert pillar_cache['errors'] == 1
+    assert pillar_cache['p50'] <= pillar_cache['p95'] <= pillar_cache['p99']
+    assert stats['wall_seconds'] >= 0
+    assert stats['requests']['requests'] == 4
+    assert mdl_vault.stats()['prefixes'] == {}
+    assert mdl_vault.request_stats()['requests'] == 0
+
+
+def test_send_stats_event(vault_session):
+    vault_session.request.return_value = response(200)
+    client = mdl_vault.VaultClient(session=vault_session)
+    event_send = Mock()
+    mdl_vault.__salt__ = {'event.send': event_send}
+    try:
+        client.read('secret/foo')
+        mdl_vault.send_stats_event()
+        # Nothing happened since the last event
+        mdl_vault.send_stats_event()
+    finally:
+        mdl_vault.__salt__ = None
+
+    event_send.assert_called_once()
+    assert event_send.call_args[0][0] == 'vault/stats'
+    assert event_send.call_args[1]['data']['requests']['requests'] == 1
+
+
+def test_percentile():
+    latencies = list(range(1, 101))
+
+    assert mdl_vault._percentile(latencies, 50) == 50
+    assert mdl_vault._percentile(latencies, 95) == 95
+    assert mdl_vault._percentile(latencies, 99) == 99
+    assert mdl_vault._percentile([], 50) is None
+
+
+def json_response(status_code, data):
+    return Mock(status_code=status_code, is_redirect=False, text='',
+                content=mdl_vault.json.dumps(data).encode('utf-8'),
+                headers={'Content-Type': 'application/json'},
+                **{'json.return_value': data})
+
+
+def transit_session(vault_session):
+    def request(method, url, headers=None, json=None, **kwargs):
+        results = []
+        status_code = 200
+        for item in json['batch_input']:
+            if item['plaintext'] == 'broken-batch':
+                return json_response(500, {'errors': ['internal error']})
+            if item['plaintext'] == 'bad':
+                results.append({'error': 'invalid plaintext'})
+                status_code = 400
+            else:
+                results.append({'ciphertext': 'vault:v1:' + item['plaintext']})
+        return json_response(status_code, {'data': {'batch_results': results}})
+
+    vault_session.request.side_effect = request
+    return vault_session
+
+
+def test_transit_encrypt_batch(vault_session):
+    client = mdl_vault.VaultClient(session=transit_session(vault_session))
+    plaintexts = ['a', 'bad', 'broken-batch', 'd', 'e']
+
+    results = list(client.transit_encrypt_batch('key', iter(plaintexts), batch_size=2))
+
+    assert len(results) == 5
+    assert results[0] == {'ciphertext': 'vault:v1:a'}
+    assert results[1] == {'error': 'invalid plaintext'}
+    # The whole batch with the broken item failed
+    assert 'internal error' in results[2]['error']
+    assert 'internal error' in results[3]['error']
+    assert results[4] == {'ciphertext': 'vault:v1:e'}
+    assert vault_session.request.call_count == 3
+    batch_sizes = [len(call[1]['json']['batch_input'])
+                   for call in vault_session.request.call_args_list]
+    assert sorted(batch_sizes) == [1, 2, 2]
+
+
+def test_chunk_batch_limits_bytes():
+    items = [{'ciphertext': 'x' * 40} for _ in range(5)]
+
+    chunks = list(mdl_vault._chunk_batch(iter(items), max_items=10, max_bytes=100))
+
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+
+
+def test_bound_generators_are_listed():
+    def numbers(client):
+        yield 1
+        yield 2
+
+    with patch.object(mdl_vault, 'build_client', Mock()):
+        assert mdl_vault.bind_client(numbers)() == [1, 2]
+
+
+def transit_data_key_client():
+    key = mdl_vault.base64.b64encode(os.urandom(32)).decode('ascii')
+    client = Mock()
+    client.transit_generate_data_key.return_value = {
+        'data': {'plaintext': key, 'ciphertext': 'vault:v1:wrapped'}}
+    client.transit_decrypt_data.return_value = {'data': {'plaintext': key}}
+    return client
+
+
+def encrypt_stream(client, data, chunk_size=16):
+    encrypted = io.BytesIO()
+    size = mdl_vault.transit_encrypt_stream(client, 'backups', io.BytesIO(data),
+                                            encrypted, chunk_size=chunk_size)
+    assert size == len(data)
+    return encrypted.getvalue()
+
+
+def decrypt_stream(client, encrypted):
+    decrypted = io.BytesIO()
+    mdl_vault.transit_decrypt_stream(client, io.BytesIO(encrypted), decrypted)
+    return decrypted.getvalue()
+
+
+@pytest.mark.parametrize('has_aesgcm', [True, False])
+@pytest.mark.parametrize('size', [0, 15, 16, 100])
+def test_transit_stream_round_trip(size, has_aesgcm):
+    if has_aesgcm and not mdl_vault.HAS_AESGCM or \
+            not has_aesgcm and not mdl_vault.HAS_CRYPTODOME:
+        pytest.skip('Needs the AES-GCM implementation being tested')
+    client = transit_data_key_client()
+    data = os.urandom(size)
+
+    with patch.object(mdl_vault, 'HAS_AESGCM', has_aesgcm):
+        encrypted = encrypt_stream(client, data)
+        assert data not in encrypted or not data
+        assert decrypt_stream(client, encrypted) == data
+
+    client.transit_generate_data_key.assert_called_once_with('backups', 'plaintext',
+        context=None, bits=256, mount_point='transit')
+    client.transit_decrypt_data.assert_called_once_with('backups', 'vault:v1:wrapped',
+        context=None, mount_point='transit')
+
+
+def test_transit_stream_detects_tampering():
+    client = transit_data_key_client()
+    encrypted = bytearray(encrypt_stream(client, os.urandom(100)))
+    encrypted[-20] ^= 1
+
+    with pytest.raises(mdl_vault.salt.exceptions.CommandExecutionError,
+                       match='tampered'):
+        decrypt_stream(client, bytes(encrypted))
+
+
+def test_transit_stream_rejects_oversized_frames():
+    client = transit_data_key_client()
+    encrypted = encrypt_stream(client, os.urandom(10))
+    # Claim the single frame is 4 GiB long
+    frame_start = len(encrypted) - 10 - 16 - mdl_vault._ENVELOPE_FRAME.size
+    oversized = (encrypted[:frame_start] +
+                 mdl_vault._ENVELOPE_FRAME.pack(True, 2**32 - 1) +
+                 encrypted[frame_start + mdl_vault._ENVELOPE_FRAME.size:])
+
+    with patch.object(mdl_vault, '_read_full', wraps=mdl_vault._read_full) as read_full, \
+            pytest.raises(mdl_vault.salt.exceptions.CommandExecutionError,
+                          match='corrupt'):
+        decrypt_stream(client, oversized)
+    assert all(call[0][1] < 2**32 - 1 for call in read_full.call_args_list)
+
+
+def test_transit_stream_detects_truncation():
+    client = transit_data_key_client()
+    encrypted = encrypt_stream(client, os.urandom(100))
+    # Cut off the last frame, the one before it isn't marked as the last one
+    last_frame = mdl_vault._ENVELOPE_FRAME.size + 100 % 16 + 16
+    truncated = encrypted[:-last_frame]
+
+    with pytest.raises(mdl_vault.salt.exceptions.CommandExecutionError,
+                       match='truncated'):
+        decrypt_stream(client, truncated)
@@ -0,0 +1,527 @@
+#!/usr/bin/env python3
+
+'''
+Benchmark the Vault client and execution module against a fake Vault.
+
+The fake Vault runs in a separate process so it doesn't count towards the
+measured memory, and supports KV, dynamic credentials, leases, sys/health and
+sys/leader, a standby node that redirects to the leader, injected latency and
+random 429s. For each scenario the number of requests Vault received, the wall
+time, the throughput and the peak memory allocated by the client is reported.
+
+The client_overhead scenario doesn't use the fake Vault, its requests are
+answered without being sent, to measure what the client itself costs per request.
+
+    ./venv3/bin/python tools/vault_benchmark.py --latency 2 --standby
+'''
+
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from functools import reduce
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SCENARIOS = ('client_read', 'client_read_many', 'scan_leases', 'list_cache_paths',
+    'cached_read', 'client_overhead')
+
+
+def main():
+    args = get_args()
+    server = FakeVaultProcess(args)
+    server.start()
+    tmpdir = tempfile.mkdtemp(prefix='vault-benchmark-')
+    try:
+        utils, module = load_modules(args, server, tmpdir)
+        results = OrderedDict()
+        for scenario in args.scenarios:
+            server.reset_stats()
+            results[scenario] = run_scenario(scenario, args, server, utils, module)
+    finally:
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+class Tree(object):
+    '''
+    The directory structure of paths, so that listing a directory doesn't have
+    to look at every path.
+    '''
+
+    def __init__(self):
+        self.children = defaultdict(set)
+
+    def add(self, path):
+        parts = path.strip('/').split('/')
+        for i in range(len(parts) - 1):
+            self.children['/'.join(parts[:i])].add(parts[i] + '/')
+        self.children['/'.join(parts[:-1])].add(parts[-1])
+
+    def remove(self, path):
+        parts = path.strip('/').split('/')
+        key = parts[-1]
+        while parts:
+            parent = '/'.join(parts[:-1])
+            self.children[parent].discard(key)
+            if self.children[parent] or not parent:
+                break
+            del self.children[parent]
+            parts = parts[:-1]
+            key = parts[-1] + '/'
+
+    def list(self, directory):
+        return sorted(self.children.get(directory.strip('/'), ()))
+
+
+def vault_time(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime(
+        '%Y-%m-%dT%H:%M:%S.%f') + '123Z'
+
+
+class FakeVault(object):
+    def __init__(self, args):
+        self.latency = args.latency / 1000.0
+        self.rate_limit_probability = args.rate_limit_probability
+        self.lock = threading.Lock()
+        self.kv = {}
+        self.kv_tree = Tree()
+        self.leases = {}
+        self.lease_tree = Tree()
+        self.requests = defaultdict(int)
+        self.lease_counter = 0
+
+        now = time.time()
+        for i in range(args.leases):
+            # Spread the leases out over the next month, so about a quarter of
+            # them expire within the default time horizon of the scan
+            self.add_lease('database/creds/role%d' % (i % 100),
+                           random.uniform(3600, 30*24*3600), now)
+        for i in range(args.cache_paths):
+            self.write_kv('secret/pillar_cache/minion%d/database/creds/app%d' % (
+                i % 1000, i // 1000), {'value': {'lease_id': 'unknown'}})
+        for i in range(args.reads):
+            self.write_kv('secret/benchmark/%d' % i, {'value': i})
+
+    def add_lease(self, role, duration, now=None):
+        with self.lock:
+            self.lease_counter += 1
+            lease_id = '%s/%08x' % (role, self.lease_counter)
+            now = now or time.time()
+            self.leases[lease_id] = {
+                'issued': now,
+                'expires': now + duration,
+            }
+            self.lease_tree.add(lease_id)
+        return lease_id
+
+    def write_kv(self, path, data):
+        with self.lock:
+            self.kv[path] = data
+            self.kv_tree.add(path)
+
+    def delete_kv(self, path):
+        with self.lock:
+            if self.kv.pop(path, None) is not None:
+                self.kv_tree.remove(path)
+
+    def revoke(self, lease_id):
+        with self.lock:
+            if self.leases.pop(lease_id, None) is not None:
+                self.lease_tree.remove(lease_id)
+
+    def lease_info(self, lease_id):
+        lease = self.leases.get(lease_id)
+        if lease is None:
+            return None
+        return {
+            'id': lease_id,
+            'issue_time': vault_time(lease['issued']),
+            'expire_time': vault_time(lease['expires']),
+            'ttl': int(lease['expires'] - time.time()),
+            'renewable': True,
+        }
+
+
+class FakeVaultHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately, without this every response
+        # on a kept alive connection waits for a delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.handle_vault('GET')
+
+    def do_POST(self):
+        self.handle_vault('POST')
+
+    def do_PUT(self):
+        self.handle_vault('PUT')
+
+    def do_DELETE(self):
+        self.handle_vault('DELETE')
+
+    def do_LIST(self):
+        self.handle_vault('LIST')
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data=None, headers=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_vault(self, method):
+        vault = self.server.vault
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null') if length else None
+
+        if url.path.startswith('/_benchmark/'):
+            return self.handle_benchmark(url.path)
+
+        with vault.lock:
+            vault.requests[self.server.name] += 1
+        if vault.latency:
+            time.sleep(vault.latency)
+
+        path = url.path[len('/v1/'):]
+        if not self.server.is_leader and path not in ('sys/health', 'sys/leader'):
+            return self.send_json(307, headers={
+                'Location': self.server.leader_url + self.path})
+        if path != 'sys/health' and random.random() < vault.rate_limit_probability:
+            with vault.lock:
+                vault.requests['rate_limited'] += 1
+            return self.send_json(429, {'errors': ['rate limit quota exceeded']},
+                                  {'Retry-After': '0'})
+
+        if method == 'GET' and parse_qs(url.query).get('list', [''])[0].lower() == 'true':
+            method = 'LIST'
+        status, data = self.route(vault, method, path, body or {})
+        self.send_json(status, data)
+
+    def route(self, vault, method, path, body):
+        if path == 'sys/health':
+            return 200, {'initialized': True, 'sealed': False,
+                         'standby': not self.server.is_leader}
+        if path == 'sys/leader':
+            return 200, {'ha_enabled': True, 'is_self': self.server.is_leader,
+                         'leader_address': self.server.leader_url}
+        if path.startswith('sys/leases/lookup') and method == 'LIST':
+            keys = vault.lease_tree.list(path[len('sys/leases/lookup'):])
+            return (200, {'data': {'keys': keys}}) if keys else (404, {'errors': []})
+        if path == 'sys/leases/lookup':
+            lease = vault.lease_info(body.get('lease_id'))
+            if lease is None:
+                return 400, {'errors': ['invalid lease']}
+            return 200, {'data': lease}
+        if path in ('sys/leases/revoke', 'sys/revoke'):
+            vault.revoke(body.get('lease_id'))
+            return 204, None
+        if path.startswith('sys/revoke-prefix/'):
+            prefix = path[len('sys/revoke-prefix/'):].strip('/') + '/'
+            for lease_id in [lease_id for lease_id in list(vault.leases)
+                             if lease_id.startswith(prefix)]:
+                vault.revoke(lease_id)
+            return 204, None
+        if path.startswith('database/creds/') and method == 'GET':
+            lease_id = vault.add_lease(path, 24*3600)
+            return 200, {
+                'lease_id': lease_id,
+                'lease_duration': 24*3600,
+                'renewable': True,
+                'data': {'username': 'v-%s' % lease_id[-8:], 'password': 'secret'},
+            }
+
+        if method == 'LIST':
+            keys = vault.kv_tree.list(path)
+            return (200, {'data': {'keys': keys}}) if keys else (404, {'errors': []})
+        if method == 'GET':
+            if path not in vault.kv:
+                return 404, {'errors': []}
+            return 200, {'lease_duration': 2764800, 'lease_id': '',
+                         'data': vault.kv[path]}
+        if method in ('POST', 'PUT'):
+            vault.write_kv(path, body)
+            return 204, None
+        if method == 'DELETE':
+            vault.delete_kv(path)
+            return 204, None
+        return 405, {'errors': ['unsupported operation']}
+
+    def handle_benchmark(self, path):
+        vault = self.server.vault
+        with vault.lock:
+            if path == '/_benchmark/stats':
+                stats = dict(vault.requests)
+            else:
+                vault.requests.clear()
+                stats = {}
+        self.send_json(200, stats)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(args, ports):
+    vault = FakeVault(args)
+    leader = ThreadingHTTPServer(('127.0.0.1', 0), FakeVaultHandler)
+    standby = ThreadingHTTPServer(('127.0.0.1', 0), FakeVaultHandler)
+    leader_url = 'http://127.0.0.1:%d' % leader.server_address[1]
+    for server, name, is_leader in ((leader, 'leader', True),
+                                    (standby, 'standby', False)):
+        server.vault = vault
+        server.name = name
+        server.is_leader = is_leader
+        server.leader_url = leader_url
+    threading.Thread(target=standby.serve_forever, daemon=True).start()
+    ports.put((leader.server_address[1], standby.server_address[1]))
+    leader.serve_forever()
+
+
+class FakeVaultProcess(object):
+    def __init__(self, args):
+        self.args = args
+        self.process = None
+        self.leader_url = self.standby_url = None
+
+    def start(self):
+        ports = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=serve, args=(self.args, ports))
+        self.process.daemon = True
+        self.process.start()
+        leader_port, standby_port = ports.get(timeout=120)
+        self.leader_url = 'http://127.0.0.1:%d' % leader_port
+        self.standby_url = 'http://127.0.0.1:%d' % standby_port
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self):
+        return requests.get(self.leader_url + '/_benchmark/stats').json()
+
+    def reset_stats(self):
+        requests.get(self.leader_url + '/_benchmark/reset')
+
+
+class CannedSession(object):
+    '''
+    Answers every request with the same response without sending it.
+    '''
+
+    def __init__(self):
+        self.response = requests.Response()
+        self.response.status_code = 200
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response._content = json.dumps({'data': {'value': 'secret'}}).encode('utf-8')
+
+    def request(self, *args, **kwargs):
+        return self.response
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_modules(args, server, tmpdir):
+    '''
+    Load the utils and execution module with the dunders the salt loader would
+    have given them
+    '''
+    pki_dir = os.path.join(tmpdir, 'pki')
+    os.makedirs(pki_dir)
+    with open(os.path.join(pki_dir, 'minion.pem'), 'wb') as key_file:
+        key_file.write(os.urandom(1024))
+
+    vault_config = {
+        'url': server.standby_url if args.standby else server.leader_url,
+        'auth': {'method': 'token', 'token': 'benchmark'},
+        'leader_ttl': args.leader_ttl,
+        'pool_maxsize': max(10, args.workers),
+    }
+    opts = {
+        'vault': vault_config,
+        'local': True,
+        'file_client': 'local',
+        'master_type': 'disable',
+        'pki_dir': pki_dir,
+        'cachedir': os.path.join(tmpdir, 'cache'),
+        'vault.cache_base_path': 'secret/benchmark_cache',
+        'vault.lease_renewal_threshold': {'hours': 1},
+    }
+
+    def config_get(key, default=None):
+        return vault_config.get(key.split(':', 1)[1], default)
+
+    # Salt logs everything until logging is set up, which a master or minion
+    # would have done
+    logging.getLogger().setLevel(logging.WARNING)
+
+    utils = load_module('mdl_vault_utils', 'salt/_utils/mdl_vault.py')
+    utils.__opts__ = opts
+    utils.__grains__ = {'id': 'benchmark'}
+    utils.__salt__ = {'config.get': config_get}
+
+    module = load_module('mdl_vault_module', 'salt/_modules/mdl_vault.py')
+    module.__opts__ = opts
+    module.__grains__ = utils.__grains__
+    module.__salt__ = {'event.send': lambda *args, **kwargs: None}
+    module.__utils__ = {
+        'mdl_vault.build_client': utils.build_client,
+        'mdl_vault.run_concurrently': utils.run_concurrently,
+        'mdl_vault.vault_error': utils.vault_error,
+        'mdl_vault.stats': utils.stats,
+        'data.traverse_dict': lambda data, key: reduce(
+            lambda value, part: value[part], key.split(':'), data),
+    }
+    return utils, module
+
+
+def run_scenario(scenario, args, server, utils, module):
+    client = utils.build_client()
+    paths = ['secret/benchmark/%d' % i for i in range(args.reads)]
+
+    if scenario == 'client_read':
+        def run():
+            for path in paths:
+                client.read(path)
+            return len(paths)
+    elif scenario == 'client_read_many':
+        def run():
+            return len(client.read_many(paths, max_workers=args.workers))
+    elif scenario == 'scan_leases':
+        def run():
+            return len(module.scan_leases(send_events=False,
+                                          max_workers=args.workers))
+    elif scenario == 'list_cache_paths':
+        def run():
+            return len(module.list_cache_paths(prefix='secret/pillar_cache',
+                                               max_workers=args.workers))
+    elif scenario == 'client_overhead':
+        canned_client = utils.VaultClient(url=server.leader_url, session=CannedSession(),
+                                          leader_ttl=0)
+
+        def run():
+            for path in paths:
+                canned_client.read(path)
+            return len(paths)
+    elif scenario == 'cached_read':
+        def run():
+            # The second round should be served from the local cache
+            for _ in range(2):
+                for i in range(args.cached_reads):
+                    module.cached_read('database/creds/app',
+                                       cache_prefix='minion%d' % i)
+            return 2*args.cached_reads
+
+    utils.stats(reset=True)
+    # The request counters are per process, only report this scenario's share
+    requests_before = utils.request_stats()
+    if args.trace_memory:
+        tracemalloc.start()
+    started = time.time()
+    items = run()
+    elapsed = time.time() - started
+    peak_memory = None
+    if args.trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    vault_requests = server.stats()
+    client_stats = utils.stats(reset=True)
+    return OrderedDict([
+        ('items', items),
+        ('requests', vault_requests.get('leader', 0) + vault_requests.get('standby', 0)),
+        ('redirected', vault_requests.get('standby', 0)),
+        ('rate_limited', vault_requests.get('rate_limited', 0)),
+        ('retries', client_stats['requests']['retries'] - requests_before['retries']),
+        ('wall_seconds', round(elapsed, 3)),
+        ('items_per_second', int(items / elapsed) if elapsed else None),
+        ('peak_memory_mib', round(peak_memory / 1024.0 / 1024, 2)
+            if peak_memory is not None else None),
+        ('prefixes', client_stats['prefixes']),
+    ])
+
+
+def print_results(results):
+    columns = ('items', 'requests', 'redirected', 'rate_limited', 'retries',
+               'wall_seconds', 'items_per_second', 'peak_memory_mib')
+    print('%-18s %s' % ('scenario', ' '.join('%16s' % column for column in columns)))
+    for scenario, result in results.items():
+        print('%-18s %s' % (scenario, ' '.join('%16s' % result[column]
+                                                for column in columns)))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the Vault client and '
+        'execution module against a fake Vault')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+        metavar='scenario', help='Scenarios to run, out of %s. Default: all' % (
+        ', '.join(SCENARIOS)))
+    parser.add_argument('--leases', type=int, default=10000,
+        help='Number of leases to create. Default: %(default)s')
+    parser.add_argument('--cache-paths', type=int, default=5000,
+        help='Number of paths in the pillar cache. Default: %(default)s')
+    parser.add_argument('--reads', type=int, default=1000,
+        help='Number of KV secrets to read. Default: %(default)s')
+    parser.add_argument('--cached-reads', type=int, default=500,
+        help='Number of minions to do cached reads for. Default: %(default)s')
+    parser.add_argument('--workers', type=int, default=10,
+        help='Concurrent requests for the bulk operations. Default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0,
+        help='Milliseconds the fake Vault waits before responding. '
+        'Default: %(default)s')
+    parser.add_argument('--rate-limit-probability', type=float, default=0,
+        help='Probability of responding with 429 to a request. Default: %(default)s')
+    parser.add_argument('--standby', action='store_true',
+        help='Send requests to a standby node that redirects to the leader')
+    parser.add_argument('--leader-ttl', type=int, default=60,
+        help='How long the client remembers the leader. Default: %(default)s')
+    parser.add_argument('--no-trace-memory', dest='trace_memory',
+        action='store_false', help="Don't measure peak memory, which slows "
+        'down the client')
+    parser.add_argument('--json', action='store_true', help='Output results as json')
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+    return args
+
+
+if __name__ == '__main__':
+    main()